@@ -3,4 +3,193 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 
-# Register your models here.
+from django_advanced_queries.covid_19.models import (
+    Hospital,
+    Department,
+    EpidemicCurveBucket,
+    HospitalDailyStats,
+    Person,
+    HospitalWorker,
+    Patient,
+    MedicalExaminationResult,
+    PersonHealthState,
+    ReportJob,
+)
+from django_advanced_queries.covid_19.pagination import EstimatedCountPaginator
+from django_advanced_queries.covid_19.reports import REPORTS
+
+
+class CovidModelAdmin(admin.ModelAdmin):
+    """
+    Changelists in a constant number of queries on tables of any size.
+
+    Every related column shown is in list_select_related, relations are edited with raw id widgets
+    (no <select> of the whole related table), the list filters are choices/dates (no query) or small
+    related tables, and the pagination doesn't count the whole table.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+
+@admin.register(Hospital)
+class HospitalAdmin(CovidModelAdmin):
+    list_display = ('id', 'name', 'city', )
+    search_fields = ('name', )
+
+
+@admin.register(Department)
+class DepartmentAdmin(CovidModelAdmin):
+    list_display = ('id', 'name', 'hospital_name', )
+    list_select_related = ('hospital', )
+    list_filter = ('hospital', )
+    raw_id_fields = ('hospital', )
+    search_fields = ('name', )
+
+    def hospital_name(self, department):
+        return department.hospital.name
+    hospital_name.short_description = 'hospital'
+    hospital_name.admin_order_field = 'hospital__name'
+
+
+@admin.register(Person)
+class PersonAdmin(CovidModelAdmin):
+    list_display = ('id', 'name', 'age', 'gender', )
+    list_filter = ('gender', )
+    search_fields = ('name', )
+
+
+@admin.register(HospitalWorker)
+class HospitalWorkerAdmin(CovidModelAdmin):
+    list_display = ('id', 'person_name', 'position', 'department_name', 'hospital_name', )
+    list_select_related = ('person', 'department__hospital', )
+    list_filter = ('position', )
+    raw_id_fields = ('person', 'department', )
+
+    def person_name(self, hospital_worker):
+        return hospital_worker.person.name
+    person_name.short_description = 'person'
+
+    def department_name(self, hospital_worker):
+        return hospital_worker.department.name
+    department_name.short_description = 'department'
+
+    def hospital_name(self, hospital_worker):
+        return hospital_worker.department.hospital.name
+    hospital_name.short_description = 'hospital'
+
+
+@admin.register(Patient)
+class PatientAdmin(CovidModelAdmin):
+    list_display = ('id', 'person_name', 'department_name', 'hospital_name', 'last_result', )
+    list_select_related = ('person', 'department__hospital', 'last_medical_examination_result', )
+    # No filter on the last result, it goes through a join no index covers (PersonHealthStateAdmin filters
+    # by the indexed state)
+    raw_id_fields = ('person', 'department', 'last_medical_examination_result', )
+
+    def person_name(self, patient):
+        return patient.person.name
+    person_name.short_description = 'person'
+
+    def department_name(self, patient):
+        return patient.department.name
+    department_name.short_description = 'department'
+
+    def hospital_name(self, patient):
+        return patient.department.hospital.name
+    hospital_name.short_description = 'hospital'
+
+    def last_result(self, patient):
+        if patient.last_medical_examination_result is None:
+            return None
+        return patient.last_medical_examination_result.result
+    last_result.short_description = 'last result'
+
+
+@admin.register(MedicalExaminationResult)
+class MedicalExaminationResultAdmin(CovidModelAdmin):
+    list_display = ('id', 'time', 'result', 'patient_name', 'examined_by_name', 'hospital_name', )
+    list_select_related = ('patient__person', 'patient__department__hospital', 'examined_by__person', )
+    # covid_mer_result_patient_idx and covid_mer_time_idx
+    list_filter = ('result', 'time', )
+    raw_id_fields = ('patient', 'examined_by', )
+
+    def patient_name(self, medical_examination_result):
+        return medical_examination_result.patient.person.name
+    patient_name.short_description = 'patient'
+
+    def examined_by_name(self, medical_examination_result):
+        return medical_examination_result.examined_by.person.name
+    examined_by_name.short_description = 'examined by'
+
+    def hospital_name(self, medical_examination_result):
+        return medical_examination_result.patient.department.hospital.name
+    hospital_name.short_description = 'hospital'
+
+
+@admin.register(HospitalDailyStats)
+class HospitalDailyStatsAdmin(CovidModelAdmin):
+    list_display = ('id', 'hospital_name', 'date', ) + HospitalDailyStats.METRICS
+    list_select_related = ('hospital', )
+    list_filter = ('date', 'hospital', )
+    raw_id_fields = ('hospital', )
+
+    def hospital_name(self, hospital_daily_stats):
+        return hospital_daily_stats.hospital.name
+    hospital_name.short_description = 'hospital'
+
+
+@admin.register(EpidemicCurveBucket)
+class EpidemicCurveBucketAdmin(CovidModelAdmin):
+    list_display = ('id', 'period', 'start', 'department_name', ) + EpidemicCurveBucket.METRICS
+    list_select_related = ('department', )
+    list_filter = ('period', 'start', )
+    raw_id_fields = ('department', )
+
+    def department_name(self, epidemic_curve_bucket):
+        if epidemic_curve_bucket.department is None:
+            return 'Total'
+        return epidemic_curve_bucket.department.name
+    department_name.short_description = 'department'
+
+
+@admin.register(PersonHealthState)
+class PersonHealthStateAdmin(CovidModelAdmin):
+    list_display = (
+        'person_id',
+        'person_name',
+        'state',
+        'last_examination_time',
+        'first_corona_time',
+        'death_time',
+        'num_of_examinations',
+        'num_of_infections',
+        'num_of_recoveries',
+    )
+    list_select_related = ('person', )
+    list_filter = ('state', )
+    raw_id_fields = ('person', 'last_examination', )
+
+    def person_name(self, person_health_state):
+        return person_health_state.person.name
+    person_name.short_description = 'person'
+
+
+class ReportFilter(admin.SimpleListFilter):
+    """The reports of the registry, the default filter of a field without choices selects its distinct values."""
+    title = 'report'
+    parameter_name = 'report'
+
+    def lookups(self, request, model_admin):
+        return [(report, report) for report in sorted(REPORTS)]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(report=self.value())
+
+
+@admin.register(ReportJob)
+class ReportJobAdmin(CovidModelAdmin):
+    list_display = ('id', 'report', 'status', 'priority', 'attempts', 'worker', 'created_at', 'finished_at', )
+    list_filter = ('status', ReportFilter, )
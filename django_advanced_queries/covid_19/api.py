@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Read API resources.
+
+Every page is a single query: the rows are read as values (related columns joined in, no model
+instances), ordered by the resource's keyset and starting right after the cursor of the previous page
+(no OFFSET). The patients, workers and examinations are personal health data, for staff users only.
+
+A conditional request is answered from a single aggregate of the resource (see `Resource.get_validator`),
+before any page is read.
+"""
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count, Max, Q
+from django.utils.dateparse import parse_date, parse_datetime
+
+from django_advanced_queries.covid_19.exports import EXPORT_FIELDS, parse_since
+from django_advanced_queries.covid_19.models import (
+    Hospital,
+    Department,
+    EpidemicCurveBucket,
+    HospitalWorker,
+    Patient,
+    MedicalExaminationResult,
+)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+def parse_id(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid {name} "{value}"'.format(name=name, value=value))
+
+
+class Resource(object):
+    """
+    A model exposed as pages of `fields` (response key, lookup), filterable by `filters` (param, lookup).
+
+    A personal resource is served to staff users only. `latest_examination` (id lookup, time lookup) is the
+    examination the pages show whose latest one is the resource's modification time, if any.
+    """
+
+    def __init__(self, model, fields, filters=(), is_personal=False, latest_examination=None):
+        self.model = model
+        self.fields = fields
+        self.filters = filters
+        self.is_personal = is_personal
+        self.latest_examination = latest_examination
+        self.columns = tuple(column for column, _ in fields)
+
+    def get_queryset(self, using):
+        return self.model.objects.using(using).order_by('pk')
+
+    def filter(self, queryset, params):
+        for param, lookup in self.filters:
+            if params.get(param):
+                queryset = queryset.filter(**{lookup: parse_id(params[param], param)})
+        return queryset
+
+    def get_cursor(self, record):
+        return [record['id']]
+
+    def after_cursor(self, queryset, cursor):
+        last_id, = cursor
+        return queryset.filter(pk__gt=parse_id(last_id, 'cursor'))
+
+    def get_validator(self, params, using=DEFAULT_DB_ALIAS):
+        """
+        Return (ETag, modification time or None) of the pages of the params in a single aggregate query,
+        raising ValueError on invalid params.
+
+        The count and the highest id of the filtered rows change with additions and deletions, the latest
+        examination shown with new examinations. Changes in place (a renamed department, a corrected age)
+        keep the validator.
+        """
+        aggregates = {'count': Count('pk'), 'max_id': Max('pk')}
+        if self.latest_examination:
+            id_lookup, time_lookup = self.latest_examination
+            aggregates.update(latest_examination_id=Max(id_lookup), latest_examination_time=Max(time_lookup))
+        values = self.filter(self.get_queryset(using).order_by(), params).aggregate(**aggregates)
+
+        etag = hashlib.sha1(json.dumps(
+            [self.model._meta.label, sorted(params.items()), values],
+            sort_keys=True,
+            cls=DjangoJSONEncoder,
+        ).encode('utf-8')).hexdigest()
+        return '"{etag}"'.format(etag=etag), values.get('latest_examination_time')
+
+    def get_page(self, params, using=DEFAULT_DB_ALIAS):
+        """Return (records, next page cursor or None), raising ValueError on invalid params."""
+        page_size = parse_id(params.get('limit', DEFAULT_PAGE_SIZE), 'limit')
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise ValueError('limit must be between 1 and {max}'.format(max=MAX_PAGE_SIZE))
+
+        queryset = self.filter(self.get_queryset(using), params)
+        if params.get('cursor'):
+            cursor = decode_cursor(params['cursor'])
+            try:
+                queryset = self.after_cursor(queryset, cursor)
+            except (TypeError, ValueError):
+                raise ValueError('Invalid cursor')
+
+        # One more row tells whether there's a next page
+        rows = list(queryset.values_list(*[lookup for _, lookup in self.fields])[:page_size + 1])
+        records = [dict(zip(self.columns, row)) for row in rows[:page_size]]
+        next_cursor = encode_cursor(self.get_cursor(records[-1])) if len(rows) > page_size else None
+        return records, next_cursor
+
+
+class ExaminationsResource(Resource):
+    """Examinations ordered by (time, id), like the export."""
+
+    def get_queryset(self, using):
+        return self.model.objects.using(using).order_by('time', 'pk')
+
+    def filter(self, queryset, params):
+        queryset = super(ExaminationsResource, self).filter(queryset, params)
+        if params.get('since'):
+            queryset = queryset.filter(time__gte=parse_since(params['since']))
+        return queryset
+
+    def get_cursor(self, record):
+        return [record['time'], record['id']]
+
+    def after_cursor(self, queryset, cursor):
+        last_time, last_id = cursor
+        last_time = parse_datetime(last_time)
+        if last_time is None:
+            raise ValueError('Invalid cursor')
+        last_id = parse_id(last_id, 'cursor')
+        return queryset.filter(time__gte=last_time).filter(Q(time__gt=last_time) | Q(pk__gt=last_id))
+
+
+RESOURCES = {
+    'hospitals': Resource(Hospital, fields=(
+        ('id', 'pk'),
+        ('name', 'name'),
+        ('city', 'city'),
+    )),
+    'departments': Resource(Department, fields=(
+        ('id', 'pk'),
+        ('name', 'name'),
+        ('hospital_id', 'hospital'),
+        ('hospital', 'hospital__name'),
+    ), filters=(
+        ('hospital', 'hospital'),
+    )),
+    'patients': Resource(Patient, fields=(
+        ('id', 'pk'),
+        ('person_id', 'person'),
+        ('name', 'person__name'),
+        ('age', 'person__age'),
+        ('gender', 'person__gender'),
+        ('department_id', 'department'),
+        ('department', 'department__name'),
+        ('hospital_id', 'department__hospital'),
+        ('hospital', 'department__hospital__name'),
+        ('last_result', 'last_medical_examination_result__result'),
+        ('last_examination_time', 'last_medical_examination_result__time'),
+    ), filters=(
+        ('department', 'department'),
+        ('hospital', 'department__hospital'),
+        ('person', 'person'),
+    ), is_personal=True, latest_examination=(
+        'last_medical_examination_result',
+        'last_medical_examination_result__time',
+    )),
+    'workers': Resource(HospitalWorker, fields=(
+        ('id', 'pk'),
+        ('person_id', 'person'),
+        ('name', 'person__name'),
+        ('age', 'person__age'),
+        ('gender', 'person__gender'),
+        ('position', 'position'),
+        ('department_id', 'department'),
+        ('department', 'department__name'),
+        ('hospital_id', 'department__hospital'),
+        ('hospital', 'department__hospital__name'),
+    ), filters=(
+        ('department', 'department'),
+        ('hospital', 'department__hospital'),
+        ('person', 'person'),
+    ), is_personal=True),
+    'examinations': ExaminationsResource(MedicalExaminationResult, fields=EXPORT_FIELDS, filters=(
+        ('patient', 'patient'),
+        ('examined_by', 'examined_by'),
+    ), is_personal=True, latest_examination=('pk', 'time')),
+}
+
+
+def parse_date_param(params, name):
+    if not params.get(name):
+        return None
+    value = parse_date(params[name])
+    if value is None:
+        raise ValueError('Invalid {name} "{value}", expected an ISO date'.format(name=name, value=params[name]))
+    return value
+
+
+def get_epidemic_curve(params, using=DEFAULT_DB_ALIAS):
+    """
+    EpidemicCurveBucket.objects.get_series of ?period=day|week, ?group_by=department|hospital|total,
+    ?hospital=, ?department=, ?start= and ?end= (ISO dates), raising ValueError on invalid params.
+    """
+    group_by = params.get('group_by', 'department')
+    return EpidemicCurveBucket.objects.using(using).get_series(
+        period=params.get('period', EpidemicCurveBucket.PERIOD_DAY),
+        group_by=None if group_by == 'total' else group_by,
+        hospital=parse_id(params['hospital'], 'hospital') if params.get('hospital') else None,
+        department=parse_id(params['department'], 'department') if params.get('department') else None,
+        start_date=parse_date_param(params, 'start'),
+        end_date=parse_date_param(params, 'end'),
+    )
+
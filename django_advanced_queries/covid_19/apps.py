@@ -6,3 +6,13 @@ from django.apps import AppConfig
 
 class Covid19Config(AppConfig):
     name = 'django_advanced_queries.covid_19'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from django_advanced_queries.covid_19 import signals  # noqa: F401
+        from django_advanced_queries.covid_19.instrumentation import install_cursor_instrumentation
+        from django_advanced_queries.covid_19.sqlite import configure_connection
+
+        connection_created.connect(install_cursor_instrumentation, dispatch_uid='covid_19_instrumentation')
+        connection_created.connect(configure_connection, dispatch_uid='covid_19_sqlite_production')
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar NumPy arrays of the medical examination results, for analysis without model instances.
+
+The rows are read as tuples (values_list) in pages ordered by id, each page starting right after the
+previous one, and copied into arrays preallocated for the whole queryset: a few bytes per examination
+instead of a model instance. `ArraysCache` keeps the arrays in memory mapped .npy files and only reads
+the examinations added since (by id).
+
+NumPy is optional, only this module needs it.
+"""
+from __future__ import unicode_literals
+
+import collections
+import os
+
+from django.db import connections
+from django.db.models import Count, Max
+
+from django_advanced_queries.covid_19.functions import EpochMicroseconds
+
+try:
+    import numpy
+    from numpy.lib.format import open_memmap
+except ImportError:
+    numpy = None
+
+# (array name, lookup, dtype), results are stored as MedicalExaminationResult.RESULT_CODES
+EXAMINATION_ARRAY_FIELDS = (
+    ('id', 'pk', 'int64'),
+    ('time', 'time', 'datetime64[us]'),
+    ('result', 'result', 'uint8'),
+    ('patient_id', 'patient', 'int32'),
+    ('person_id', 'patient__person', 'int32'),
+    ('department_id', 'patient__department', 'int32'),
+    ('hospital_id', 'patient__department__hospital', 'int32'),
+    ('examined_by_id', 'examined_by', 'int32'),
+)
+EXAMINATION_ARRAY_NAMES = tuple(name for name, _, _ in EXAMINATION_ARRAY_FIELDS)
+
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def _check_numpy():
+    if numpy is None:
+        raise ImportError('NumPy is required for the examination arrays (pip install -r requirements.txt)')
+
+
+def get_array_fields(names=None):
+    if names is None:
+        return EXAMINATION_ARRAY_FIELDS
+
+    fields = {name: (name, lookup, dtype) for name, lookup, dtype in EXAMINATION_ARRAY_FIELDS}
+    unknown_names = [name for name in names if name not in fields]
+    if unknown_names:
+        raise ValueError('Unknown examination array fields {names}, choose from {choices}'.format(
+            names=', '.join(unknown_names),
+            choices=', '.join(EXAMINATION_ARRAY_NAMES),
+        ))
+    return tuple(fields[name] for name in names)
+
+
+def queryset_to_arrays(queryset, fields=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Ordered dict of array name -> NumPy array of the examinations in the queryset, ordered by id."""
+    _check_numpy()
+    fields = get_array_fields(fields)
+    result_codes = queryset.model.RESULT_CODES
+
+    # The rows are only read up to the current last id, so the arrays fit
+    size = queryset.order_by().aggregate(num=Count('pk'), max_id=Max('pk'))
+    arrays = collections.OrderedDict((name, numpy.empty(size['num'], dtype)) for name, _, dtype in fields)
+    if not size['num']:
+        return arrays
+
+    lookups = [lookup for _, lookup, _ in fields]
+    epoch_time = connections[queryset.db].vendor in EpochMicroseconds.vendors
+    if epoch_time and 'time' in lookups:
+        queryset = queryset.annotate(epoch_time=EpochMicroseconds('time'))
+        lookups[lookups.index('time')] = 'epoch_time'
+    rows = queryset.filter(pk__lte=size['max_id']).order_by('pk').values_list('pk', *lookups)
+
+    num_of_rows = 0
+    page = rows
+    while num_of_rows < size['num']:
+        chunk = list(page[:min(chunk_size, size['num'] - num_of_rows)])
+        if not chunk:
+            # Deleted meanwhile
+            break
+
+        columns = list(zip(*chunk))
+        start, end = num_of_rows, num_of_rows + len(chunk)
+        for (name, lookup, _), column in zip(fields, columns[1:]):
+            if lookup == 'result':
+                arrays[name][start:end] = [result_codes[result] for result in column]
+            elif lookup == 'time' and epoch_time:
+                arrays[name].view('int64')[start:end] = column
+            else:
+                arrays[name][start:end] = column
+
+        num_of_rows = end
+        page = rows.filter(pk__gt=columns[0][-1])
+
+    if num_of_rows < size['num']:
+        for name in arrays:
+            arrays[name] = arrays[name][:num_of_rows]
+    return arrays
+
+
+class ArraysCache(object):
+    """
+    Examination arrays of a queryset kept in `directory` as <name>.npy files, loaded memory mapped.
+
+    `refresh()` appends the examinations with an id above the last cached one (the watermark), the
+    cache doesn't see examinations updated or deleted since they were cached, `rebuild()` for that.
+    """
+
+    def __init__(self, directory, queryset, fields=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        names = [name for name, _, _ in get_array_fields(fields)]
+        # The ids are the watermark
+        self.names = ['id'] + [name for name in names if name != 'id']
+        self.directory = directory
+        self.queryset = queryset
+        self.chunk_size = chunk_size
+
+    def get_path(self, name):
+        return os.path.join(self.directory, '{name}.npy'.format(name=name))
+
+    def load(self):
+        """The cached arrays (read only memory maps), None if there's no complete cache."""
+        _check_numpy()
+        if not all(os.path.exists(self.get_path(name)) for name in self.names):
+            return None
+
+        arrays = collections.OrderedDict(
+            (name, numpy.load(self.get_path(name), mmap_mode='r')) for name in self.names
+        )
+        # Different lengths are left by an interrupted refresh
+        if len({len(array) for array in arrays.values()}) != 1:
+            return None
+        return arrays
+
+    def refresh(self):
+        """Append the examinations added since the last refresh and return the cached arrays."""
+        cached_arrays = self.load()
+        watermark = int(cached_arrays['id'][-1]) if cached_arrays and len(cached_arrays['id']) else 0
+        new_arrays = queryset_to_arrays(
+            self.queryset.filter(pk__gt=watermark),
+            fields=self.names,
+            chunk_size=self.chunk_size,
+        )
+        if not len(new_arrays['id']):
+            return new_arrays if cached_arrays is None else cached_arrays
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name in self.names:
+            new_array = new_arrays[name]
+            cached_array = cached_arrays[name] if cached_arrays is not None else new_array[:0]
+            temporary_path = '{path}.tmp'.format(path=self.get_path(name))
+            array = open_memmap(
+                temporary_path,
+                mode='w+',
+                dtype=new_array.dtype,
+                shape=(len(cached_array) + len(new_array), ),
+            )
+            array[:len(cached_array)] = cached_array
+            array[len(cached_array):] = new_array
+            array.flush()
+            del array
+            getattr(os, 'replace', os.rename)(temporary_path, self.get_path(name))
+
+        return self.load()
+
+    def rebuild(self):
+        for name in self.names:
+            if os.path.exists(self.get_path(name)):
+                os.remove(self.get_path(name))
+        return self.refresh()
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import os
+import random
+import shutil
+import threading
+import timeit
+
+from django.core.management import call_command
+from django.db import OperationalError, connections, transaction
+from django.db.models import Avg, Case, Count, QuerySet, When
+from django.test.utils import CaptureQueriesContext
+
+from django_advanced_queries.covid_19 import caching
+from django_advanced_queries.covid_19.data_generation import PATIENT_PROBABILITY, CovidDataGenerator
+from django_advanced_queries.covid_19.models import (
+    Hospital,
+    Department,
+    EpidemicCurveBucket,
+    Person,
+    HospitalWorker,
+    Patient,
+    MedicalExaminationResult,
+)
+
+BENCHMARK_EXAMS_PER_PATIENT = 4
+# Dead is terminal, so patients end up with fewer examinations than BENCHMARK_EXAMS_PER_PATIENT
+BENCHMARK_MEAN_EXAMS_PER_PATIENT = 3.1
+PERSONS_PER_HOSPITAL = 5000
+
+# name -> callable(using) calling a single manager method
+MANAGER_METHODS_BENCHMARKS = (
+    ('Patient.filter_by_examinations_results_options', lambda using: Patient.objects.using(
+        using).filter_by_examinations_results_options(results=('Botism', 'Corona'))),
+    ('Patient.get_highest_num_of_patient_medical_examinations', lambda using: Patient.objects.using(
+        using).get_highest_num_of_patient_medical_examinations()),
+    ('Patient.filter_by_examined_hospital_workers', lambda using: Patient.objects.using(
+        using).filter_by_examined_hospital_workers(hospital_workers=HospitalWorker.objects.get_sick_workers())),
+    ('Patient.filter_dead_from_corona', lambda using: Patient.objects.using(using).filter_dead_from_corona()),
+    ('Department.annotate_avg_age_of_patients', lambda using: Department.objects.using(
+        using).annotate_avg_age_of_patients()),
+    ('HospitalWorker.get_worker_performed_most_medical_examinations', lambda using: HospitalWorker.objects.using(
+        using).get_worker_performed_most_medical_examinations(filter_kwargs={'position': 'Doctor'}, exclude_kwargs={})),
+    ('HospitalWorker.get_sick_workers', lambda using: HospitalWorker.objects.using(using).get_sick_workers()),
+    ('Person.get_sick_persons', lambda using: Person.objects.using(using).get_sick_persons()),
+    ('Person.persons_with_multiple_jobs', lambda using: Person.objects.using(
+        using).persons_with_multiple_jobs(jobs=['Doctor', 'Nurse'])),
+    ('Hospital.annotate_by_num_of_hospital_workers_in_risk_of_corona', lambda using: Hospital.objects.using(
+        using).annotate_by_num_of_hospital_workers_in_risk_of_corona()),
+    ('Hospital.annotate_by_num_of_dead_from_corona', lambda using: Hospital.objects.using(
+        using).annotate_by_num_of_dead_from_corona()),
+    ('Hospital.dashboard', lambda using: Hospital.objects.using(using).dashboard()),
+    # The dashboard by chaining annotations (the joins fan out, some of the counts are wrong) to compare with
+    ('Hospital.dashboard_chained_annotations', lambda using: get_chained_annotations_dashboard(using)),
+)
+
+# name -> callable(using), the series reads the stored buckets from the second run on - its median shouldn't
+# grow with the history, unlike re-bucketing the whole history every time
+EPIDEMIC_CURVE_BENCHMARKS = (
+    ('EpidemicCurveBucket.get_series', lambda using: EpidemicCurveBucket.objects.using(using).get_series(
+        period=EpidemicCurveBucket.PERIOD_WEEK, group_by='hospital')),
+    ('EpidemicCurveBucket.compute_whole_history', lambda using: EpidemicCurveBucket.objects.using(using).compute(
+        EpidemicCurveBucket.PERIOD_WEEK, datetime.date.min, datetime.date.today())),
+)
+
+# profile name -> overrides of the DATABASES entry, the connections of 'default' are closed after every
+# operation (as after every request) and the database uses the rollback journal
+SQLITE_PROFILES = (
+    ('default', {'COVID_19_SQLITE_PRODUCTION': False, 'CONN_MAX_AGE': 0}),
+    ('production', {'COVID_19_SQLITE_PRODUCTION': True, 'CONN_MAX_AGE': 600}),
+)
+
+
+def get_chained_annotations_dashboard(using):
+    return Hospital.objects.using(using).annotate_by_num_of_hospital_workers_in_risk_of_corona(
+    ).annotate_by_num_of_dead_from_corona().annotate(
+        num_of_departments=Count('departments', distinct=True),
+        num_of_hospital_workers=Count('departments__hospital_workers__person', distinct=True),
+        num_of_sick_patients=Count(Case(When(
+            departments__patients_details__last_medical_examination_result__result__in=(
+                MedicalExaminationResult.SICK_RESULTS
+            ),
+            then='departments__patients_details',
+        )), distinct=True),
+        avg_age_of_patients=Avg('departments__patients_details__person__age'),
+    )
+
+
+def get_percentile(sorted_values, percentile):
+    index = int(round(percentile / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def evaluate(result):
+    """Fetch the rows of a lazy result and return how many there are."""
+    if isinstance(result, QuerySet):
+        return len(list(result))
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return 0 if result is None else 1
+
+
+def benchmark(func, using, repeat):
+    """
+    Call `func(using)` `repeat` times and report the latency, number of queries and number of rows.
+
+    The result cache is bypassed, every call hits the database.
+    """
+    latencies = []
+    for _ in range(repeat):
+        with caching.disabled(), CaptureQueriesContext(connections[using]) as context:
+            start_time = timeit.default_timer()
+            num_of_rows = evaluate(func(using))
+            latencies.append(timeit.default_timer() - start_time)
+
+    latencies.sort()
+    return {
+        'median_ms': get_percentile(latencies, 50) * 1000,
+        'p95_ms': get_percentile(latencies, 95) * 1000,
+        'num_of_queries': len(context.captured_queries),
+        'num_of_rows': num_of_rows,
+    }
+
+
+def setup_benchmark_database(num_of_examinations, database_dir, seed=None, log=None):
+    """
+    Register (and seed on first use) an SQLite database holding about `num_of_examinations` examinations.
+
+    Seeded databases are kept in `database_dir` and reused by later runs.
+    """
+    alias = 'benchmark_{num}'.format(num=num_of_examinations)
+    path = os.path.join(database_dir, '{alias}.sqlite3'.format(alias=alias))
+    is_seeded = os.path.exists(path)
+
+    connections.databases[alias] = dict(connections.databases['default'], NAME=path)
+    connections.ensure_defaults(alias)
+
+    if not is_seeded:
+        call_command('migrate', database=alias, verbosity=0)
+        num_of_persons = max(int(num_of_examinations / (PATIENT_PROBABILITY * BENCHMARK_MEAN_EXAMS_PER_PATIENT)), 100)
+        CovidDataGenerator(seed=seed, log=log, using=alias).generate(
+            num_of_hospitals=max(num_of_persons // PERSONS_PER_HOSPITAL, 3),
+            num_of_persons=num_of_persons,
+            exams_per_patient=BENCHMARK_EXAMS_PER_PATIENT,
+        )
+        with connections[alias].cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    return alias
+
+
+def run_benchmarks(scales, database_dir, repeat, benchmarks=MANAGER_METHODS_BENCHMARKS + EPIDEMIC_CURVE_BENCHMARKS,
+                   seed=None, log=None):
+    """Return {scale: {'num_of_examinations': ..., 'methods': {name: measurements}}}."""
+    if not os.path.exists(database_dir):
+        os.makedirs(database_dir)
+
+    report = {}
+    for scale in scales:
+        alias = setup_benchmark_database(scale, database_dir, seed=seed, log=log)
+        report[str(scale)] = {
+            'num_of_examinations': MedicalExaminationResult.objects.using(alias).count(),
+            'methods': {name: benchmark(func, alias, repeat) for name, func in benchmarks},
+        }
+        connections[alias].close()
+
+    return report
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """
+    Return a list of human readable regressions of `report` compared to `baseline`.
+
+    A method regresses when it issues more queries than before or its median latency grew by more
+    than `tolerance` (1.2 - 20% slower).
+    """
+    regressions = []
+    for scale, scale_report in sorted(report.items()):
+        baseline_methods = baseline.get(scale, {}).get('methods', {})
+        for name, measurements in sorted(scale_report['methods'].items()):
+            baseline_measurements = baseline_methods.get(name)
+            if baseline_measurements is None:
+                continue
+
+            if measurements['num_of_queries'] > baseline_measurements['num_of_queries']:
+                regressions.append('{scale} {name}: {num} queries (baseline {baseline_num})'.format(
+                    scale=scale,
+                    name=name,
+                    num=measurements['num_of_queries'],
+                    baseline_num=baseline_measurements['num_of_queries'],
+                ))
+            if measurements['median_ms'] > baseline_measurements['median_ms'] * tolerance:
+                regressions.append('{scale} {name}: median {median:.2f}ms (baseline {baseline_median:.2f}ms)'.format(
+                    scale=scale,
+                    name=name,
+                    median=measurements['median_ms'],
+                    baseline_median=baseline_measurements['median_ms'],
+                ))
+
+    return regressions
+
+
+def read_patient_report(using, rng, ids):
+    """A reporting request - a patient's examinations and the results in their hospital."""
+    patient_id, hospital_id = rng.choice(ids['patients'])
+    list(MedicalExaminationResult.objects.using(using).filter(patient=patient_id).order_by('time'))
+    list(MedicalExaminationResult.objects.using(using).filter(
+        patient__department__hospital=hospital_id,
+    ).values('result').annotate(num=Count('pk')).order_by())
+
+
+def write_examination(using, rng, ids):
+    """An ingest request - a new examination, the signals update its patient and the daily stats."""
+    patient_id, _ = rng.choice(ids['patients'])
+    with transaction.atomic(using=using):
+        MedicalExaminationResult.objects.using(using).create(
+            time=datetime.datetime.now(),
+            examined_by_id=rng.choice(ids['hospital_workers']),
+            patient_id=patient_id,
+            result=rng.choice(sorted(MedicalExaminationResult.RESULT_CODES)),
+        )
+
+
+def _run_operations(operation, using, seed, ids, stop_time, results, lock):
+    rng = random.Random(seed)
+    num_of_operations = 0
+    num_of_locked_errors = 0
+    try:
+        with caching.disabled():
+            while timeit.default_timer() < stop_time:
+                try:
+                    operation(using, rng, ids)
+                    num_of_operations += 1
+                except OperationalError as error:
+                    if 'locked' not in str(error):
+                        raise
+                    num_of_locked_errors += 1
+                # The end of a request, closes the connection unless it's persistent
+                connections[using].close_if_unusable_or_obsolete()
+    except Exception as error:
+        with lock:
+            results['errors'].append(error)
+    finally:
+        connections[using].close()
+
+    with lock:
+        results[operation.__name__]['num_of_operations'] += num_of_operations
+        results[operation.__name__]['num_of_locked_errors'] += num_of_locked_errors
+
+
+def remove_database_files(path):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def setup_profile_database(alias, profile, database_dir):
+    """Register a fresh copy of a benchmark database under the SQLite profile `profile`."""
+    path = connections.databases[alias]['NAME']
+    profile_alias = '{alias}_{profile}'.format(alias=alias, profile=profile)
+    profile_path = os.path.join(database_dir, '{alias}.sqlite3'.format(alias=profile_alias))
+    remove_database_files(profile_path)
+    connections[alias].close()
+    shutil.copyfile(path, profile_path)
+
+    connections.databases[profile_alias] = dict(
+        connections.databases[alias],
+        NAME=profile_path,
+        **dict(SQLITE_PROFILES)[profile]
+    )
+    connections.ensure_defaults(profile_alias)
+    if not connections.databases[profile_alias]['COVID_19_SQLITE_PRODUCTION']:
+        # The journal mode is stored in the file, the seeded database may be in WAL already
+        with connections[profile_alias].cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode = DELETE')
+        connections[profile_alias].close()
+    return profile_alias
+
+
+def benchmark_concurrency(using, num_of_readers, num_of_writers, duration, seed=None):
+    """
+    Run reporting readers and ingesting writers on threads for `duration` seconds against `using`.
+
+    Reports the throughput and the rate of "database is locked" errors of the reads and the writes.
+    """
+    ids = {
+        'patients': list(Patient.objects.using(using).values_list('pk', 'department__hospital')),
+        'hospital_workers': list(HospitalWorker.objects.using(using).values_list('pk', flat=True)),
+    }
+    connections[using].close()
+
+    rng = random.Random(seed)
+    results = {'errors': []}
+    lock = threading.Lock()
+    threads = []
+    stop_time = timeit.default_timer() + duration
+    for operation, num_of_threads in ((read_patient_report, num_of_readers), (write_examination, num_of_writers)):
+        results[operation.__name__] = {'num_of_threads': num_of_threads, 'num_of_operations': 0,
+                                       'num_of_locked_errors': 0}
+        for _ in range(num_of_threads):
+            threads.append(threading.Thread(
+                target=_run_operations,
+                args=(operation, using, rng.random(), ids, stop_time, results, lock),
+            ))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if results['errors']:
+        raise results['errors'][0]
+
+    report = {}
+    for operation in (read_patient_report, write_examination):
+        measurements = results[operation.__name__]
+        num_of_attempts = measurements['num_of_operations'] + measurements['num_of_locked_errors']
+        report[operation.__name__] = dict(
+            measurements,
+            operations_per_second=measurements['num_of_operations'] / float(duration),
+            locked_error_rate=measurements['num_of_locked_errors'] / float(num_of_attempts) if num_of_attempts else 0,
+        )
+    return report
+
+
+def run_concurrency_benchmarks(scale, database_dir, num_of_readers, num_of_writers, duration,
+                               profiles=tuple(profile for profile, _ in SQLITE_PROFILES), seed=None, log=None):
+    """Return {profile: concurrency measurements}, every profile runs on its own copy of the seeded database."""
+    if not os.path.exists(database_dir):
+        os.makedirs(database_dir)
+
+    alias = setup_benchmark_database(scale, database_dir, seed=seed, log=log)
+    report = {}
+    for profile in profiles:
+        profile_alias = setup_profile_database(alias, profile, database_dir)
+        report[profile] = benchmark_concurrency(profile_alias, num_of_readers, num_of_writers, duration, seed=seed)
+        connections[profile_alias].close()
+        remove_database_files(connections.databases.pop(profile_alias)['NAME'])
+
+    return report
+
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Max
+
+from django_advanced_queries.covid_19.caching import invalidate
+
+# Stay below SQLite's default SQLITE_MAX_VARIABLE_NUMBER (999 before 3.32) in "__in" lookups
+MAX_IN_LIST_SIZE = 900
+
+
+def get_next_id(model, using=DEFAULT_DB_ALIAS):
+    return (model.objects.using(using).aggregate(max_id=Max('pk'))['max_id'] or 0) + 1
+
+
+def insert_rows(model, field_names, rows, using=DEFAULT_DB_ALIAS):
+    """
+    Insert already db-prepared tuples with a single executemany.
+
+    bulk_create prepares every value of every instance through the fields, which dominates the cost
+    on the large tables, so those are written as plain rows instead.
+    """
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    sql = 'INSERT INTO {table} ({columns}) VALUES ({placeholders})'.format(
+        table=quote_name(model._meta.db_table),
+        columns=', '.join(quote_name(model._meta.get_field(field_name).column) for field_name in field_names),
+        placeholders=', '.join(['%s'] * len(field_names)),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+    invalidate(model, using=using)
+
+
+def chunks(items, size=MAX_IN_LIST_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Invalidation aware result cache of the covid_19 aggregate manager methods.
+
+QuerySet methods decorated with `cached(*models)` mark their queryset, and evaluating a marked
+queryset (iterating it, `aggregate()`) is served from the cache backend when possible. Querysets
+chained on a cached method stay cached, the key is the final SQL and parameters.
+
+Every model has a version, bumped on `post_save`/`post_delete` of its instances and by writes through
+the covid_19 querysets (`update()`, `delete()`, `bulk_create()`) and bulk inserts. Keys include the
+versions of the models the query depends on - the declared ones and every table it joins - so a write
+makes exactly the entries depending on the written model unreachable, they are evicted by the backend
+(LRU and TTL for the in-process one).
+
+The versions are bumped once the write commits: a bump before it would let a concurrent reader cache
+the rows as they were before the write under the new versions. Queries inside a transaction aren't served
+from nor stored in the cache, they may see the transaction's own uncommitted writes.
+
+Off by default (`COVID_19_QUERY_CACHE`). The default backend is the Django cache, which must be shared
+by the processes (as memcached or redis) for a write in one of them to invalidate the others' entries.
+"""
+from __future__ import unicode_literals
+
+import collections
+import functools
+import hashlib
+import pickle
+import threading
+import timeit
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils.module_loading import import_string
+
+from django_advanced_queries.covid_19.instrumentation import InstrumentedQuerySet
+from django_advanced_queries.covid_19.routers import get_primary
+
+KEY_PREFIX = 'covid_19:query_cache'
+
+
+_local = threading.local()
+
+
+def is_enabled():
+    return getattr(settings, 'COVID_19_QUERY_CACHE', False) and not getattr(_local, 'is_disabled', False)
+
+
+@contextmanager
+def disabled():
+    """Evaluate every query inside the block against the database (benchmarks)."""
+    was_disabled = getattr(_local, 'is_disabled', False)
+    _local.is_disabled = True
+    try:
+        yield
+    finally:
+        _local.is_disabled = was_disabled
+
+
+def get_ttl():
+    return getattr(settings, 'COVID_19_QUERY_CACHE_TTL', 300)
+
+
+def get_max_entries():
+    return getattr(settings, 'COVID_19_QUERY_CACHE_MAX_ENTRIES', 1024)
+
+
+class LocalBackend(object):
+    """
+    Thread safe in-process LRU cache with TTL eviction.
+
+    For a single process only, the writes of other processes don't invalidate its entries.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (expiry time, value), least recently used first
+        self._versions = {}
+        self.num_of_evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= timeit.default_timer():
+                del self._entries[key]
+                self.num_of_evictions += 1
+                return None
+            # Mark as most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (timeit.default_timer() + get_ttl(), value)
+            while len(self._entries) > get_max_entries():
+                self._entries.popitem(last=False)
+                self.num_of_evictions += 1
+
+    def get_versions(self, labels):
+        with self._lock:
+            return [self._versions.get(label, 0) for label in labels]
+
+    def bump_versions(self, labels):
+        with self._lock:
+            for label in labels:
+                self._versions[label] = self._versions.get(label, 0) + 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class DjangoCacheBackend(object):
+    """Backend on top of a Django cache, shared between processes (its own eviction policy applies)."""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, get_ttl())
+
+    def _get_version_key(self, label):
+        return '{prefix}:version:{label}'.format(prefix=KEY_PREFIX, label=label)
+
+    def get_versions(self, labels):
+        versions = self.cache.get_many([self._get_version_key(label) for label in labels])
+        return [versions.get(self._get_version_key(label), 0) for label in labels]
+
+    def bump_versions(self, labels):
+        for label in labels:
+            version_key = self._get_version_key(label)
+            # Versions never expire, an expired version would make old entries valid again
+            if not self.cache.add(version_key, 1, None):
+                try:
+                    self.cache.incr(version_key)
+                except ValueError:
+                    self.cache.set(version_key, 1, None)
+
+    def clear(self):
+        self.cache.clear()
+
+
+local_backend = LocalBackend()
+django_cache_backend = DjangoCacheBackend()
+
+
+def get_backend():
+    backend_path = getattr(settings, 'COVID_19_QUERY_CACHE_BACKEND', None)
+    return import_string(backend_path) if backend_path else django_cache_backend
+
+
+class CacheStats(object):
+    """Hits and misses per cached manager method, to size the cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def record(self, name, hit):
+        with self._lock:
+            counters = self._counters.setdefault(name, {'hits': 0, 'misses': 0})
+            counters['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {name: dict(counters) for name, counters in self._counters.items()}
+        for counters in snapshot.values():
+            counters['hit_ratio'] = counters['hits'] / float(counters['hits'] + counters['misses'])
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+
+
+stats = CacheStats()
+
+
+def get_label(model):
+    return model._meta.label
+
+
+def invalidate(*models, **kwargs):
+    """
+    Make every cached result depending on one of the models stale, once the transaction of the write (on
+    the `using` database) commits.
+    """
+    using = kwargs.pop('using', DEFAULT_DB_ALIAS)
+    if models:
+        labels = sorted({get_label(model) for model in models})
+        # Right away outside of a transaction, dropped with a rolled back one
+        transaction.on_commit(lambda: get_backend().bump_versions(labels), using=using)
+
+
+_table_labels = {}
+
+
+def _get_table_labels():
+    if not _table_labels:
+        _table_labels.update((model._meta.db_table, get_label(model)) for model in apps.get_models())
+    return _table_labels
+
+
+class CachingQuerySet(InstrumentedQuerySet):
+    """QuerySet serving the evaluation of querysets built by `cached` methods from the cache."""
+
+    _cache_name = None
+    _cache_dependencies = frozenset()
+
+    def _clone(self, **kwargs):
+        kwargs.setdefault('_cache_name', self._cache_name)
+        kwargs.setdefault('_cache_dependencies', self._cache_dependencies)
+        return super(CachingQuerySet, self)._clone(**kwargs)
+
+    def _get_cache_key(self, *extra):
+        """Key of the query in its current versions, None if it can't be cached."""
+        try:
+            sql, params = self.query.get_compiler(using=self.db).as_sql()
+        except EmptyResultSet:
+            return None
+
+        table_labels = _get_table_labels()
+        labels = set(self._cache_dependencies)
+        for join in self.query.alias_map.values():
+            if join.table_name in table_labels:
+                labels.add(table_labels[join.table_name])
+        labels = sorted(labels)
+        key_parts = (
+            self._cache_name,
+            # The read replica serving an analytic query is picked per query, they all hold the primary's rows
+            get_primary(self.db),
+            sql,
+            params,
+            self._iterable_class.__name__,
+            self._fields,
+            labels,
+            get_backend().get_versions(labels),
+        ) + extra
+        return '{prefix}:{name}:{digest}'.format(
+            prefix=KEY_PREFIX,
+            name=self._cache_name,
+            digest=hashlib.sha1(repr(key_parts).encode('utf-8')).hexdigest(),
+        )
+
+    def _is_cached(self):
+        return (
+            self._cache_name is not None and is_enabled() and
+            # The transaction writing to the primary (read from a replica or not)
+            not connections[get_primary(self.db)].in_atomic_block
+        )
+
+    def _get_or_compute(self, compute, *extra):
+        key = self._get_cache_key(*extra)
+        if key is None:
+            return compute()
+
+        backend = get_backend()
+        cached_value = backend.get(key)
+        stats.record(self._cache_name, hit=cached_value is not None)
+        if cached_value is not None:
+            # Stored pickled so callers can't mutate the cached instances
+            return pickle.loads(cached_value)
+
+        value = compute()
+        backend.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        return value
+
+    def _fetch_all(self):
+        if self._result_cache is not None or not self._is_cached():
+            return super(CachingQuerySet, self)._fetch_all()
+
+        def compute():
+            super(CachingQuerySet, self)._fetch_all()
+            return self._result_cache
+
+        self._result_cache = self._get_or_compute(compute)
+        # Prefetched objects are cached along with the instances
+        self._prefetch_done = True
+
+    def aggregate(self, *args, **kwargs):
+        if not self._is_cached():
+            return super(CachingQuerySet, self).aggregate(*args, **kwargs)
+        return self._get_or_compute(
+            lambda: super(CachingQuerySet, self).aggregate(*args, **kwargs),
+            'aggregate',
+            repr(args),
+            repr(sorted(kwargs.items())),
+        )
+
+    def update(self, **kwargs):
+        try:
+            return super(CachingQuerySet, self).update(**kwargs)
+        finally:
+            invalidate(self.model, using=self.db)
+
+    def delete(self):
+        try:
+            return super(CachingQuerySet, self).delete()
+        finally:
+            invalidate(self.model, using=self.db)
+
+    def bulk_create(self, *args, **kwargs):
+        try:
+            return super(CachingQuerySet, self).bulk_create(*args, **kwargs)
+        finally:
+            invalidate(self.model, using=self.db)
+
+
+def cached(*model_names):
+    """
+    Decorate a custom QuerySet method so its results are cached under `<Model>.<method>`.
+
+    `model_names` are the models the query depends on besides the ones it joins (subqueries), as
+    model names of the covid_19 app.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            name = '{model}.{method}'.format(model=self.model.__name__, method=method.__name__)
+            dependencies = {get_label(self.model)} | {
+                get_label(apps.get_model(self.model._meta.app_label, model_name)) for model_name in model_names
+            }
+            queryset = self._clone(
+                _cache_name=name,
+                _cache_dependencies=self._cache_dependencies | frozenset(dependencies),
+            )
+            return method(queryset, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_stats():
+    """Hits/misses per cached method, and the in-process backend's size when it's the one in use."""
+    snapshot = {'methods': stats.snapshot()}
+    backend = get_backend()
+    if isinstance(backend, LocalBackend):
+        snapshot['num_of_entries'] = len(backend)
+        snapshot['num_of_evictions'] = backend.num_of_evictions
+    return snapshot
+
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import random
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from django_advanced_queries.covid_19.bulk import get_next_id, insert_rows
+from django_advanced_queries.covid_19.models import (
+    Hospital,
+    Department,
+    HospitalDailyStats,
+    Person,
+    HospitalWorker,
+    Patient,
+    MedicalExaminationResult,
+    PersonHealthState,
+)
+
+CITIES = ('Jerusalem', 'Tel Aviv', 'Haifa', 'Be\'er Sheva', 'Be\'er Ya\'akov', 'Petah Tikva', 'Holon', 'Ashdod', )
+DEPARTMENT_NAMES = (
+    'Critical Care', 'Emergency', 'Internal Medicine', 'Pediatrics',
+    'Geriatrics', 'Cardiology', 'Surgery', 'Oncology',
+)
+FIRST_NAMES = (
+    'Alon', 'Ahmed', 'Rony', 'Dana', 'Yoav', 'Ron', 'Shalom', 'Lea', 'Daniel', 'Ruby', 'Abdul',
+    'Noa', 'Tamar', 'Omer', 'Yael', 'Itai', 'Maya', 'Amir', 'Shira', 'Eitan', 'Lior', 'Hila',
+)
+GENDERS = (Person.GENDER_MALE, Person.GENDER_FEMALE, Person.GENDER_UNDEFINED, )
+
+# Weighted next result given the previous one (None - first examination). Dead is terminal.
+RESULT_TRANSITIONS = {
+    None: (
+        (MedicalExaminationResult.RESULT_CORONA, 0.45),
+        (MedicalExaminationResult.RESULT_BOT, 0.25),
+        (MedicalExaminationResult.RESULT_HEALTHY, 0.3),
+    ),
+    MedicalExaminationResult.RESULT_CORONA: (
+        (MedicalExaminationResult.RESULT_CORONA, 0.5),
+        (MedicalExaminationResult.RESULT_HEALTHY, 0.3),
+        (MedicalExaminationResult.RESULT_BOT, 0.05),
+        (MedicalExaminationResult.RESULT_DEAD, 0.15),
+    ),
+    MedicalExaminationResult.RESULT_BOT: (
+        (MedicalExaminationResult.RESULT_BOT, 0.4),
+        (MedicalExaminationResult.RESULT_HEALTHY, 0.4),
+        (MedicalExaminationResult.RESULT_CORONA, 0.1),
+        (MedicalExaminationResult.RESULT_DEAD, 0.1),
+    ),
+    MedicalExaminationResult.RESULT_HEALTHY: (
+        (MedicalExaminationResult.RESULT_HEALTHY, 0.7),
+        (MedicalExaminationResult.RESULT_CORONA, 0.2),
+        (MedicalExaminationResult.RESULT_BOT, 0.1),
+    ),
+}
+
+WORKER_PROBABILITY = 0.1
+MULTIPLE_JOBS_PROBABILITY = 0.15
+PATIENT_PROBABILITY = 0.7
+MIN_WORKER_AGE = 22
+MAX_WORKER_AGE = 70
+FIRST_EXAMINATION_TIME = datetime.datetime(year=2020, month=3, day=1)
+FIRST_EXAMINATION_SPREAD_DAYS = 365
+MEAN_HOURS_BETWEEN_EXAMINATIONS = 36
+
+
+class CovidDataGenerator(object):
+    """
+    Fill Hospital -> Department -> Person -> HospitalWorker/Patient -> MedicalExaminationResult in batches.
+
+    Primary keys are assigned up front (bulk_create doesn't return them on SQLite) so every batch is
+    built in memory, inserted inside a single transaction and then dropped, keeping memory constant
+    regardless of the number of examinations.
+    """
+
+    def __init__(self, seed=None, batch_size=10000, log=None, using=DEFAULT_DB_ALIAS):
+        self.random = random.Random(seed)
+        self.using = using
+        self.batch_size = batch_size
+        self.log = log or (lambda message: None)
+
+    def generate(self, num_of_hospitals, num_of_persons, exams_per_patient):
+        department_ids_by_hospital = self.create_hospitals(num_of_hospitals)
+        department_ids = [department_id
+                          for hospital_department_ids in department_ids_by_hospital.values()
+                          for department_id in hospital_department_ids]
+
+        first_person_id, person_ages = self.create_persons(num_of_persons)
+        worker_ids_by_department = self.create_hospital_workers(first_person_id, person_ages, department_ids)
+        del person_ages
+
+        worker_ids_by_hospital = {
+            hospital_id: [worker_id
+                          for department_id in hospital_department_ids
+                          for worker_id in worker_ids_by_department.get(department_id, ())]
+            for hospital_id, hospital_department_ids in department_ids_by_hospital.items()
+        }
+        hospital_id_by_department = {
+            department_id: hospital_id
+            for hospital_id, hospital_department_ids in department_ids_by_hospital.items()
+            for department_id in hospital_department_ids
+        }
+        all_worker_ids = [worker_id
+                          for department_worker_ids in worker_ids_by_department.values()
+                          for worker_id in department_worker_ids]
+        if not all_worker_ids:
+            raise ValueError('Not enough persons to staff the hospitals, increase the number of persons')
+
+        def get_examiner_ids(department_id):
+            return (worker_ids_by_department.get(department_id) or
+                    worker_ids_by_hospital[hospital_id_by_department[department_id]] or
+                    all_worker_ids)
+
+        num_of_examinations = self.create_patients_with_examinations(
+            first_person_id,
+            num_of_persons,
+            department_ids,
+            get_examiner_ids,
+            exams_per_patient,
+        )
+
+        # The rows above bypassed the signals maintaining the rollups
+        HospitalDailyStats.objects.using(self.using).rebuild()
+        self.log('Rebuilt hospital daily stats')
+        PersonHealthState.objects.using(self.using).refresh(range(first_person_id, first_person_id + num_of_persons))
+        self.log('Refreshed persons health states')
+
+        return num_of_examinations
+
+    def create_hospitals(self, num_of_hospitals):
+        next_hospital_id = get_next_id(Hospital, using=self.using)
+        next_department_id = get_next_id(Department, using=self.using)
+
+        hospitals = []
+        departments = []
+        department_ids_by_hospital = {}
+        for hospital_id in range(next_hospital_id, next_hospital_id + num_of_hospitals):
+            hospitals.append(Hospital(
+                id=hospital_id,
+                name='Hospital {num}'.format(num=hospital_id),
+                city=self.random.choice(CITIES),
+            ))
+            num_of_departments = self.random.randint(3, len(DEPARTMENT_NAMES))
+            department_ids_by_hospital[hospital_id] = []
+            for name in self.random.sample(DEPARTMENT_NAMES, num_of_departments):
+                departments.append(Department(id=next_department_id, name=name, hospital_id=hospital_id))
+                department_ids_by_hospital[hospital_id].append(next_department_id)
+                next_department_id += 1
+
+        with transaction.atomic(using=self.using):
+            Hospital.objects.using(self.using).bulk_create(hospitals)
+            Department.objects.using(self.using).bulk_create(departments)
+
+        self.log('Created {hospitals} hospitals and {departments} departments'.format(
+            hospitals=len(hospitals),
+            departments=len(departments),
+        ))
+        return department_ids_by_hospital
+
+    def create_persons(self, num_of_persons):
+        """Return the first created person id and a compact list of ages (used to pick workers)."""
+        first_person_id = get_next_id(Person, using=self.using)
+        person_ages = bytearray()
+
+        for batch_start in range(0, num_of_persons, self.batch_size):
+            persons = []
+            for person_id in range(first_person_id + batch_start,
+                                   first_person_id + min(batch_start + self.batch_size, num_of_persons)):
+                age = int(self.random.triangular(0, 100, 45))
+                person_ages.append(age)
+                persons.append((
+                    person_id,
+                    self.random.choice(FIRST_NAMES),
+                    age,
+                    Person.GENDER_CODES[self.random.choice(GENDERS)],
+                    0,
+                    0,
+                ))
+
+            with transaction.atomic(using=self.using):
+                insert_rows(Person, ('id', 'name', 'age', 'gender', 'num_of_jobs', 'positions_mask', ), persons,
+                            using=self.using)
+
+        self.log('Created {persons} persons'.format(persons=num_of_persons))
+        return first_person_id, person_ages
+
+    def create_hospital_workers(self, first_person_id, person_ages, department_ids):
+        next_worker_id = get_next_id(HospitalWorker, using=self.using)
+        worker_ids_by_department = {}
+        num_of_workers = 0
+
+        hospital_workers = []
+        for offset, age in enumerate(person_ages):
+            if not MIN_WORKER_AGE <= age <= MAX_WORKER_AGE or self.random.random() >= WORKER_PROBABILITY:
+                continue
+
+            # Make sure every department gets staffed before spreading workers randomly
+            if num_of_workers < len(department_ids):
+                department_id = department_ids[num_of_workers]
+            else:
+                department_id = self.random.choice(department_ids)
+
+            num_of_jobs = self.random.randint(2, 3) if self.random.random() < MULTIPLE_JOBS_PROBABILITY else 1
+            for _ in range(num_of_jobs):
+                hospital_workers.append(HospitalWorker(
+                    id=next_worker_id,
+                    person_id=first_person_id + offset,
+                    department_id=department_id,
+                    position=self.random.choice((HospitalWorker.POSITION_DOCTOR, HospitalWorker.POSITION_NURSE)),
+                ))
+                worker_ids_by_department.setdefault(department_id, []).append(next_worker_id)
+                next_worker_id += 1
+                num_of_workers += 1
+
+            if len(hospital_workers) >= self.batch_size:
+                self.insert_hospital_workers(hospital_workers)
+                hospital_workers = []
+
+        self.insert_hospital_workers(hospital_workers)
+
+        self.log('Created {workers} hospital workers'.format(workers=num_of_workers))
+        return worker_ids_by_department
+
+    def insert_hospital_workers(self, hospital_workers):
+        if not hospital_workers:
+            return
+
+        with transaction.atomic(using=self.using):
+            HospitalWorker.objects.using(self.using).bulk_create(hospital_workers)
+            # bulk_create skips the signals maintaining the persons' jobs, a batch holds all the jobs of its persons
+            Person.objects.using(self.using).filter(
+                pk__gte=hospital_workers[0].person_id,
+                pk__lte=hospital_workers[-1].person_id,
+            ).refresh_jobs()
+
+    def get_num_of_examinations(self, exams_per_patient):
+        # Skewed - most patients get a few examinations, some get many (mean ~ exams_per_patient)
+        if exams_per_patient <= 1:
+            return exams_per_patient
+        return min(1 + int(self.random.expovariate(1.0 / (exams_per_patient - 1))), 20 * exams_per_patient)
+
+    def get_next_result(self, previous_result):
+        threshold = self.random.random()
+        cumulative_weight = 0
+        for result, weight in RESULT_TRANSITIONS[previous_result]:
+            cumulative_weight += weight
+            if threshold < cumulative_weight:
+                return result
+        return result
+
+    def create_patients_with_examinations(self, first_person_id, num_of_persons, department_ids,
+                                          get_examiner_ids, exams_per_patient):
+        next_patient_id = get_next_id(Patient, using=self.using)
+        next_examination_id = get_next_id(MedicalExaminationResult, using=self.using)
+        num_of_patients = 0
+        num_of_examinations = 0
+
+        adapt_datetime = connections[self.using].ops.adapt_datetimefield_value
+
+        patients = []
+        examinations = []
+        for person_id in range(first_person_id, first_person_id + num_of_persons):
+            if self.random.random() >= PATIENT_PROBABILITY:
+                continue
+
+            patient_id = next_patient_id
+            department_id = self.random.choice(department_ids)
+            next_patient_id += 1
+            examiner_ids = get_examiner_ids(department_id)
+
+            time = FIRST_EXAMINATION_TIME + datetime.timedelta(
+                days=self.random.random() * FIRST_EXAMINATION_SPREAD_DAYS,
+            )
+            result = None
+            last_examination_id = None
+            for _ in range(self.get_num_of_examinations(exams_per_patient)):
+                result = self.get_next_result(result)
+                examinations.append((
+                    next_examination_id,
+                    adapt_datetime(time),
+                    self.random.choice(examiner_ids),
+                    patient_id,
+                    MedicalExaminationResult.RESULT_CODES[result],
+                ))
+                last_examination_id = next_examination_id
+                next_examination_id += 1
+                if result == MedicalExaminationResult.RESULT_DEAD:
+                    break
+                time += datetime.timedelta(
+                    hours=self.random.expovariate(1.0 / MEAN_HOURS_BETWEEN_EXAMINATIONS),
+                )
+
+            patients.append((patient_id, person_id, department_id, last_examination_id, ))
+            if len(examinations) >= self.batch_size:
+                num_of_patients += len(patients)
+                num_of_examinations += len(examinations)
+                self._insert_patients_with_examinations(patients, examinations)
+                patients = []
+                examinations = []
+
+        num_of_patients += len(patients)
+        num_of_examinations += len(examinations)
+        self._insert_patients_with_examinations(patients, examinations)
+
+        self.log('Created {patients} patients and {examinations} medical examination results'.format(
+            patients=num_of_patients,
+            examinations=num_of_examinations,
+        ))
+        return num_of_examinations
+
+    def _insert_patients_with_examinations(self, patients, examinations):
+        # The patients already point at their last examination - both sides go in one transaction
+        with transaction.atomic(using=self.using):
+            insert_rows(
+                Patient,
+                ('id', 'person', 'department', 'last_medical_examination_result', ),
+                patients,
+                using=self.using,
+            )
+            insert_rows(
+                MedicalExaminationResult,
+                ('id', 'time', 'examined_by', 'patient', 'result', ),
+                examinations,
+                using=self.using,
+            )
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Representations of the covid_19 models that don't query per instance.
+
+The reprs go through foreign keys (an examination shows its patient's person and department, and its
+examiner's), so rendering a list of instances lazily loads every relation of every instance. Querysets
+preload exactly what the reprs need with `with_display_related()` (the models' DISPLAY_RELATED), and
+inside `without_lazy_loads()` (or with COVID_19_REPR_LAZY_LOADS = False) the reprs never query: a
+relation that isn't loaded is shown by its id.
+"""
+from __future__ import unicode_literals
+
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from django_advanced_queries.covid_19.caching import CachingQuerySet
+
+_local = threading.local()
+
+
+def are_lazy_loads_enabled():
+    return getattr(settings, 'COVID_19_REPR_LAZY_LOADS', True) and not getattr(_local, 'is_disabled', False)
+
+
+@contextmanager
+def without_lazy_loads():
+    """Render the reprs inside the block without queries (logging), unloaded relations show their ids."""
+    was_disabled = getattr(_local, 'is_disabled', False)
+    _local.is_disabled = True
+    try:
+        yield
+    finally:
+        _local.is_disabled = was_disabled
+
+
+class NotLoaded(object):
+    """Stands for a related instance that isn't loaded in a repr."""
+
+    def __init__(self, model, pk):
+        self.model = model
+        self.pk = pk
+
+    def __repr__(self):
+        return '<{model} id {id}>'.format(model=self.model._meta.object_name, id=self.pk)
+
+
+def get_display_related(instance, field_name):
+    """The related instance of a foreign key for a repr, `NotLoaded` when it would have to be queried."""
+    field = instance._meta.get_field(field_name)
+    if are_lazy_loads_enabled() or hasattr(instance, field.get_cache_name()):
+        return getattr(instance, field_name)
+    return NotLoaded(field.related_model, getattr(instance, field.attname))
+
+
+class DisplayRelatedQuerySet(CachingQuerySet):
+    def with_display_related(self):
+        """Preload the relations the instances' repr goes through (the model's DISPLAY_RELATED)."""
+        display_related = getattr(self.model, 'DISPLAY_RELATED', ())
+        # select_related() without fields would follow every non null foreign key
+        return self.select_related(*display_related) if display_related else self._clone()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Constant memory export of the medical examination results.
+
+Rows are read as tuples (values_list, no model instances) in pages ordered by (time, id). Each page
+starts right after the last row of the previous one (keyset pagination), so every page is an index
+range scan no matter how deep into the table the export is.
+"""
+from __future__ import unicode_literals
+
+import csv
+import datetime
+import json
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_datetime
+
+from django_advanced_queries.covid_19.models import MedicalExaminationResult
+
+# (exported column, lookup)
+EXPORT_FIELDS = (
+    ('id', 'pk'),
+    ('time', 'time'),
+    ('result', 'result'),
+    ('patient_id', 'patient'),
+    ('patient_name', 'patient__person__name'),
+    ('patient_age', 'patient__person__age'),
+    ('patient_gender', 'patient__person__gender'),
+    ('department', 'patient__department__name'),
+    ('hospital', 'patient__department__hospital__name'),
+    ('hospital_city', 'patient__department__hospital__city'),
+    ('examined_by_id', 'examined_by'),
+    ('examined_by_name', 'examined_by__person__name'),
+    ('examined_by_position', 'examined_by__position'),
+)
+EXPORT_COLUMNS = tuple(column for column, _ in EXPORT_FIELDS)
+TIME_INDEX = EXPORT_COLUMNS.index('time')
+ID_INDEX = EXPORT_COLUMNS.index('id')
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_CSV = 'csv'
+CONTENT_TYPES = {
+    FORMAT_NDJSON: 'application/x-ndjson',
+    FORMAT_CSV: 'text/csv',
+}
+
+
+def parse_since(value):
+    """Parse an ISO datetime or date (midnight), raising ValueError on anything else."""
+    since = parse_datetime(value)
+    if since is None:
+        since_date = parse_date(value)
+        if since_date is None:
+            raise ValueError('"{value}" is not an ISO date or datetime'.format(value=value))
+        since = datetime.datetime.combine(since_date, datetime.time.min)
+    return since
+
+
+def iter_examination_rows(since=None, batch_size=5000, using=DEFAULT_DB_ALIAS):
+    """Yield the examinations as tuples of EXPORT_COLUMNS ordered by (time, id), one page per query."""
+    examinations = MedicalExaminationResult.objects.using(using).order_by('time', 'pk').values_list(
+        *[lookup for _, lookup in EXPORT_FIELDS]
+    )
+    if since is not None:
+        examinations = examinations.filter(time__gte=since)
+
+    page = examinations
+    while True:
+        rows = list(page[:batch_size])
+        for row in rows:
+            yield row
+
+        if len(rows) < batch_size:
+            return
+
+        last_time, last_id = rows[-1][TIME_INDEX], rows[-1][ID_INDEX]
+        # The time__gte bound keeps it a range scan on the time index
+        page = examinations.filter(time__gte=last_time).filter(Q(time__gt=last_time) | Q(pk__gt=last_id))
+
+
+class _Echo(object):
+    """File-like object handing back what csv.writer writes, to stream the lines."""
+
+    def write(self, value):
+        return value
+
+
+def iter_ndjson_lines(rows):
+    for row in rows:
+        record = dict(zip(EXPORT_COLUMNS, row))
+        record['time'] = record['time'].isoformat()
+        yield json.dumps(record, sort_keys=True) + '\n'
+
+
+def iter_csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_export_lines(export_format, since=None, batch_size=5000, using=DEFAULT_DB_ALIAS):
+    rows = iter_examination_rows(since=since, batch_size=batch_size, using=using)
+    if export_format == FORMAT_NDJSON:
+        return iter_ndjson_lines(rows)
+    if export_format == FORMAT_CSV:
+        return iter_csv_lines(rows)
+    raise ValueError('Unknown export format {export_format}'.format(export_format=export_format))
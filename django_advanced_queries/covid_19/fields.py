@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.utils import six
+
+
+class CodedChoiceField(models.PositiveSmallIntegerField):
+    """
+    A choice field stored as a small integer code.
+
+    The Python values stay the choices' strings: instances, lookups (`result='Corona'`,
+    `result__in=(...)`), values()/values_list() and forms all use the strings, only the column holds
+    `codes[value]`. A value that isn't a choice is looked up as `UNKNOWN_CODE`, no row has it: `filter()`
+    matches nothing and `exclude()` everything, as they did with the string. Saving it raises ValueError.
+
+    `order_by()` sorts by the codes, not alphabetically by the strings.
+    """
+
+    # Never stored, the codes are positive
+    UNKNOWN_CODE = -1
+
+    def __init__(self, *args, **kwargs):
+        self.codes = dict(kwargs.pop('codes', {}))
+        self.values_by_code = {code: value for value, code in self.codes.items()}
+        super(CodedChoiceField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(CodedChoiceField, self).deconstruct()
+        kwargs['codes'] = self.codes
+        return name, path, args, kwargs
+
+    @property
+    def validators(self):
+        # The integer range validators don't apply to the string values
+        return list(self.default_validators) + list(self._validators)
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+        return self.values_by_code[value]
+
+    def to_python(self, value):
+        if value is None or value in self.codes:
+            return value
+        if isinstance(value, six.integer_types) and value in self.values_by_code:
+            return self.values_by_code[value]
+        raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice', params={'value': value})
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return self.codes.get(value, self.UNKNOWN_CODE)
+
+    def get_db_prep_save(self, value, connection):
+        if value is not None and value not in self.codes:
+            raise ValueError('"{value}" is not a choice of {field}'.format(value=value, field=self.name))
+        return super(CodedChoiceField, self).get_db_prep_save(value, connection)
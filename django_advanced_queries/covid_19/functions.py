@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.models import FloatField, Func
+
+
+class EpochMicroseconds(Func):
+    """
+    A datetime as microseconds since the epoch, computed by the database.
+
+    For reading many datetimes, parsing them in Python costs more than the query. Only `vendors` are
+    supported. SQLite keeps julian days at millisecond precision, so are the values there.
+    """
+    output_field = FloatField()
+    vendors = ('sqlite', 'postgresql', )
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(
+            compiler,
+            connection,
+            template='(ROUND((julianday(%(expressions)s) - 2440587.5) * 86400000.0) * 1000)',
+        )
+
+    def as_postgresql(self, compiler, connection):
+        return self.as_sql(compiler, connection, template='(EXTRACT(EPOCH FROM %(expressions)s) * 1000000)')
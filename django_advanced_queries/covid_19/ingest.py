@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk ingest of lab examination results.
+
+Records are read as a stream and handled in batches. Every batch resolves its foreign keys through
+in-memory caches (hospitals, departments and workers are pre-warmed up front, persons and patients
+are looked up once per batch), creates the missing parents in bulk and inserts the examinations in
+one transaction. Invalid records are rejected one by one without failing their batch, before any of
+their parents is created.
+"""
+from __future__ import unicode_literals
+
+import csv
+import json
+import timeit
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.db.models.functions import TruncDate
+from django.utils.dateparse import parse_datetime
+
+from django_advanced_queries.covid_19.bulk import chunks, insert_rows
+from django_advanced_queries.covid_19.models import (
+    Hospital,
+    Department,
+    EpidemicCurveBucket,
+    HospitalDailyStats,
+    Person,
+    HospitalWorker,
+    Patient,
+    MedicalExaminationResult,
+    PersonHealthState,
+)
+
+REQUIRED_FIELDS = (
+    'person_name', 'person_age', 'person_gender', 'hospital', 'department',
+    'examined_by_name', 'examined_by_position', 'time', 'result',
+)
+# examined_by_age/gender are only needed to create a worker that doesn't exist yet,
+# examined_by_department defaults to the patient's department.
+OPTIONAL_FIELDS = ('hospital_city', 'examined_by_age', 'examined_by_gender', 'examined_by_department', )
+
+GENDERS = frozenset(gender for gender, _ in Person._meta.get_field('gender').choices)
+POSITIONS = frozenset(position for position, _ in HospitalWorker._meta.get_field('position').choices)
+RESULTS = frozenset(result for result, _ in MedicalExaminationResult._meta.get_field('result').choices)
+MAX_NAME_LENGTH = 255
+MAX_AGE = 32767
+
+EXAMINATION_FIELDS = ('time', 'examined_by', 'patient', 'result', )
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+
+
+class RejectedRecord(Exception):
+    pass
+
+
+class IngestReport(object):
+    def __init__(self):
+        self.num_of_records = 0
+        self.num_of_inserted = 0
+        self.rejected = []  # [(line number, reason), ...]
+        self.elapsed = 0.0
+
+    @property
+    def records_per_second(self):
+        return self.num_of_records / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {
+            'num_of_records': self.num_of_records,
+            'num_of_inserted': self.num_of_inserted,
+            'num_of_rejected': len(self.rejected),
+            'elapsed_seconds': self.elapsed,
+            'records_per_second': self.records_per_second,
+        }
+
+
+def iter_csv_records(lines):
+    """Yield (line number, record) for a CSV with a header line."""
+    for line_number, record in enumerate(csv.DictReader(lines), start=2):
+        yield line_number, record
+
+
+def iter_ndjson_records(lines):
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record
+
+
+def _get_name(record, field):
+    value = record.get(field)
+    value = value.strip() if value is not None else ''
+    if not value or len(value) > MAX_NAME_LENGTH:
+        raise RejectedRecord('Invalid {field} "{value}"'.format(field=field, value=value))
+    return value
+
+
+def _get_choice(record, field, choices):
+    value = record.get(field)
+    if value not in choices:
+        raise RejectedRecord('Invalid {field} "{value}"'.format(field=field, value=value))
+    return value
+
+
+def _get_age(record, field):
+    try:
+        age = int(record.get(field))
+    except (TypeError, ValueError):
+        raise RejectedRecord('Invalid {field} "{value}"'.format(field=field, value=record.get(field)))
+    if not 0 <= age <= MAX_AGE:
+        raise RejectedRecord('Invalid {field} "{value}"'.format(field=field, value=age))
+    return age
+
+
+def clean_record(record):
+    """Validate a raw record (CSV/NDJSON dict) and return the typed values."""
+    if not isinstance(record, dict):
+        raise RejectedRecord('Not a record')
+
+    time = record.get('time')
+    try:
+        time = parse_datetime(time) if not hasattr(time, 'date') else time
+    except (TypeError, ValueError):
+        time = None
+    if time is None:
+        raise RejectedRecord('Invalid time "{value}"'.format(value=record.get('time')))
+
+    department = _get_name(record, 'department')
+    cleaned = {
+        'person_name': _get_name(record, 'person_name'),
+        'person_age': _get_age(record, 'person_age'),
+        'person_gender': _get_choice(record, 'person_gender', GENDERS),
+        'hospital': _get_name(record, 'hospital'),
+        'hospital_city': (record.get('hospital_city') or '').strip(),
+        'department': department,
+        'examined_by_name': _get_name(record, 'examined_by_name'),
+        'examined_by_position': _get_choice(record, 'examined_by_position', POSITIONS),
+        'examined_by_department': (record.get('examined_by_department') or '').strip() or department,
+        'examined_by_age': None,
+        'examined_by_gender': record.get('examined_by_gender') or Person.GENDER_UNDEFINED,
+        'time': time,
+        'result': _get_choice(record, 'result', RESULTS),
+    }
+    if record.get('examined_by_age') not in (None, ''):
+        cleaned['examined_by_age'] = _get_age(record, 'examined_by_age')
+    if cleaned['examined_by_gender'] not in GENDERS:
+        raise RejectedRecord('Invalid examined_by_gender "{value}"'.format(value=cleaned['examined_by_gender']))
+    return cleaned
+
+
+class ExaminationsImporter(object):
+    """
+    Ingest examination records in batches.
+
+    >>> report = ExaminationsImporter(batch_size=10000).ingest(iter_csv_records(csv_file))
+    """
+
+    def __init__(self, batch_size=10000, using=DEFAULT_DB_ALIAS, log=None):
+        self.batch_size = batch_size
+        self.using = using
+        self.log = log or (lambda message: None)
+        self.hospital_ids = {}  # name -> id
+        self.department_ids = {}  # (hospital id, name) -> id
+        self.worker_ids = {}  # (department id, person name, position) -> id
+        self.person_ids = {}  # (name, age, gender) -> id
+        self.patient_ids = {}  # (person id, department id) -> id
+
+    def warm_up(self):
+        """Load the small parent tables in bulk, persons and patients are looked up per batch."""
+        self.hospital_ids = dict(Hospital.objects.using(self.using).values_list('name', 'pk'))
+        self.department_ids = {
+            (hospital_id, name): department_id
+            for department_id, hospital_id, name in Department.objects.using(self.using).values_list(
+                'pk', 'hospital', 'name',
+            )
+        }
+        self.worker_ids = {
+            (department_id, person_name, position): worker_id
+            for worker_id, department_id, person_name, position in HospitalWorker.objects.using(
+                self.using,
+            ).values_list('pk', 'department', 'person__name', 'position')
+        }
+
+    def ingest(self, records):
+        """Ingest (line number, record) pairs and return an IngestReport."""
+        report = IngestReport()
+        start_time = timeit.default_timer()
+        self.warm_up()
+
+        batch = []
+        for line_number, record in records:
+            report.num_of_records += 1
+            try:
+                batch.append((line_number, clean_record(record)))
+            except RejectedRecord as e:
+                report.rejected.append((line_number, str(e)))
+
+            if len(batch) >= self.batch_size:
+                self.ingest_batch(batch, report)
+                batch = []
+                report.elapsed = timeit.default_timer() - start_time
+                self.log('{num} records, {rate:.0f} records/s'.format(
+                    num=report.num_of_records,
+                    rate=report.records_per_second,
+                ))
+
+        self.ingest_batch(batch, report)
+        report.elapsed = timeit.default_timer() - start_time
+        return report
+
+    def ingest_batch(self, batch, report):
+        batch = self.reject_unknown_workers(batch, report)
+        if not batch:
+            return
+
+        with transaction.atomic(using=self.using):
+            self.resolve_hospitals(batch)
+            self.resolve_departments(batch)
+            self.resolve_persons(batch)
+            self.resolve_workers(batch)
+            self.resolve_patients(batch)
+            examinations = [(line_number, self.get_examination_row(record)) for line_number, record in batch]
+            inserted_examinations = self.insert_examinations(examinations, report)
+            self.refresh_derived_data(inserted_examinations)
+
+        report.num_of_inserted += len(inserted_examinations)
+
+    def _is_known_worker(self, record):
+        hospital_id = self.hospital_ids.get(record['hospital'])
+        department_id = self.department_ids.get((hospital_id, record['examined_by_department']))
+        return (department_id, record['examined_by_name'], record['examined_by_position']) in self.worker_ids
+
+    def reject_unknown_workers(self, batch, report):
+        """
+        The records whose worker exists or can be created (examined_by_age is given in one of the batch's
+        records), the others are rejected before any parent is created for them.
+        """
+        created_workers = {
+            (record['hospital'], record['examined_by_department'], record['examined_by_name'],
+             record['examined_by_position'])
+            for _, record in batch if record['examined_by_age'] is not None
+        }
+        valid_batch = []
+        for line_number, record in batch:
+            if (record['hospital'], record['examined_by_department'], record['examined_by_name'],
+                    record['examined_by_position']) in created_workers or self._is_known_worker(record):
+                valid_batch.append((line_number, record))
+            else:
+                report.rejected.append((line_number, 'Unknown hospital worker "{name}", examined_by_age is '
+                                                     'required to create it'.format(name=record['examined_by_name'])))
+        return valid_batch
+
+    def resolve_hospitals(self, batch):
+        missing_names = {record['hospital']: record['hospital_city']
+                         for _, record in batch if record['hospital'] not in self.hospital_ids}
+        if missing_names:
+            Hospital.objects.using(self.using).bulk_create(
+                Hospital(name=name, city=city) for name, city in missing_names.items()
+            )
+            for names in chunks(missing_names):
+                self.hospital_ids.update(
+                    Hospital.objects.using(self.using).filter(name__in=names).values_list('name', 'pk')
+                )
+
+        for _, record in batch:
+            record['hospital_id'] = self.hospital_ids[record['hospital']]
+
+    def resolve_departments(self, batch):
+        keys = set()
+        for _, record in batch:
+            keys.add((record['hospital_id'], record['department']))
+            keys.add((record['hospital_id'], record['examined_by_department']))
+
+        missing_keys = keys - set(self.department_ids)
+        if missing_keys:
+            Department.objects.using(self.using).bulk_create(
+                Department(hospital_id=hospital_id, name=name) for hospital_id, name in missing_keys
+            )
+            for hospital_ids in chunks({hospital_id for hospital_id, _ in missing_keys}):
+                self.department_ids.update(
+                    ((hospital_id, name), department_id)
+                    for department_id, hospital_id, name in Department.objects.using(self.using).filter(
+                        hospital__in=hospital_ids,
+                    ).values_list('pk', 'hospital', 'name')
+                )
+
+        for _, record in batch:
+            record['department_id'] = self.department_ids[(record['hospital_id'], record['department'])]
+            record['examined_by_department_id'] = self.department_ids[
+                (record['hospital_id'], record['examined_by_department'])
+            ]
+
+    def _load_person_ids(self, names):
+        for names_chunk in chunks(names):
+            # Several persons may share the same details, the first one wins
+            for person_id, name, age, gender in Person.objects.using(self.using).filter(
+                name__in=names_chunk,
+            ).order_by('-pk').values_list('pk', 'name', 'age', 'gender'):
+                self.person_ids[(name, age, gender)] = person_id
+
+    def resolve_persons(self, batch):
+        keys = {(record['person_name'], record['person_age'], record['person_gender']) for _, record in batch}
+        # Persons of workers that will have to be created
+        for _, record in batch:
+            if (record['examined_by_department_id'], record['examined_by_name'],
+                    record['examined_by_position']) not in self.worker_ids and record['examined_by_age'] is not None:
+                keys.add((record['examined_by_name'], record['examined_by_age'], record['examined_by_gender']))
+
+        missing_keys = keys - set(self.person_ids)
+        if missing_keys:
+            self._load_person_ids({name for name, _, _ in missing_keys})
+            missing_keys -= set(self.person_ids)
+        if missing_keys:
+            Person.objects.using(self.using).bulk_create(
+                Person(name=name, age=age, gender=gender) for name, age, gender in missing_keys
+            )
+            self._load_person_ids({name for name, _, _ in missing_keys})
+
+        for _, record in batch:
+            record['person_id'] = self.person_ids[
+                (record['person_name'], record['person_age'], record['person_gender'])
+            ]
+
+    def resolve_workers(self, batch):
+        missing_workers = {}
+        for _, record in batch:
+            key = (record['examined_by_department_id'], record['examined_by_name'], record['examined_by_position'])
+            # A record without examined_by_age shares its worker with one that has it (reject_unknown_workers)
+            if key in self.worker_ids or record['examined_by_age'] is None:
+                continue
+            missing_workers[key] = self.person_ids[
+                (record['examined_by_name'], record['examined_by_age'], record['examined_by_gender'])
+            ]
+
+        if missing_workers:
+            HospitalWorker.objects.using(self.using).bulk_create(
+                HospitalWorker(person_id=person_id, department_id=department_id, position=position)
+                for (department_id, _, position), person_id in missing_workers.items()
+            )
+            # bulk_create skips the signals maintaining the persons' jobs
+            for person_ids in chunks(set(missing_workers.values())):
+                Person.objects.using(self.using).filter(pk__in=person_ids).refresh_jobs()
+            for department_ids in chunks({department_id for department_id, _, _ in missing_workers}):
+                self.worker_ids.update(
+                    ((department_id, person_name, position), worker_id)
+                    for worker_id, department_id, person_name, position in HospitalWorker.objects.using(
+                        self.using,
+                    ).filter(department__in=department_ids).values_list('pk', 'department', 'person__name', 'position')
+                )
+
+        for _, record in batch:
+            record['examined_by_id'] = self.worker_ids[
+                (record['examined_by_department_id'], record['examined_by_name'], record['examined_by_position'])
+            ]
+
+    def _load_patient_ids(self, person_ids):
+        for person_ids_chunk in chunks(person_ids):
+            for patient_id, person_id, department_id in Patient.objects.using(self.using).filter(
+                person__in=person_ids_chunk,
+            ).order_by('-pk').values_list('pk', 'person', 'department'):
+                self.patient_ids[(person_id, department_id)] = patient_id
+
+    def resolve_patients(self, batch):
+        keys = {(record['person_id'], record['department_id']) for _, record in batch}
+
+        missing_keys = keys - set(self.patient_ids)
+        if missing_keys:
+            self._load_patient_ids({person_id for person_id, _ in missing_keys})
+            missing_keys -= set(self.patient_ids)
+        if missing_keys:
+            Patient.objects.using(self.using).bulk_create(
+                Patient(person_id=person_id, department_id=department_id) for person_id, department_id in missing_keys
+            )
+            self._load_patient_ids({person_id for person_id, _ in missing_keys})
+
+        for _, record in batch:
+            record['patient_id'] = self.patient_ids[(record['person_id'], record['department_id'])]
+
+    def get_examination_row(self, record):
+        return (
+            connections[self.using].ops.adapt_datetimefield_value(record['time']),
+            record['examined_by_id'],
+            record['patient_id'],
+            MedicalExaminationResult.RESULT_CODES[record['result']],
+        )
+
+    def insert_examinations(self, examinations, report):
+        """Insert the batch at once, falling back to row by row (isolating the bad rows) if it fails."""
+        try:
+            with transaction.atomic(using=self.using):
+                insert_rows(MedicalExaminationResult, EXAMINATION_FIELDS, [row for _, row in examinations],
+                            using=self.using)
+            return [row for _, row in examinations]
+        except DatabaseError:
+            pass
+
+        inserted_examinations = []
+        for line_number, row in examinations:
+            try:
+                with transaction.atomic(using=self.using):
+                    insert_rows(MedicalExaminationResult, EXAMINATION_FIELDS, [row], using=self.using)
+                inserted_examinations.append(row)
+            except DatabaseError as e:
+                report.rejected.append((line_number, str(e)))
+        return inserted_examinations
+
+    def refresh_derived_data(self, examinations):
+        """The examinations bypassed the signals, update the latest examination pointers, the rollups and states."""
+        patient_ids = {patient_id for _, _, patient_id, _ in examinations}
+        for patient_ids_chunk in chunks(patient_ids):
+            patients = Patient.objects.using(self.using).filter(pk__in=patient_ids_chunk)
+            patients.refresh_last_medical_examination_result()
+            PersonHealthState.objects.using(self.using).refresh(patients.values_list('person', flat=True))
+
+        if not examinations:
+            return
+
+        # Every day from the earliest ingested examination on may have changed (out of order examinations
+        # change the "previous result" of the later ones)
+        min_time = min(time for time, _, _, _ in examinations)
+        keys = set()
+        for patient_ids_chunk in chunks(patient_ids):
+            patients_examinations = MedicalExaminationResult.objects.using(self.using).filter(
+                patient__in=patient_ids_chunk,
+                time__gte=min_time,
+            ).annotate(date=TruncDate('time'))
+            keys.update(patients_examinations.values_list('patient__department__hospital', 'date').distinct())
+            keys.update(patients_examinations.values_list('examined_by__department__hospital', 'date').distinct())
+        HospitalDailyStats.objects.using(self.using).refresh(keys)
+        EpidemicCurveBucket.objects.using(self.using).invalidate({date for _, date in keys})
+
+
+def iter_records(lines, records_format):
+    if records_format == FORMAT_CSV:
+        return iter_csv_records(lines)
+    if records_format == FORMAT_NDJSON:
+        return iter_ndjson_records(lines)
+    raise ValueError('Unknown records format {records_format}'.format(records_format=records_format))
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Per manager method query instrumentation.
+
+Custom QuerySet methods decorated with `instrumented` are measured - number of queries, SQL time and
+rows fetched - and the measurement is handed to a sink (by default the in-process histogram registry
+below). Querysets returned by an instrumented method keep its name, so the queries issued when the
+caller evaluates them later are attributed to the method too.
+
+Cursors are only wrapped while a measurement is active, so everything else runs untouched.
+"""
+from __future__ import unicode_literals
+
+import bisect
+import functools
+import json
+import logging
+import threading
+import timeit
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import models
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 25, 50, 100, )
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000, )
+TIME_MS_BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, )
+
+_local = threading.local()
+
+
+class Measurement(object):
+    def __init__(self):
+        self.num_of_queries = 0
+        self.sql_time = 0.0
+        self.num_of_rows = 0
+        self.duration = 0.0
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        bucket_names = ['le_{bucket}'.format(bucket=bucket) for bucket in self.buckets] + ['inf']
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(bucket_names, self.counts)),
+        }
+
+
+class HistogramRegistry(object):
+    """Thread safe in-process sink keeping a histogram per (manager method, metric)."""
+
+    METRICS = (
+        ('num_of_queries', COUNT_BUCKETS),
+        ('sql_time_ms', TIME_MS_BUCKETS),
+        ('num_of_rows', ROWS_BUCKETS),
+        ('duration_ms', TIME_MS_BUCKETS),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def record(self, name, measurement):
+        values = {
+            'num_of_queries': measurement.num_of_queries,
+            'sql_time_ms': measurement.sql_time * 1000,
+            'num_of_rows': measurement.num_of_rows,
+            'duration_ms': measurement.duration * 1000,
+        }
+        with self._lock:
+            histograms = self._histograms.get(name)
+            if histograms is None:
+                histograms = self._histograms[name] = {
+                    metric: Histogram(buckets) for metric, buckets in self.METRICS
+                }
+            for metric, value in values.items():
+                histograms[metric].observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {metric: histogram.to_dict() for metric, histogram in histograms.items()}
+                for name, histograms in self._histograms.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def dump_to_log(self, log=logger, level=logging.INFO):
+        log.log(level, 'covid_19 query instrumentation: %s', json.dumps(self.snapshot(), sort_keys=True))
+
+    def dump_to_file(self, path):
+        with open(path, 'w') as dump_file:
+            json.dump(self.snapshot(), dump_file, indent=2, sort_keys=True)
+
+
+registry = HistogramRegistry()
+
+
+def is_enabled():
+    return getattr(settings, 'COVID_19_QUERY_INSTRUMENTATION', True)
+
+
+def get_sink():
+    sink_path = getattr(settings, 'COVID_19_QUERY_INSTRUMENTATION_SINK', None)
+    return import_string(sink_path) if sink_path else registry
+
+
+def get_current_measurement():
+    return getattr(_local, 'measurement', None)
+
+
+@contextmanager
+def measure(name):
+    """
+    Measure the queries issued inside the block. Nested blocks are attributed to the outermost one.
+
+    Blocks that didn't hit the database (building a lazy queryset, reading a cached result) aren't recorded.
+    """
+    if get_current_measurement() is not None or not is_enabled():
+        yield None
+        return
+
+    measurement = _local.measurement = Measurement()
+    start_time = timeit.default_timer()
+    try:
+        yield measurement
+    finally:
+        measurement.duration = timeit.default_timer() - start_time
+        _local.measurement = None
+        if measurement.num_of_queries:
+            get_sink().record(name, measurement)
+
+
+class InstrumentedCursorWrapper(object):
+    def __init__(self, cursor, measurement):
+        self.cursor = cursor
+        self.measurement = measurement
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.measurement.num_of_rows += 1
+            yield row
+
+    def _timed(self, method, *args):
+        start_time = timeit.default_timer()
+        try:
+            return method(*args)
+        finally:
+            self.measurement.num_of_queries += 1
+            self.measurement.sql_time += timeit.default_timer() - start_time
+
+    def execute(self, sql, params=None):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.measurement.num_of_rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.measurement.num_of_rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.measurement.num_of_rows += len(rows)
+        return rows
+
+
+def _instrument_cursor_factory(make_cursor):
+    @functools.wraps(make_cursor)
+    def wrapper(cursor):
+        cursor = make_cursor(cursor)
+        measurement = get_current_measurement()
+        if measurement is None:
+            return cursor
+        return InstrumentedCursorWrapper(cursor, measurement)
+    return wrapper
+
+
+def install_cursor_instrumentation(sender, connection, **kwargs):
+    """`connection_created` receiver wrapping the cursors of the connection."""
+    if getattr(connection, '_covid_19_instrumented', False):
+        return
+
+    connection.make_cursor = _instrument_cursor_factory(connection.make_cursor)
+    connection.make_debug_cursor = _instrument_cursor_factory(connection.make_debug_cursor)
+    connection._covid_19_instrumented = True
+
+
+def _measured_evaluation(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._instrumentation_name is None:
+            return method(self, *args, **kwargs)
+        with measure(self._instrumentation_name):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class InstrumentedQuerySet(models.QuerySet):
+    """QuerySet remembering which instrumented method built it, measuring its evaluation under that name."""
+
+    _instrumentation_name = None
+
+    def _clone(self, **kwargs):
+        kwargs.setdefault('_instrumentation_name', self._instrumentation_name)
+        return super(InstrumentedQuerySet, self)._clone(**kwargs)
+
+    def _fetch_all(self):
+        # Called on every iteration/len(), only the first (uncached) one hits the database
+        if self._result_cache is None and self._instrumentation_name is not None:
+            with measure(self._instrumentation_name):
+                return super(InstrumentedQuerySet, self)._fetch_all()
+        return super(InstrumentedQuerySet, self)._fetch_all()
+
+    count = _measured_evaluation(models.QuerySet.count)
+    exists = _measured_evaluation(models.QuerySet.exists)
+    aggregate = _measured_evaluation(models.QuerySet.aggregate)
+    update = _measured_evaluation(models.QuerySet.update)
+
+
+def instrumented(method):
+    """Decorate a custom QuerySet method so its queries are measured under `<Model>.<method>`."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        name = '{model}.{method}'.format(model=self.model.__name__, method=method.__name__)
+        with measure(name):
+            result = method(self, *args, **kwargs)
+
+        if isinstance(result, InstrumentedQuerySet):
+            result = result._clone(_instrumentation_name=name)
+        return result
+    return wrapper
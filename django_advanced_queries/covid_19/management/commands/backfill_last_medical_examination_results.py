@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from django_advanced_queries.covid_19.models import Patient
+
+
+class Command(BaseCommand):
+    help = 'Recompute Patient.last_medical_examination_result from the medical examination history'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='Number of patient ids updated per transaction',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        max_patient_id = Patient.objects.aggregate(max_id=Max('pk'))['max_id'] or 0
+
+        num_of_updated_patients = 0
+        for start_id in range(0, max_patient_id, batch_size):
+            with transaction.atomic():
+                num_of_updated_patients += Patient.objects.filter(
+                    pk__gt=start_id,
+                    pk__lte=start_id + batch_size,
+                ).refresh_last_medical_examination_result()
+
+        self.stdout.write('Updated {num} patients'.format(num=num_of_updated_patients))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from django_advanced_queries.covid_19.models import Person
+
+
+class Command(BaseCommand):
+    help = 'Recompute Person.num_of_jobs and Person.positions_mask from the hospital jobs, or check them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='Number of person ids updated (or checked) per transaction',
+        )
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report the persons whose maintained jobs are inconsistent, fails if there are any',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        max_person_id = Person.objects.aggregate(max_id=Max('pk'))['max_id'] or 0
+
+        num_of_persons = 0
+        for start_id in range(0, max_person_id, batch_size):
+            persons = Person.objects.filter(pk__gt=start_id, pk__lte=start_id + batch_size)
+            if options['check']:
+                for person in persons.get_persons_with_inconsistent_jobs():
+                    self.stderr.write('{person}: {num_of_jobs} jobs, positions mask {positions_mask}, expected '
+                                      '{actual_num_of_jobs} jobs, positions mask {actual_positions_mask}'.format(
+                                          person=repr(person),
+                                          num_of_jobs=person.num_of_jobs,
+                                          positions_mask=person.positions_mask,
+                                          actual_num_of_jobs=person.actual_num_of_jobs,
+                                          actual_positions_mask=person.actual_positions_mask,
+                                      ))
+                    num_of_persons += 1
+            else:
+                with transaction.atomic():
+                    num_of_persons += persons.refresh_jobs()
+
+        if options['check']:
+            if num_of_persons:
+                raise CommandError('{num} persons with inconsistent jobs'.format(num=num_of_persons))
+            self.stdout.write('All persons jobs are consistent')
+        else:
+            self.stdout.write('Updated {num} persons'.format(num=num_of_persons))
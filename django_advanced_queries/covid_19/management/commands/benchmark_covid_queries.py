@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_advanced_queries.covid_19.benchmarks import compare_to_baseline, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Time every covid_19 manager method on seeded databases of several sizes and report JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales',
+            default='10000,1000000,10000000',
+            help='Comma separated numbers of medical examinations to seed a database with',
+        )
+        parser.add_argument('--repeat', type=int, default=10, help='Runs per manager method')
+        parser.add_argument(
+            '--database-dir',
+            default=os.path.join(settings.BASE_DIR, 'benchmark_databases'),
+            help='Where the seeded databases are kept between runs',
+        )
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--baseline', help='JSON report to compare against, fails on regressions')
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=1.2,
+            help='Allowed median latency growth compared to the baseline (1.2 - 20%% slower)',
+        )
+
+    def handle(self, *args, **options):
+        scales = [int(scale) for scale in options['scales'].split(',')]
+        report = run_benchmarks(
+            scales,
+            options['database_dir'],
+            options['repeat'],
+            seed=options['seed'],
+            log=self.stderr.write,
+        )
+
+        report_json = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(report_json)
+        else:
+            self.stdout.write(report_json)
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                regressions = compare_to_baseline(report, json.load(baseline_file), options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions compared to the baseline:\n' + '\n'.join(regressions))
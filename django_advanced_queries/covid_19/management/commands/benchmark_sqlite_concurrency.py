@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from django_advanced_queries.covid_19.benchmarks import SQLITE_PROFILES, run_concurrency_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Compare the SQLite profiles with reporting readers and ingesting writers on threads, report JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scale',
+            type=int,
+            default=1000000,
+            help='Number of medical examinations to seed the database with',
+        )
+        parser.add_argument('--readers', type=int, default=8, help='Number of reader threads')
+        parser.add_argument('--writers', type=int, default=2, help='Number of writer threads')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds every profile runs')
+        parser.add_argument(
+            '--profiles',
+            default=','.join(profile for profile, _ in SQLITE_PROFILES),
+            help='Comma separated SQLite profiles to compare',
+        )
+        parser.add_argument(
+            '--database-dir',
+            default=os.path.join(settings.BASE_DIR, 'benchmark_databases'),
+            help='Where the seeded databases are kept between runs',
+        )
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        report = run_concurrency_benchmarks(
+            options['scale'],
+            options['database_dir'],
+            options['readers'],
+            options['writers'],
+            options['duration'],
+            profiles=options['profiles'].split(','),
+            seed=options['seed'],
+            log=self.stderr.write,
+        )
+
+        report_json = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(report_json)
+        else:
+            self.stdout.write(report_json)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from django_advanced_queries.covid_19.exports import CONTENT_TYPES, FORMAT_NDJSON, iter_export_lines, parse_since
+
+
+class Command(BaseCommand):
+    help = 'Stream all medical examination results with their patient, department, hospital and examiner'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', default=FORMAT_NDJSON, choices=sorted(CONTENT_TYPES))
+        parser.add_argument('--since', help='Only examinations from this ISO date/datetime on (incremental export)')
+        parser.add_argument('--output', help='File to write to instead of stdout')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows fetched per query')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = parse_since(options['since'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        lines = iter_export_lines(
+            options['format'],
+            since=since,
+            batch_size=options['batch_size'],
+            using=options['database'],
+        )
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from django_advanced_queries.covid_19.data_generation import CovidDataGenerator
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic covid_19 dataset (hospitals, workers, patients and medical examinations)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hospitals', type=int, default=10, help='Number of hospitals')
+        parser.add_argument('--persons', type=int, default=10000, help='Number of persons')
+        parser.add_argument(
+            '--exams-per-patient',
+            type=int,
+            default=3,
+            help='Mean number of medical examinations per patient (the actual distribution is skewed)',
+        )
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for reproducible datasets')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows inserted per transaction')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to fill')
+
+    def handle(self, *args, **options):
+        generator = CovidDataGenerator(
+            seed=options['seed'],
+            batch_size=options['batch_size'],
+            log=self.stdout.write,
+            using=options['database'],
+        )
+
+        start_time = time.time()
+        try:
+            num_of_examinations = generator.generate(
+                num_of_hospitals=options['hospitals'],
+                num_of_persons=options['persons'],
+                exams_per_patient=options['exams_per_patient'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        elapsed = time.time() - start_time
+        self.stdout.write('Done in {elapsed:.1f}s ({rate:.0f} examinations/s)'.format(
+            elapsed=elapsed,
+            rate=num_of_examinations / elapsed if elapsed else 0,
+        ))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from django_advanced_queries.covid_19.ingest import FORMAT_CSV, FORMAT_NDJSON, ExaminationsImporter, iter_records
+
+
+class Command(BaseCommand):
+    help = 'Ingest lab medical examination results (CSV with a header line or NDJSON), creating missing parents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to ingest, "-" for stdin')
+        parser.add_argument(
+            '--format',
+            choices=(FORMAT_CSV, FORMAT_NDJSON),
+            help='Defaults to csv for .csv files and ndjson otherwise',
+        )
+        parser.add_argument('--batch-size', type=int, default=10000, help='Records per transaction')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        records_format = options['format'] or (FORMAT_CSV if path.endswith('.csv') else FORMAT_NDJSON)
+        importer = ExaminationsImporter(
+            batch_size=options['batch_size'],
+            using=options['database'],
+            log=self.stderr.write,
+        )
+
+        if path == '-':
+            report = importer.ingest(iter_records(sys.stdin, records_format))
+        else:
+            with io.open(path, encoding='utf-8', newline='') as lines:
+                report = importer.ingest(iter_records(lines, records_format))
+
+        for line_number, reason in report.rejected:
+            self.stderr.write('Rejected line {line_number}: {reason}'.format(line_number=line_number, reason=reason))
+        self.stdout.write(json.dumps(report.to_dict(), indent=2, sort_keys=True))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Analyze (0x02) every table whose statistics are missing or stale, not only the ones this connection
+# queried (0x10000, SQLite 3.46+ - older versions ignore the bit)
+SQLITE_OPTIMIZE_MASK = 0x10002
+
+
+class Command(BaseCommand):
+    help = 'Refresh the query planner statistics (PRAGMA optimize / ANALYZE), meant to run periodically'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument(
+            '--analyze',
+            action='store_true',
+            help='ANALYZE every table and index instead of only the stale ones (SQLite)',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            action='store_true',
+            help='Also checkpoint the WAL into the database file and truncate it (SQLite)',
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        with connection.cursor() as cursor:
+            if connection.vendor != 'sqlite' or options['analyze']:
+                cursor.execute('ANALYZE')
+                self.stdout.write('Analyzed {database}'.format(database=options['database']))
+            else:
+                cursor.execute('PRAGMA optimize = {mask}'.format(mask=SQLITE_OPTIMIZE_MASK))
+                self.stdout.write('Optimized {database}'.format(database=options['database']))
+
+            if connection.vendor == 'sqlite' and options['checkpoint']:
+                cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                is_busy, num_of_wal_pages, num_of_checkpointed_pages = cursor.fetchone()
+                self.stdout.write('Checkpointed {checkpointed} of {pages} WAL pages{busy}'.format(
+                    checkpointed=num_of_checkpointed_pages,
+                    pages=num_of_wal_pages,
+                    busy=' (busy, readers kept part of the WAL)' if is_busy else '',
+                ))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from django_advanced_queries.covid_19.models import HospitalWorker, Person, Patient, PersonHealthState
+
+
+class Command(BaseCommand):
+    help = 'Recompute the persons health states from the medical examinations history, or check them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='Number of person ids checked per query',
+        )
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report the persons whose health state doesn\'t match their history, fails if there are any',
+        )
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            PersonHealthState.objects.rebuild()
+            self.stdout.write('Rebuilt {num} health states'.format(num=PersonHealthState.objects.count()))
+            return
+
+        batch_size = options['batch_size']
+        max_person_id = Person.objects.aggregate(max_id=Max('pk'))['max_id'] or 0
+
+        num_of_persons = 0
+        for start_id in range(0, max_person_id, batch_size):
+            persons = Person.objects.filter(pk__gt=start_id, pk__lte=start_id + batch_size)
+            for person, recorded, expected in persons.get_persons_with_inconsistent_health_state():
+                self.stderr.write('{person}: {recorded}, expected {expected}'.format(
+                    person=repr(person),
+                    recorded=recorded,
+                    expected=expected,
+                ))
+                num_of_persons += 1
+
+        # The history based queries follow every department's latest examination on its own, a person examined
+        # in several departments may count differently there
+        for name, num_of_recorded, num_of_history in (
+            (
+                'Sick persons',
+                Person.objects.get_sick_persons(from_health_state=True).count(),
+                Person.objects.get_sick_persons().count(),
+            ),
+            (
+                'Sick workers',
+                HospitalWorker.objects.get_sick_workers(from_health_state=True).count(),
+                HospitalWorker.objects.get_sick_workers().count(),
+            ),
+            (
+                'Patients dead from corona',
+                Patient.objects.filter(person__health_state__state=PersonHealthState.STATE_DEAD_FROM_CORONA).count(),
+                Patient.objects.filter_dead_from_corona().count(),
+            ),
+        ):
+            self.stdout.write('{name}: {recorded} (history based queries: {history})'.format(
+                name=name,
+                recorded=num_of_recorded,
+                history=num_of_history,
+            ))
+
+        if num_of_persons:
+            raise CommandError('{num} persons with inconsistent health states'.format(num=num_of_persons))
+        self.stdout.write('All persons health states are consistent')
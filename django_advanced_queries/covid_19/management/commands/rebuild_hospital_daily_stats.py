@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from django_advanced_queries.covid_19.models import HospitalDailyStats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the HospitalDailyStats rollup from the medical examinations history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to rebuild the rollup in')
+
+    def handle(self, *args, **options):
+        HospitalDailyStats.objects.using(options['database']).rebuild()
+        self.stdout.write('Rebuilt {num} hospital daily stats'.format(
+            num=HospitalDailyStats.objects.using(options['database']).count(),
+        ))
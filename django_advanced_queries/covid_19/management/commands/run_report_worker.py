@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from django_advanced_queries.covid_19.reports import (
+    DEFAULT_LEASE,
+    DEFAULT_POLL_INTERVAL,
+    DEFAULT_RETRY_DELAY,
+    ReportWorker,
+)
+
+
+class Command(BaseCommand):
+    help = 'Run the submitted covid_19 report jobs (see reports.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=1, help='Number of jobs run in parallel')
+        parser.add_argument('--name', help='Worker name stored on the claimed jobs, defaults to <host>:<pid>')
+        parser.add_argument(
+            '--burst',
+            action='store_true',
+            help='Exit once there are no jobs to run instead of polling for new ones',
+        )
+        parser.add_argument('--max-jobs', type=int, help='Exit after running this number of jobs')
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=DEFAULT_POLL_INTERVAL,
+            help='Seconds between polls of an empty queue',
+        )
+        parser.add_argument(
+            '--lease',
+            type=int,
+            default=DEFAULT_LEASE,
+            help='Seconds a claimed job is held before it\'s requeued, must exceed the longest report',
+        )
+        parser.add_argument(
+            '--retry-delay',
+            type=int,
+            default=DEFAULT_RETRY_DELAY,
+            help='Seconds before the first retry of a failed job, doubled by every attempt',
+        )
+
+    def handle(self, *args, **options):
+        worker = ReportWorker(
+            name=options['name'],
+            num_of_threads=options['threads'],
+            lease=options['lease'],
+            retry_delay=options['retry_delay'],
+            poll_interval=options['poll_interval'],
+        )
+        try:
+            worker.run(burst=options['burst'], max_jobs=options['max_jobs'])
+        except KeyboardInterrupt:
+            worker.stop()
+
+        self.stdout.write('{name}: {succeeded} jobs succeeded, {failed} failed'.format(
+            name=worker.name,
+            succeeded=worker.num_of_succeeded,
+            failed=worker.num_of_failed,
+        ))
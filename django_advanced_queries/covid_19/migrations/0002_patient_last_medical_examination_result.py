@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 16:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def backfill_last_medical_examination_result(apps, schema_editor):
+    Patient = apps.get_model('covid_19', 'Patient')
+    MedicalExaminationResult = apps.get_model('covid_19', 'MedicalExaminationResult')
+    db_alias = schema_editor.connection.alias
+
+    latest_medical_examination_result = MedicalExaminationResult.objects.filter(
+        patient=OuterRef('pk'),
+    ).order_by('-time', '-pk').values('pk')[:1]
+    Patient.objects.using(db_alias).update(last_medical_examination_result=Subquery(latest_medical_examination_result))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('covid_19', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='last_medical_examination_result',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='covid_19.MedicalExaminationResult'),
+        ),
+        migrations.RunPython(backfill_last_medical_examination_result, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 16:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('covid_19', '0002_patient_last_medical_examination_result'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='medicalexaminationresult',
+            name='examined_by',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='medical_examination_results', to='covid_19.HospitalWorker'),
+        ),
+        migrations.AlterField(
+            model_name='medicalexaminationresult',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='medical_examination_results', to='covid_19.Patient'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalexaminationresult',
+            index=models.Index(fields=['patient', 'time'], name='covid_mer_patient_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalexaminationresult',
+            index=models.Index(fields=['examined_by', 'time'], name='covid_mer_examiner_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalexaminationresult',
+            index=models.Index(fields=['result', 'patient'], name='covid_mer_result_patient_idx'),
+        ),
+    ]
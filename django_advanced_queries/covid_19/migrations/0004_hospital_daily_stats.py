@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 16:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from django_advanced_queries.covid_19.models import compute_hospital_daily_stats
+
+
+def backfill_hospital_daily_stats(apps, schema_editor):
+    # The compute of HospitalDailyStats.objects.rebuild(), over the historical examinations model
+    HospitalDailyStats = apps.get_model('covid_19', 'HospitalDailyStats')
+    MedicalExaminationResult = apps.get_model('covid_19', 'MedicalExaminationResult')
+    db_alias = schema_editor.connection.alias
+
+    HospitalDailyStats.objects.using(db_alias).bulk_create(
+        HospitalDailyStats(hospital_id=hospital_id, date=date, **metrics)
+        for (hospital_id, date), metrics in compute_hospital_daily_stats(
+            MedicalExaminationResult.objects.using(db_alias),
+        ).items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('covid_19', '0003_medical_examination_result_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HospitalDailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('num_of_new_corona_cases', models.PositiveIntegerField(default=0)),
+                ('num_of_deaths', models.PositiveIntegerField(default=0)),
+                ('num_of_deaths_after_corona', models.PositiveIntegerField(default=0)),
+                ('num_of_healthy_results', models.PositiveIntegerField(default=0)),
+                ('num_of_active_workers_in_risk_of_corona', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='medicalexaminationresult',
+            index=models.Index(fields=['time'], name='covid_mer_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='hospitaldailystats',
+            name='hospital',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='covid_19.Hospital'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='hospitaldailystats',
+            unique_together=set([('hospital', 'date')]),
+        ),
+        migrations.RunPython(backfill_hospital_daily_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:19
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+# HospitalWorker.POSITION_MASKS at the time of the migration
+POSITION_MASKS = {
+    'Doctor': 1,
+    'Nurse': 2,
+}
+
+
+def backfill_person_jobs(apps, schema_editor):
+    Person = apps.get_model('covid_19', 'Person')
+    HospitalWorker = apps.get_model('covid_19', 'HospitalWorker')
+    db_alias = schema_editor.connection.alias
+
+    jobs = HospitalWorker.objects.filter(person=OuterRef('pk')).order_by()
+    num_of_jobs = jobs.values('person').annotate(num_of_jobs=Count('pk')).values('num_of_jobs')
+    positions_mask = sum((
+        Coalesce(Subquery(
+            jobs.filter(position=position).annotate(
+                mask=Value(mask, output_field=models.IntegerField()),
+            ).values('mask')[:1],
+            output_field=models.IntegerField(),
+        ), 0)
+        for position, mask in sorted(POSITION_MASKS.items())
+    ), Value(0))
+    Person.objects.using(db_alias).filter(pk__in=HospitalWorker.objects.values('person')).update(
+        num_of_jobs=Coalesce(Subquery(num_of_jobs, output_field=models.IntegerField()), 0),
+        positions_mask=positions_mask,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('covid_19', '0004_hospital_daily_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='num_of_jobs',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='positions_mask',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['positions_mask', 'num_of_jobs'], name='covid_person_jobs_idx'),
+        ),
+        migrations.RunPython(backfill_person_jobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('covid_19', '0005_person_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EpidemicCurveBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'day'), ('week', 'week')], max_length=4)),
+                ('start', models.DateField()),
+                ('num_of_new_corona_cases', models.PositiveIntegerField(default=0)),
+                ('num_of_deaths', models.PositiveIntegerField(default=0)),
+                ('num_of_recoveries', models.PositiveIntegerField(default=0)),
+                ('department', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='epidemic_curve_buckets', to='covid_19.Department')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='epidemiccurvebucket',
+            unique_together=set([('period', 'start', 'department')]),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Expand step of storing the choices as integer codes: the code columns are added next to the string
+    columns, 0008 fills them in batches and 0009 replaces the string columns with them. The string
+    columns become nullable so 0009 can be reversed (they are refilled by reversing 0008).
+    """
+
+    dependencies = [
+        ('covid_19', '0006_epidemic_curve_buckets'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='person',
+            name='gender',
+            field=models.CharField(choices=[('Male', 'Male'), ('Female', 'Female'), ('Other', 'Other')], max_length=6, null=True),
+        ),
+        migrations.AlterField(
+            model_name='hospitalworker',
+            name='position',
+            field=models.CharField(choices=[('Doctor', 'Doctor'), ('Nurse', 'Nurse')], max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='medicalexaminationresult',
+            name='result',
+            field=models.CharField(choices=[('Healthy', 'Healthy'), ('Corona', 'Corona'), ('Botism', 'Botism'), ('Dead', 'Dead')], max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='gender_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='hospitalworker',
+            name='position_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='medicalexaminationresult',
+            name='result_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
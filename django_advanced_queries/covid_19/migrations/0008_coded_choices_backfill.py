@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models, transaction
+from django.db.models import Case, Max, Value, When
+
+BATCH_SIZE = 20000
+
+# (model name, string field, code field, codes) - the models' codes at the time of the migration
+CODED_FIELDS = (
+    ('Person', 'gender', 'gender_code', {'Male': 0, 'Female': 1, 'Other': 2}),
+    ('HospitalWorker', 'position', 'position_code', {'Doctor': 0, 'Nurse': 1}),
+    ('MedicalExaminationResult', 'result', 'result_code', {'Healthy': 0, 'Corona': 1, 'Botism': 2, 'Dead': 3}),
+)
+
+
+def _update_in_batches(model, db_alias, filters, values):
+    """Every batch of ids is updated in its own transaction, an interrupted run continues where it stopped."""
+    max_id = model.objects.using(db_alias).aggregate(max_id=Max('pk'))['max_id'] or 0
+    for start_id in range(0, max_id, BATCH_SIZE):
+        with transaction.atomic(using=db_alias):
+            model.objects.using(db_alias).filter(
+                pk__gt=start_id,
+                pk__lte=start_id + BATCH_SIZE,
+                **filters
+            ).update(**values)
+
+
+def fill_codes(apps, schema_editor):
+    for model_name, field_name, code_field_name, codes in CODED_FIELDS:
+        _update_in_batches(
+            apps.get_model('covid_19', model_name),
+            schema_editor.connection.alias,
+            filters={'{field}__isnull'.format(field=code_field_name): True},
+            values={code_field_name: Case(
+                *[When(then=Value(code), **{field_name: value}) for value, code in sorted(codes.items())],
+                output_field=models.PositiveSmallIntegerField()
+            )},
+        )
+
+
+def fill_strings(apps, schema_editor):
+    for model_name, field_name, code_field_name, codes in CODED_FIELDS:
+        _update_in_batches(
+            apps.get_model('covid_19', model_name),
+            schema_editor.connection.alias,
+            filters={'{field}__isnull'.format(field=code_field_name): False},
+            values={field_name: Case(
+                *[When(then=Value(value), **{code_field_name: code}) for value, code in sorted(codes.items())],
+                output_field=models.CharField()
+            )},
+        )
+
+
+class Migration(migrations.Migration):
+    # The batches commit on their own
+    atomic = False
+
+    dependencies = [
+        ('covid_19', '0007_coded_choices_expand'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_codes, fill_strings),
+    ]
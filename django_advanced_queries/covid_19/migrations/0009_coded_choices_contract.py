@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django_advanced_queries.covid_19.fields
+
+
+class Migration(migrations.Migration):
+    """Contract step: the filled code columns replace the string columns (and their index)."""
+
+    dependencies = [
+        ('covid_19', '0008_coded_choices_backfill'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='medicalexaminationresult',
+            name='covid_mer_result_patient_idx',
+        ),
+        migrations.RemoveField(
+            model_name='person',
+            name='gender',
+        ),
+        migrations.RemoveField(
+            model_name='hospitalworker',
+            name='position',
+        ),
+        migrations.RemoveField(
+            model_name='medicalexaminationresult',
+            name='result',
+        ),
+        migrations.RenameField(
+            model_name='person',
+            old_name='gender_code',
+            new_name='gender',
+        ),
+        migrations.RenameField(
+            model_name='hospitalworker',
+            old_name='position_code',
+            new_name='position',
+        ),
+        migrations.RenameField(
+            model_name='medicalexaminationresult',
+            old_name='result_code',
+            new_name='result',
+        ),
+        migrations.AlterField(
+            model_name='person',
+            name='gender',
+            field=django_advanced_queries.covid_19.fields.CodedChoiceField(choices=[('Male', 'Male'), ('Female', 'Female'), ('Other', 'Other')], codes={'Female': 1, 'Male': 0, 'Other': 2}),
+        ),
+        migrations.AlterField(
+            model_name='hospitalworker',
+            name='position',
+            field=django_advanced_queries.covid_19.fields.CodedChoiceField(choices=[('Doctor', 'Doctor'), ('Nurse', 'Nurse')], codes={'Doctor': 0, 'Nurse': 1}),
+        ),
+        migrations.AlterField(
+            model_name='medicalexaminationresult',
+            name='result',
+            field=django_advanced_queries.covid_19.fields.CodedChoiceField(choices=[('Healthy', 'Healthy'), ('Corona', 'Corona'), ('Botism', 'Botism'), ('Dead', 'Dead')], codes={'Botism': 2, 'Corona': 1, 'Dead': 3, 'Healthy': 0}),
+        ),
+        migrations.AddIndex(
+            model_name='medicalexaminationresult',
+            index=models.Index(fields=['result', 'patient'], name='covid_mer_result_patient_idx'),
+        ),
+    ]
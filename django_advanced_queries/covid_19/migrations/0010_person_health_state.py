@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_advanced_queries.covid_19.fields
+
+BATCH_SIZE = 5000
+
+# MedicalExaminationResult.SICK_RESULTS at the time of the migration
+SICK_RESULTS = ('Corona', 'Botism')
+
+
+def get_state(last_result, previous_result, num_of_infections):
+    # PersonHealthState.get_state at the time of the migration
+    if last_result in SICK_RESULTS:
+        return 'Sick'
+    if last_result == 'Dead':
+        return 'Dead from Corona' if previous_result == 'Corona' else 'Dead'
+    return 'Recovered' if num_of_infections else 'Healthy'
+
+
+def backfill_person_health_states(apps, schema_editor):
+    """Fold every person's examinations history in (time, id) order, as PersonHealthState.apply does."""
+    PersonHealthState = apps.get_model('covid_19', 'PersonHealthState')
+    MedicalExaminationResult = apps.get_model('covid_19', 'MedicalExaminationResult')
+    db_alias = schema_editor.connection.alias
+
+    health_states = []
+    health_state = None
+    for person_id, examination_id, time, result in MedicalExaminationResult.objects.using(db_alias).order_by(
+        'patient__person', 'time', 'pk',
+    ).values_list('patient__person', 'pk', 'time', 'result').iterator():
+        if health_state is None or health_state.person_id != person_id:
+            if len(health_states) >= BATCH_SIZE:
+                PersonHealthState.objects.using(db_alias).bulk_create(health_states)
+                health_states = []
+            health_state = PersonHealthState(person_id=person_id, last_result=None, num_of_examinations=0,
+                                             num_of_infections=0, num_of_recoveries=0)
+            health_states.append(health_state)
+
+        was_sick = health_state.last_result in SICK_RESULTS
+        if result in SICK_RESULTS and not was_sick:
+            health_state.num_of_infections += 1
+        if result == 'Healthy' and was_sick:
+            health_state.num_of_recoveries += 1
+        if result == 'Corona' and health_state.first_corona_time is None:
+            health_state.first_corona_time = time
+        if result == 'Dead' and health_state.death_time is None:
+            health_state.death_time = time
+        health_state.state = get_state(result, health_state.last_result, health_state.num_of_infections)
+        health_state.last_result = result
+        health_state.last_examination_id = examination_id
+        health_state.last_examination_time = time
+        health_state.num_of_examinations += 1
+
+    PersonHealthState.objects.using(db_alias).bulk_create(health_states)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('covid_19', '0009_coded_choices_contract'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PersonHealthState',
+            fields=[
+                ('person', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='health_state', serialize=False, to='covid_19.Person')),
+                ('state', django_advanced_queries.covid_19.fields.CodedChoiceField(choices=[('Healthy', 'Healthy'), ('Sick', 'Sick'), ('Recovered', 'Recovered'), ('Dead', 'Dead'), ('Dead from Corona', 'Dead from Corona')], codes={'Dead': 3, 'Dead from Corona': 4, 'Healthy': 0, 'Recovered': 2, 'Sick': 1})),
+                ('last_result', django_advanced_queries.covid_19.fields.CodedChoiceField(choices=[('Healthy', 'Healthy'), ('Corona', 'Corona'), ('Botism', 'Botism'), ('Dead', 'Dead')], codes={'Botism': 2, 'Corona': 1, 'Dead': 3, 'Healthy': 0})),
+                ('last_examination_time', models.DateTimeField()),
+                ('first_corona_time', models.DateTimeField(blank=True, null=True)),
+                ('death_time', models.DateTimeField(blank=True, null=True)),
+                ('num_of_examinations', models.PositiveIntegerField(default=0)),
+                ('num_of_infections', models.PositiveIntegerField(default=0)),
+                ('num_of_recoveries', models.PositiveIntegerField(default=0)),
+                ('last_examination', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='covid_19.MedicalExaminationResult')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='personhealthstate',
+            index=models.Index(fields=['state'], name='covid_health_state_idx'),
+        ),
+        migrations.RunPython(backfill_person_health_states, migrations.RunPython.noop),
+    ]
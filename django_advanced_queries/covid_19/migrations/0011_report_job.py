@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django_advanced_queries.covid_19.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('covid_19', '0010_person_health_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('report', models.CharField(max_length=64)),
+                ('params', models.TextField(default='{}')),
+                ('priority', models.SmallIntegerField(default=0)),
+                ('status', django_advanced_queries.covid_19.fields.CodedChoiceField(choices=[('pending', 'pending'), ('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], codes={'failed': 3, 'pending': 0, 'running': 1, 'succeeded': 2}, default='pending')),
+                ('dedup_key', models.CharField(blank=True, max_length=40, null=True, unique=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('max_attempts', models.PositiveSmallIntegerField(default=3)),
+                ('created_at', models.DateTimeField()),
+                ('available_at', models.DateTimeField()),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('worker', models.CharField(blank=True, max_length=255)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('result', models.TextField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reportjob',
+            index=models.Index(fields=['status', '-priority', 'available_at'], name='covid_report_job_claim_idx'),
+        ),
+    ]
@@ -1,13 +1,864 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.db import models
+import datetime
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Avg, Case, Count, F, Max, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from django_advanced_queries.covid_19.arrays import DEFAULT_CHUNK_SIZE, queryset_to_arrays
+from django_advanced_queries.covid_19.bulk import MAX_IN_LIST_SIZE, chunks
+from django_advanced_queries.covid_19.caching import cached
+from django_advanced_queries.covid_19.display import DisplayRelatedQuerySet, get_display_related
+from django_advanced_queries.covid_19.fields import CodedChoiceField
+from django_advanced_queries.covid_19.instrumentation import instrumented
+from django_advanced_queries.covid_19.routers import analytic
+from django_advanced_queries.covid_19.shards import merge_max, merge_max_by, sharded, unsharded
+
+
+class HospitalQuerySet(DisplayRelatedQuerySet):
+    @sharded()
+    @instrumented
+    @cached('Department', 'HospitalWorker', 'Person')
+    @analytic
+    def annotate_by_num_of_hospital_workers_in_risk_of_corona(self):
+        return self.annotate(
+            num_of_hospital_workers_in_risk_of_corona=Count(
+                Case(When(
+                    departments__hospital_workers__person__age__gte=Person.RISK_GROUP_MIN_AGE,
+                    then='departments__hospital_workers__person',
+                )),
+                distinct=True,
+            ),
+        )
+
+    @sharded()
+    @instrumented
+    @cached('Department', 'Patient', 'MedicalExaminationResult', 'HospitalDailyStats', 'PersonHealthState')
+    @analytic
+    def annotate_by_num_of_dead_from_corona(self, from_rollup=False, from_health_state=False):
+        if from_rollup:
+            return self.annotate(
+                num_of_dead_from_corona=Coalesce(Sum('daily_stats__num_of_deaths_after_corona'), 0),
+            )
+        if from_health_state:
+            # The patients whose person's record is dead from corona, instead of every death's previous result
+            return self.annotate(
+                num_of_dead_from_corona=Count(
+                    Case(When(
+                        departments__patients_details__person__in=PersonHealthState.objects.filter(
+                            state=PersonHealthState.STATE_DEAD_FROM_CORONA,
+                        ).values('person'),
+                        then='departments__patients_details',
+                    )),
+                    distinct=True,
+                ),
+            )
+
+        return self.annotate(
+            num_of_dead_from_corona=Count(
+                Case(When(
+                    departments__patients_details__in=MedicalExaminationResult.objects.db_manager(
+                        self._db,
+                    ).filter_deaths_after_corona().values('patient'),
+                    then='departments__patients_details',
+                )),
+                distinct=True,
+            ),
+        )
+
+    @sharded()
+    @instrumented
+    @cached('Department', 'HospitalWorker', 'Person', 'Patient', 'MedicalExaminationResult')
+    @analytic
+    def dashboard(self):
+        """
+        Annotate the hospital dashboard metrics in a single query.
+
+        Every metric is its own correlated aggregate subquery, joins of one metric don't multiply the
+        rows counted by another (as chaining the annotate methods does).
+        """
+        def per_hospital(queryset, hospital_lookup, aggregate, output_field=models.IntegerField()):
+            return Subquery(
+                queryset.filter(**{hospital_lookup: OuterRef('pk')}).order_by().values(
+                    hospital_lookup,
+                ).annotate(value=aggregate).values('value'),
+                output_field=output_field,
+            )
+
+        hospital_workers = HospitalWorker.objects.all()
+        patients = Patient.objects.all()
+        return self.annotate(
+            num_of_departments=Coalesce(per_hospital(Department.objects.all(), 'hospital', Count('pk')), 0),
+            num_of_hospital_workers=Coalesce(
+                per_hospital(hospital_workers, 'department__hospital', Count('person', distinct=True)),
+                0,
+            ),
+            num_of_hospital_workers_in_risk_of_corona=Coalesce(
+                per_hospital(
+                    hospital_workers.filter(person__age__gte=Person.RISK_GROUP_MIN_AGE),
+                    'department__hospital',
+                    Count('person', distinct=True),
+                ),
+                0,
+            ),
+            num_of_dead_from_corona=Coalesce(
+                per_hospital(
+                    patients.filter(pk__in=MedicalExaminationResult.objects.db_manager(
+                        self._db,
+                    ).filter_deaths_after_corona().values('patient')),
+                    'department__hospital',
+                    Count('pk'),
+                ),
+                0,
+            ),
+            num_of_sick_patients=Coalesce(
+                per_hospital(
+                    patients.filter(last_medical_examination_result__result__in=MedicalExaminationResult.SICK_RESULTS),
+                    'department__hospital',
+                    Count('pk'),
+                ),
+                0,
+            ),
+            avg_age_of_patients=per_hospital(
+                patients,
+                'department__hospital',
+                Avg('person__age'),
+                output_field=models.FloatField(),
+            ),
+        )
+
+
+class DepartmentQuerySet(DisplayRelatedQuerySet):
+    @sharded()
+    @instrumented
+    @cached('Patient', 'Person')
+    @analytic
+    def annotate_avg_age_of_patients(self):
+        return self.annotate(avg_age_of_patients=Avg('patients_details__person__age'))
+
+
+class PersonQuerySet(DisplayRelatedQuerySet):
+    @unsharded
+    @instrumented
+    @analytic
+    def get_sick_persons(self, from_health_state=False):
+        # Sick person - last medical examination result is not dead or healthy.
+        if from_health_state:
+            # A search of covid_health_state_idx, the latest examination in any of the person's departments
+            return self.filter(health_state__state=PersonHealthState.STATE_SICK)
+        # Reads the maintained pointer on Patient instead of the whole history.
+        return self.filter(
+            patients_details__last_medical_examination_result__result__in=MedicalExaminationResult.SICK_RESULTS,
+        ).distinct()
+
+    @unsharded
+    @instrumented
+    @analytic
+    def persons_with_multiple_jobs(self, jobs=None):
+        """Persons holding more than one job. If `jobs` is given, their positions must be exactly `jobs`."""
+        # A search of covid_person_jobs_idx on the maintained positions mask and jobs count
+        if jobs is None:
+            # Any non empty positions mask
+            positions_masks = range(1, HospitalWorker.get_positions_mask(HospitalWorker.POSITION_MASKS) + 1)
+        elif set(jobs) <= set(HospitalWorker.POSITION_MASKS):
+            positions_masks = [HospitalWorker.get_positions_mask(jobs)]
+        else:
+            return self.none()
+
+        return self.filter(positions_mask__in=positions_masks, num_of_jobs__gt=1).order_by('pk')
+
+    @unsharded
+    @instrumented
+    @analytic
+    def filter_by_health_state(self, *states):
+        """Persons whose maintained health state (see PersonHealthState) is one of `states`."""
+        return self.filter(health_state__state__in=states)
+
+    def _get_actual_jobs(self):
+        """Expressions of the jobs count and the positions mask of a person computed from its jobs."""
+        jobs = HospitalWorker.objects.filter(person=OuterRef('pk')).order_by()
+        num_of_jobs = jobs.values('person').annotate(num_of_jobs=Count('pk')).values('num_of_jobs')
+        # Every position contributes its bit if the person holds at least one job in it
+        positions_mask = sum((
+            Coalesce(Subquery(
+                jobs.filter(position=position).annotate(
+                    mask=Value(mask, output_field=models.IntegerField()),
+                ).values('mask')[:1],
+                output_field=models.IntegerField(),
+            ), 0)
+            for position, mask in sorted(HospitalWorker.POSITION_MASKS.items())
+        ), Value(0))
+        return {
+            'num_of_jobs': Coalesce(Subquery(num_of_jobs, output_field=models.IntegerField()), 0),
+            'positions_mask': positions_mask,
+        }
+
+    @instrumented
+    def refresh_jobs(self):
+        """Recompute the maintained num_of_jobs and positions_mask of every person in the queryset."""
+        return self.update(**self._get_actual_jobs())
+
+    @instrumented
+    def get_persons_with_inconsistent_jobs(self):
+        """Persons whose maintained num_of_jobs or positions_mask doesn't match their jobs."""
+        actual_jobs = self._get_actual_jobs()
+        return self.annotate(
+            actual_num_of_jobs=actual_jobs['num_of_jobs'],
+            actual_positions_mask=actual_jobs['positions_mask'],
+        ).exclude(
+            num_of_jobs=F('actual_num_of_jobs'),
+            positions_mask=F('actual_positions_mask'),
+        ).order_by('pk')
+
+    def _get_history_health_state(self):
+        """Expressions of the PersonHealthState.STATE_FIELDS of a person computed from its examinations history."""
+        examinations = MedicalExaminationResult.objects.filter(patient__person=OuterRef('pk')).order_by()
+        latest_examinations = examinations.order_by('-time', '-pk')
+        # The examination right before, in any of the person's departments
+        previous_result = MedicalExaminationResult.objects.filter(
+            Q(time__lt=OuterRef('time')) | Q(time=OuterRef('time'), pk__lt=OuterRef('pk')),
+            patient__person=OuterRef('patient__person'),
+        ).order_by('-time', '-pk').values('result')[:1]
+        transitions = examinations.annotate(previous_result=Subquery(previous_result))
+
+        # Conditional aggregates over the person's examinations, a filter on the result would have the
+        # subqueries search the result index (every examination with the result) instead
+        def per_person(queryset, aggregate, output_field):
+            return Subquery(
+                queryset.values('patient__person').annotate(value=aggregate).values('value'),
+                output_field=output_field,
+            )
+
+        def count(queryset, condition=None):
+            return Coalesce(per_person(
+                queryset,
+                Count('pk') if condition is None else Count(Case(When(condition, then='pk'))),
+                models.IntegerField(),
+            ), 0)
+
+        def first_time(result):
+            return per_person(examinations, Min(Case(When(result=result, then='time'))), models.DateTimeField())
+
+        return {
+            'last_result': Subquery(latest_examinations.values('result')[:1]),
+            'last_examination_id': Subquery(latest_examinations.values('pk')[:1]),
+            'last_examination_time': Subquery(latest_examinations.values('time')[:1]),
+            'first_corona_time': first_time(MedicalExaminationResult.RESULT_CORONA),
+            'death_time': first_time(MedicalExaminationResult.RESULT_DEAD),
+            'num_of_examinations': count(examinations),
+            'num_of_infections': count(transitions, Q(
+                Q(previous_result__isnull=True) | ~Q(previous_result__in=MedicalExaminationResult.SICK_RESULTS),
+                result__in=MedicalExaminationResult.SICK_RESULTS,
+            )),
+            'num_of_recoveries': count(transitions, Q(
+                result=MedicalExaminationResult.RESULT_HEALTHY,
+                previous_result__in=MedicalExaminationResult.SICK_RESULTS,
+            )),
+            # Only to derive the state
+            'previous_result': Subquery(latest_examinations.values('result')[1:2]),
+        }
+
+    @instrumented
+    def get_persons_with_inconsistent_health_state(self):
+        """
+        (person, recorded, expected) of the persons whose health state record doesn't match their history.
+
+        recorded and expected are {field: value} of PersonHealthState.STATE_FIELDS, None without a record
+        (expected - without examinations).
+        """
+        persons = self.select_related('health_state').annotate(**{
+            'history_{name}'.format(name=name): expression
+            for name, expression in self._get_history_health_state().items()
+        }).order_by('pk')
+
+        inconsistent_persons = []
+        for person in persons:
+            expected = None
+            if person.history_last_examination_id is not None:
+                expected = {
+                    name: getattr(person, 'history_{name}'.format(name=name))
+                    for name in PersonHealthState.STATE_FIELDS if name != 'state'
+                }
+                expected['state'] = PersonHealthState.get_state(
+                    expected['last_result'],
+                    person.history_previous_result,
+                    expected['num_of_infections'],
+                )
+            health_state = getattr(person, 'health_state', None)
+            recorded = health_state.get_state_values() if health_state is not None else None
+            if recorded != expected:
+                inconsistent_persons.append((person, recorded, expected))
+        return inconsistent_persons
+
+
+class HospitalWorkerQuerySet(DisplayRelatedQuerySet):
+    @unsharded
+    @instrumented
+    @analytic
+    def get_sick_workers(self, from_health_state=False):
+        return self.filter(person__in=Person.objects.db_manager(self._db).get_sick_persons(
+            from_health_state=from_health_state,
+        ))
+
+    @sharded(merge_max_by('num_of_medical_examinations'))
+    @instrumented
+    @analytic
+    def get_worker_performed_most_medical_examinations(self, filter_kwargs, exclude_kwargs):
+        return self.filter(
+            **filter_kwargs
+        ).exclude(
+            **exclude_kwargs
+        ).annotate(
+            num_of_medical_examinations=Count('medical_examination_results'),
+        ).order_by('-num_of_medical_examinations').first()
+
+
+class PatientQuerySet(DisplayRelatedQuerySet):
+    @sharded()
+    @instrumented
+    @analytic
+    def filter_by_examinations_results_options(self, results):
+        return self.filter(medical_examination_results__result__in=results).distinct()
+
+    @unsharded
+    @instrumented
+    @analytic
+    def filter_by_examined_hospital_workers(self, hospital_workers):
+        return self.filter(medical_examination_results__examined_by__in=hospital_workers).distinct()
+
+    @sharded()
+    @instrumented
+    @analytic
+    def filter_dead_from_corona(self):
+        return self.filter(pk__in=MedicalExaminationResult.objects.db_manager(
+            self._db,
+        ).filter_deaths_after_corona().values('patient'))
+
+    @sharded(merge_max)
+    @instrumented
+    @cached('MedicalExaminationResult')
+    @analytic
+    def get_highest_num_of_patient_medical_examinations(self):
+        return self.annotate(
+            num_of_medical_examinations=Count('medical_examination_results'),
+        ).aggregate(
+            highest_num_of_medical_examinations=Max('num_of_medical_examinations'),
+        )['highest_num_of_medical_examinations']
+
+    @instrumented
+    def refresh_last_medical_examination_result(self):
+        """Point every patient in the queryset at its latest medical examination result."""
+        latest_medical_examination_result = MedicalExaminationResult.objects.filter(
+            patient=OuterRef('pk'),
+        ).order_by('-time', '-pk').values('pk')[:1]
+
+        return self.update(last_medical_examination_result=Subquery(latest_medical_examination_result))
+
+
+class MedicalExaminationResultQuerySet(DisplayRelatedQuerySet):
+    def annotate_previous_result(self):
+        return self.annotate(previous_result=get_previous_result(self.model))
+
+    @sharded()
+    @instrumented
+    @analytic
+    def filter_deaths_after_corona(self):
+        # Dead from corona - the examination right before the death was Corona
+        return self.filter(
+            result=MedicalExaminationResult.RESULT_DEAD,
+        ).annotate_previous_result().filter(previous_result=MedicalExaminationResult.RESULT_CORONA)
+
+    @instrumented
+    @analytic
+    def to_arrays(self, fields=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """The examinations as NumPy arrays per field (see arrays.py), read in chunks of values."""
+        return queryset_to_arrays(self, fields=fields, chunk_size=chunk_size)
+
+
+def get_previous_result(model):
+    """
+    Subquery of the result of the patient's examination right before, in (time, id) order as the health states
+    follow the history.
+
+    Takes the examinations model, the migrations pass their historical one.
+    """
+    return Subquery(model._default_manager.filter(
+        Q(time__lt=OuterRef('time')) | Q(time=OuterRef('time'), pk__lt=OuterRef('pk')),
+        patient=OuterRef('patient'),
+    ).order_by('-time', '-pk').values('result')[:1])
+
+
+def chunk_keys_by_date(keys, size=MAX_IN_LIST_SIZE):
+    """Split (hospital id, date) keys into {date: [hospital id]} chunks of at most `size` query params."""
+    hospital_ids_by_date = {}
+    for hospital_id, date in keys:
+        hospital_ids_by_date.setdefault(date, set()).add(hospital_id)
+
+    chunk, chunk_size = {}, 0
+    for date, hospital_ids in sorted(hospital_ids_by_date.items()):
+        # A date takes its hospital ids and the two bounds of its day
+        for hospital_ids_chunk in chunks(sorted(hospital_ids), size - 2):
+            if chunk and chunk_size + len(hospital_ids_chunk) + 2 > size:
+                yield chunk
+                chunk, chunk_size = {}, 0
+            chunk.setdefault(date, []).extend(hospital_ids_chunk)
+            chunk_size += len(hospital_ids_chunk) + 2
+    if chunk:
+        yield chunk
+
+
+def get_keys_filter(keys_chunk, hospital_lookup, date_lookup=None):
+    """Q of the rows of exactly the keys of a `chunk_keys_by_date` chunk, by date or else by day of `time`."""
+    keys_filter = Q()
+    for date, hospital_ids in sorted(keys_chunk.items()):
+        if date_lookup is not None:
+            date_filter = {date_lookup: date}
+        else:
+            start_time = datetime.datetime.combine(date, datetime.time.min)
+            date_filter = {'time__gte': start_time, 'time__lt': start_time + datetime.timedelta(days=1)}
+        keys_filter |= Q(**dict(date_filter, **{'{lookup}__in'.format(lookup=hospital_lookup): hospital_ids}))
+    return keys_filter
+
+
+def compute_hospital_daily_stats(examinations, keys=None):
+    """
+    Compute the daily stats from the medical examinations history (a queryset of the examinations, the
+    migrations pass one of their historical model).
+
+    Returns {(hospital id, date): {metric: value}} of every day, or only of the (hospital id, date) `keys`.
+    Patients' metrics are attributed to the hospital of the patient's department and workers' metrics to
+    the hospital of the examining worker's department.
+    """
+    if keys is None:
+        filters = [(Q(), Q())]
+    else:
+        filters = [
+            (
+                get_keys_filter(keys_chunk, 'patient__department__hospital'),
+                get_keys_filter(keys_chunk, 'examined_by__department__hospital'),
+            )
+            for keys_chunk in chunk_keys_by_date(keys)
+        ]
+
+    daily_stats = {}
+    for patients_filter, workers_filter in filters:
+        patients_daily_stats = examinations.filter(patients_filter).annotate(
+            previous_result=get_previous_result(examinations.model),
+            date=TruncDate('time'),
+        ).values('patient__department__hospital', 'date').annotate(
+            num_of_new_corona_cases=Sum(Case(
+                When(
+                    result=MedicalExaminationResult.RESULT_CORONA,
+                    previous_result=MedicalExaminationResult.RESULT_CORONA,
+                    then=0,
+                ),
+                When(result=MedicalExaminationResult.RESULT_CORONA, then=1),
+                default=0,
+                output_field=models.IntegerField(),
+            )),
+            num_of_deaths=Sum(Case(
+                When(result=MedicalExaminationResult.RESULT_DEAD, then=1),
+                default=0,
+                output_field=models.IntegerField(),
+            )),
+            num_of_deaths_after_corona=Sum(Case(
+                When(
+                    result=MedicalExaminationResult.RESULT_DEAD,
+                    previous_result=MedicalExaminationResult.RESULT_CORONA,
+                    then=1,
+                ),
+                default=0,
+                output_field=models.IntegerField(),
+            )),
+            num_of_healthy_results=Sum(Case(
+                When(result=MedicalExaminationResult.RESULT_HEALTHY, then=1),
+                default=0,
+                output_field=models.IntegerField(),
+            )),
+        ).order_by()
+        for row in patients_daily_stats:
+            key = (row.pop('patient__department__hospital'), row.pop('date'))
+            daily_stats.setdefault(key, dict.fromkeys(HospitalDailyStats.METRICS, 0)).update(row)
+
+        workers_daily_stats = examinations.filter(workers_filter).annotate(
+            date=TruncDate('time'),
+        ).values('examined_by__department__hospital', 'date').annotate(
+            num_of_active_workers_in_risk_of_corona=Count(
+                Case(When(examined_by__person__age__gte=Person.RISK_GROUP_MIN_AGE, then='examined_by__person')),
+                distinct=True,
+            ),
+        ).order_by()
+        for row in workers_daily_stats:
+            key = (row.pop('examined_by__department__hospital'), row.pop('date'))
+            daily_stats.setdefault(key, dict.fromkeys(HospitalDailyStats.METRICS, 0)).update(row)
+
+    return daily_stats
+
+
+class HospitalDailyStatsQuerySet(DisplayRelatedQuerySet):
+    def compute(self, keys=None):
+        """The daily stats computed from the history, see `compute_hospital_daily_stats`."""
+        return compute_hospital_daily_stats(MedicalExaminationResult.objects.using(self.db), keys=keys)
+
+    @instrumented
+    def rebuild(self):
+        """Recompute the whole rollup from the medical examinations history."""
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            self.bulk_create(
+                HospitalDailyStats(hospital_id=hospital_id, date=date, **metrics)
+                for (hospital_id, date), metrics in self.compute().items()
+            )
+
+    @instrumented
+    def refresh(self, keys):
+        """
+        Recompute the rollup of exactly the given (hospital id, date) keys.
+
+        A batch of keys is recomputed in one go (per chunk of query params) and only the rows that changed are
+        written.
+        """
+        keys = set(keys)
+        if not keys:
+            return
+
+        daily_stats = self.compute(keys=keys)
+        with transaction.atomic(using=self.db, savepoint=False):
+            stale_ids = []
+            for keys_chunk in chunk_keys_by_date(keys):
+                for current_daily_stats in self.filter(get_keys_filter(keys_chunk, 'hospital', 'date')).values(
+                    'pk', 'hospital', 'date', *HospitalDailyStats.METRICS
+                ):
+                    metrics = daily_stats.pop((current_daily_stats['hospital'], current_daily_stats['date']), None)
+                    if metrics is None:
+                        stale_ids.append(current_daily_stats['pk'])
+                    elif any(current_daily_stats[metric] != value for metric, value in metrics.items()):
+                        self.filter(pk=current_daily_stats['pk']).update(**metrics)
+
+            for stale_ids_chunk in chunks(stale_ids):
+                self.filter(pk__in=stale_ids_chunk).delete()
+            self.bulk_create(
+                HospitalDailyStats(hospital_id=hospital_id, date=date, **metrics)
+                for (hospital_id, date), metrics in daily_stats.items()
+            )
+
+
+class EpidemicCurveBucketQuerySet(DisplayRelatedQuerySet):
+    def compute(self, period, start_date, end_date):
+        """
+        Compute the buckets of the days from start_date to end_date (excluded) in one grouped query.
+
+        Returns {(hospital id, department id, bucket start): {metric: value}}, (None, None, bucket start)
+        holds the totals of the bucket. Patients' examinations count in the patient's department.
+        """
+        examinations = MedicalExaminationResult.objects.using(self.db).filter(
+            time__gte=datetime.datetime.combine(start_date, datetime.time.min),
+            time__lt=datetime.datetime.combine(end_date, datetime.time.min),
+        )
+        # Grouped by day in the database (no week truncation in this Django), folded into buckets below
+        daily_rows = examinations.annotate_previous_result().annotate(
+            date=TruncDate('time'),
+        ).values('patient__department__hospital', 'patient__department', 'date').annotate(
+            num_of_new_corona_cases=Sum(Case(
+                When(
+                    result=MedicalExaminationResult.RESULT_CORONA,
+                    previous_result=MedicalExaminationResult.RESULT_CORONA,
+                    then=0,
+                ),
+                When(result=MedicalExaminationResult.RESULT_CORONA, then=1),
+                default=0,
+                output_field=models.IntegerField(),
+            )),
+            num_of_deaths=Sum(Case(
+                When(result=MedicalExaminationResult.RESULT_DEAD, then=1),
+                default=0,
+                output_field=models.IntegerField(),
+            )),
+            num_of_recoveries=Sum(Case(
+                When(
+                    result=MedicalExaminationResult.RESULT_HEALTHY,
+                    previous_result__in=MedicalExaminationResult.SICK_RESULTS,
+                    then=1,
+                ),
+                default=0,
+                output_field=models.IntegerField(),
+            )),
+        ).order_by()
+
+        buckets = {}
+        for row in daily_rows:
+            start = EpidemicCurveBucket.get_bucket_start(period, row.pop('date'))
+            hospital_id, department_id = row.pop('patient__department__hospital'), row.pop('patient__department')
+            for key in ((hospital_id, department_id, start), (None, None, start)):
+                metrics = buckets.setdefault(key, dict.fromkeys(EpidemicCurveBucket.METRICS, 0))
+                for metric, value in row.items():
+                    metrics[metric] += value
+        return buckets
+
+    def materialize(self, period, starts):
+        """Compute and store the (completed) buckets starting at `starts`, returns them like `compute`."""
+        starts = set(starts)
+        buckets = self.compute(period, min(starts), EpidemicCurveBucket.get_bucket_end(period, max(starts)))
+        buckets = {key: metrics for key, metrics in buckets.items() if key[2] in starts}
+        for start in starts:
+            # Every materialized bucket has its totals row, even without examinations
+            buckets.setdefault((None, None, start), dict.fromkeys(EpidemicCurveBucket.METRICS, 0))
+
+        try:
+            with transaction.atomic(using=self.db):
+                self.bulk_create(
+                    EpidemicCurveBucket(period=period, start=start, department_id=department_id, **metrics)
+                    for (_, department_id, start), metrics in buckets.items()
+                )
+        except IntegrityError:
+            # Materialized by a concurrent call meanwhile
+            pass
+        return buckets
+
+    @instrumented
+    def get_series(self, period=None, group_by='department', hospital=None, department=None, start_date=None,
+                   end_date=None, today=None):
+        """
+        Daily or weekly (from Monday) new corona cases, deaths and recoveries per department, hospital
+        (`group_by='hospital'`) or in total (`group_by=None`), ordered by group and bucket start, from
+        the bucket of start_date (the first examination) to the one of end_date (today), optionally of a
+        hospital/department id only.
+
+        Completed buckets are read from the table, the ones never read before are computed and stored
+        on the way, and only the open bucket (the one of `today`) is computed from the examinations every
+        time. Buckets without examinations are left out. Raises ValueError on invalid arguments.
+        """
+        period = period or EpidemicCurveBucket.PERIOD_DAY
+        if period not in EpidemicCurveBucket.PERIODS:
+            raise ValueError('Unknown period {period}'.format(period=period))
+        if group_by not in EpidemicCurveBucket.GROUP_BY:
+            raise ValueError('Unknown group by {group_by}'.format(group_by=group_by))
+
+        today = today or datetime.date.today()
+        open_start = EpidemicCurveBucket.get_bucket_start(period, today)
+        open_end = EpidemicCurveBucket.get_bucket_end(period, open_start)
+        if start_date is None:
+            first_time = MedicalExaminationResult.objects.using(self.db).order_by('time').values_list(
+                'time',
+                flat=True,
+            ).first()
+            if first_time is None:
+                return []
+            start_date = first_time.date()
+        start = EpidemicCurveBucket.get_bucket_start(period, start_date)
+        end = open_end
+        if end_date is not None:
+            end = min(EpidemicCurveBucket.get_bucket_end(
+                period,
+                EpidemicCurveBucket.get_bucket_start(period, end_date),
+            ), open_end)
+
+        buckets = {}
+        completed_end = min(end, open_start)
+        if start < completed_end:
+            stored_buckets = self.filter(period=period, start__gte=start, start__lt=completed_end)
+            if department is not None:
+                stored_buckets = stored_buckets.filter(Q(department=None) | Q(department=department))
+            elif hospital is not None:
+                stored_buckets = stored_buckets.filter(Q(department=None) | Q(department__hospital=hospital))
+            stored_buckets = stored_buckets.values(
+                'department__hospital',
+                'department',
+                'start',
+                *EpidemicCurveBucket.METRICS
+            )
+            for row in stored_buckets:
+                key = (row.pop('department__hospital'), row.pop('department'), row.pop('start'))
+                buckets[key] = row
+
+            missing_starts = set(EpidemicCurveBucket.get_bucket_starts(period, start, completed_end)) - {
+                bucket_start for hospital_id, _, bucket_start in buckets if hospital_id is None
+            }
+            if missing_starts:
+                buckets.update(self.materialize(period, missing_starts))
+        if open_start < end:
+            buckets.update(self.compute(period, open_start, open_end))
+
+        series = {}
+        for (hospital_id, department_id, bucket_start), metrics in buckets.items():
+            if department_id is None:
+                continue
+            if department is not None and department_id != int(department):
+                continue
+            if hospital is not None and hospital_id != int(hospital):
+                continue
+            if not start <= bucket_start < end:
+                continue
+
+            if group_by == 'department':
+                key = (('hospital', hospital_id), ('department', department_id), ('start', bucket_start))
+            elif group_by == 'hospital':
+                key = (('hospital', hospital_id), ('start', bucket_start))
+            else:
+                key = (('start', bucket_start), )
+            totals = series.setdefault(key, dict.fromkeys(EpidemicCurveBucket.METRICS, 0))
+            for metric in EpidemicCurveBucket.METRICS:
+                totals[metric] += metrics[metric]
+
+        return [dict(key, **series[key]) for key in sorted(series)]
+
+    @instrumented
+    def invalidate(self, dates):
+        """Drop the stored buckets of the dates, after their examinations changed."""
+        dates = set(dates)
+        for period in EpidemicCurveBucket.PERIODS:
+            starts = {EpidemicCurveBucket.get_bucket_start(period, date) for date in dates}
+            for starts_chunk in chunks(sorted(starts)):
+                self.filter(period=period, start__in=starts_chunk).delete()
+
+
+class PersonHealthStateQuerySet(DisplayRelatedQuerySet):
+    @instrumented
+    def advance(self, examination, person_id=None):
+        """
+        Apply a new examination to its person's state, without reading the person's history.
+
+        An examination older than the person's latest one (out of order), or of a person without a state
+        yet, reprocesses that person's history instead. `person_id` saves the query of the examination's person.
+        """
+        if person_id is None:
+            person_id = Patient.objects.using(self.db).filter(
+                pk=examination.patient_id,
+            ).values_list('person', flat=True).first()
+        health_state = self.filter(pk=person_id).first()
+        if health_state is None or not health_state.is_followed_by(examination.time, examination.pk):
+            return self.refresh([person_id])
+
+        last_examination_id = health_state.last_examination_id
+        health_state.apply(examination.time, examination.pk, examination.result)
+        # Only over the state it was computed from, a concurrently advanced person is reprocessed
+        if not self.filter(pk=person_id, last_examination=last_examination_id).update(
+            **health_state.get_state_values()
+        ):
+            self.refresh([person_id])
+
+    @instrumented
+    def refresh(self, person_ids):
+        """Recompute the states of the given persons from their examinations history."""
+        for person_ids_chunk in chunks(set(person_ids) - {None}):
+            health_states = {}
+            for person_id, examination_id, time, result in MedicalExaminationResult.objects.using(self.db).filter(
+                patient__person__in=person_ids_chunk,
+            ).order_by('patient__person', 'time', 'pk').values_list('patient__person', 'pk', 'time', 'result'):
+                if person_id not in health_states:
+                    health_states[person_id] = PersonHealthState(person_id=person_id)
+                health_states[person_id].apply(time, examination_id, result)
+
+            with transaction.atomic(using=self.db, savepoint=False):
+                self.filter(pk__in=person_ids_chunk).delete()
+                self.bulk_create(health_states.values())
+
+    @instrumented
+    def rebuild(self):
+        """Recompute the state of every person from the medical examinations history."""
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            self.refresh(Patient.objects.using(self.db).values_list('person', flat=True).distinct())
+
+
+class ReportJobQuerySet(DisplayRelatedQuerySet):
+    def submit(self, report, params=None, priority=0, max_attempts=3, submitted_by=None):
+        """
+        Queue a report, or return the pending (or running) job of the same report, params and submitting user.
+
+        A submission of higher priority raises the priority of the pending job it's deduplicated into.
+        """
+        params = json.dumps(params or {}, sort_keys=True, cls=DjangoJSONEncoder)
+        dedup_key = hashlib.sha1('{report}:{user_id}:{params}'.format(
+            report=report,
+            user_id=submitted_by.pk if submitted_by is not None else '',
+            params=params,
+        ).encode('utf-8')).hexdigest()
+
+        job = self.filter(dedup_key=dedup_key).first()
+        if job is None:
+            now = timezone.now()
+            try:
+                with transaction.atomic(using=self.db):
+                    return self.create(
+                        report=report,
+                        params=params,
+                        dedup_key=dedup_key,
+                        priority=priority,
+                        max_attempts=max_attempts,
+                        submitted_by=submitted_by,
+                        created_at=now,
+                        available_at=now,
+                    )
+            except IntegrityError:
+                # Submitted concurrently meanwhile
+                job = self.get(dedup_key=dedup_key)
+
+        if priority > job.priority and self.filter(pk=job.pk, status=ReportJob.STATUS_PENDING).update(
+            priority=priority,
+        ):
+            job.priority = priority
+        return job
+
+    def claim(self, worker, lease):
+        """
+        Mark the next available job (highest priority, then oldest) as running by `worker`, None if there's none.
+
+        The claimed job stays `worker`'s for `lease` (a timedelta), then it's requeued by `requeue_expired()`.
+        """
+        has_row_locks = connections[self.db].features.has_select_for_update_skip_locked
+        while True:
+            now = timezone.now()
+            candidates = self.filter(
+                status=ReportJob.STATUS_PENDING,
+                available_at__lte=now,
+            ).order_by('-priority', 'available_at', 'pk').values_list('pk', flat=True)
+            if has_row_locks:
+                with transaction.atomic(using=self.db):
+                    # The workers skip the rows locked by each other instead of waiting for them
+                    job_id = candidates.select_for_update(skip_locked=True).first()
+                    is_claimed = job_id is not None and self._claim(job_id, worker, lease, now)
+            else:
+                # Without row locks (SQLite) the conditional update is the claim on its own, a transaction
+                # reading then writing would deadlock with the other workers' (a read lock can't be upgraded)
+                job_id = candidates.first()
+                is_claimed = job_id is not None and self._claim(job_id, worker, lease, now)
+
+            if job_id is None:
+                return None
+            if is_claimed:
+                return self.get(pk=job_id)
+            # Claimed by another worker meanwhile, on to the next one
+
+    def _claim(self, job_id, worker, lease, now):
+        return bool(self.filter(pk=job_id, status=ReportJob.STATUS_PENDING).update(
+            status=ReportJob.STATUS_RUNNING,
+            worker=worker,
+            attempts=F('attempts') + 1,
+            started_at=now,
+            locked_until=now + lease,
+        ))
+
+    def requeue_expired(self, retry_delay=datetime.timedelta(0)):
+        """Retry (or fail, out of attempts) the running jobs whose lease expired - their worker died."""
+        now = timezone.now()
+        for job in self.filter(status=ReportJob.STATUS_RUNNING, locked_until__lt=now):
+            job.fail(job.worker, 'The lease of worker {worker} expired'.format(worker=job.worker), retry_delay)
 
 
 class Hospital(models.Model):
     name = models.CharField(db_index=True, max_length=255, blank=False, null=False, )
     city = models.CharField(max_length=255, blank=False, null=False, )
 
+    objects = HospitalQuerySet.as_manager()
+
     def __repr__(self):
         return '<Hospital {name}>'.format(name=self.name, )
 
@@ -25,10 +876,15 @@ class Department(models.Model):
         on_delete=models.CASCADE,
     )
 
+    objects = DepartmentQuerySet.as_manager()
+
+    # Relations __repr__ goes through (see display.py)
+    DISPLAY_RELATED = ('hospital', )
+
     def __repr__(self):
-        return '<Department {department_name} in hospital {hospital}>'.format(
+        return '<Department {department_name} in hospital {hospital!r}>'.format(
             department_name=self.name,
-            hospital=self.hospital,
+            hospital=get_display_related(self, 'hospital'),
         )
 
     def __unicode__(self):
@@ -40,14 +896,35 @@ class Person(models.Model):
     GENDER_FEMALE = 'Female'
     GENDER_UNDEFINED = 'Other'
 
+    # Stored codes of the genders (see fields.py)
+    GENDER_CODES = {
+        GENDER_MALE: 0,
+        GENDER_FEMALE: 1,
+        GENDER_UNDEFINED: 2,
+    }
+
+    RISK_GROUP_MIN_AGE = 60
+
     name = models.CharField(db_index=True, max_length=255, blank=False, null=False)
     age = models.PositiveSmallIntegerField(null=False)
-    gender = models.CharField(max_length=6, blank=False, null=False, choices=(
+    gender = CodedChoiceField(blank=False, null=False, codes=GENDER_CODES, choices=(
         (GENDER_MALE, GENDER_MALE),
         (GENDER_FEMALE, GENDER_FEMALE),
         (GENDER_UNDEFINED, GENDER_UNDEFINED),
     ))
 
+    # Maintained by signals (see signals.py) from the person's hospital jobs
+    num_of_jobs = models.PositiveIntegerField(default=0)
+    positions_mask = models.PositiveSmallIntegerField(default=0)  # HospitalWorker.POSITION_MASKS of the jobs
+
+    objects = PersonQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Persons with multiple jobs (in given positions)
+            models.Index(fields=['positions_mask', 'num_of_jobs'], name='covid_person_jobs_idx'),
+        ]
+
     def __repr__(self):
         return '<Person {name} age {age}>'.format(name=self.name, age=self.age)
 
@@ -59,6 +936,12 @@ class HospitalWorker(models.Model):
     POSITION_DOCTOR = 'Doctor'
     POSITION_NURSE = 'Nurse'
 
+    # Stored codes of the positions (see fields.py)
+    POSITION_CODES = {
+        POSITION_DOCTOR: 0,
+        POSITION_NURSE: 1,
+    }
+
     person = models.ForeignKey(
         to=Person,
         related_name='hospital_jobs',
@@ -72,15 +955,33 @@ class HospitalWorker(models.Model):
         null=False,
         on_delete=models.CASCADE,
     )
-    position = models.CharField(max_length=255, blank=False, null=False, choices=(
+    position = CodedChoiceField(blank=False, null=False, codes=POSITION_CODES, choices=(
         (POSITION_DOCTOR, POSITION_DOCTOR),
         (POSITION_NURSE, POSITION_NURSE),
     ))
 
+    # Bit of each position in Person.positions_mask
+    POSITION_MASKS = {
+        POSITION_DOCTOR: 1,
+        POSITION_NURSE: 2,
+    }
+
+    objects = HospitalWorkerQuerySet.as_manager()
+
+    # Relations __repr__ goes through (see display.py)
+    DISPLAY_RELATED = ('person', 'department__hospital', )
+
+    @classmethod
+    def get_positions_mask(cls, positions):
+        mask = 0
+        for position in set(positions):
+            mask |= cls.POSITION_MASKS[position]
+        return mask
+
     def __repr__(self):
-        return '<Hospital worker {person}, working in {department} position {position}>'.format(
-            person=self.person,
-            department=self.department,
+        return '<Hospital worker {person!r}, working in {department!r} position {position}>'.format(
+            person=get_display_related(self, 'person'),
+            department=get_display_related(self, 'department'),
             position=self.position,
         )
 
@@ -103,11 +1004,24 @@ class Patient(models.Model):
         blank=False,
         on_delete=models.CASCADE,
     )
+    # Maintained by signals (see signals.py) so "current state" queries don't scan the history.
+    last_medical_examination_result = models.ForeignKey(
+        to='MedicalExaminationResult',
+        related_name='+',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+
+    objects = PatientQuerySet.as_manager()
+
+    # Relations __repr__ goes through (see display.py)
+    DISPLAY_RELATED = ('person', 'department__hospital', )
 
     def __repr__(self):
-        return '<Patient {person} in {department}>'.format(
-            person=self.person,
-            department=self.department
+        return '<Patient {person!r} in {department!r}>'.format(
+            person=get_display_related(self, 'person'),
+            department=get_display_related(self, 'department'),
         )
 
     def __unicode__(self):
@@ -120,6 +1034,16 @@ class MedicalExaminationResult(models.Model):
     RESULT_BOT = 'Botism'
     RESULT_DEAD = 'Dead'
 
+    SICK_RESULTS = (RESULT_CORONA, RESULT_BOT, )
+
+    # Stored codes of the results (see fields.py), also the codes of the examination arrays (see arrays.py)
+    RESULT_CODES = {
+        RESULT_HEALTHY: 0,
+        RESULT_CORONA: 1,
+        RESULT_BOT: 2,
+        RESULT_DEAD: 3,
+    }
+
     time = models.DateTimeField(auto_now=False, auto_now_add=False, )
     examined_by = models.ForeignKey(
         to=HospitalWorker,
@@ -127,6 +1051,7 @@ class MedicalExaminationResult(models.Model):
         null=False,
         blank=False,
         on_delete=models.CASCADE,
+        db_index=False,  # Covered by the composite indexes in Meta
     )
     patient = models.ForeignKey(
         to=Patient,
@@ -134,19 +1059,394 @@ class MedicalExaminationResult(models.Model):
         null=False,
         blank=False,
         on_delete=models.CASCADE,
+        db_index=False,  # Covered by the composite indexes in Meta
     )
-    result = models.CharField(max_length=255, blank=False, null=False, choices=(
+    result = CodedChoiceField(blank=False, null=False, codes=RESULT_CODES, choices=(
         (RESULT_HEALTHY, RESULT_HEALTHY),
         (RESULT_CORONA, RESULT_CORONA),
         (RESULT_BOT, RESULT_BOT),
         (RESULT_DEAD, RESULT_DEAD),
     ))
 
+    objects = MedicalExaminationResultQuerySet.as_manager()
+
+    # Relations __repr__ goes through (see display.py)
+    DISPLAY_RELATED = (
+        'patient__person',
+        'patient__department__hospital',
+        'examined_by__person',
+        'examined_by__department__hospital',
+    )
+
+    class Meta:
+        indexes = [
+            # Latest result per patient, "Corona then Dead" and per patient counts
+            models.Index(fields=['patient', 'time'], name='covid_mer_patient_time_idx'),
+            # Examinations performed by a worker
+            models.Index(fields=['examined_by', 'time'], name='covid_mer_examiner_time_idx'),
+            # Filter by results options, covering the patient lookup
+            models.Index(fields=['result', 'patient'], name='covid_mer_result_patient_idx'),
+            # Examinations of a day (daily rollups)
+            models.Index(fields=['time'], name='covid_mer_time_idx'),
+        ]
+
+    def __repr__(self):
+        return '<Medical examination result of {patient!r}, examined_by {examined_by!r}>'.format(
+            patient=get_display_related(self, 'patient'),
+            examined_by=get_display_related(self, 'examined_by'),
+        )
+
+    def __unicode__(self):
+        return repr(self)
+
+
+class HospitalDailyStats(models.Model):
+    """Per hospital per day rollup of the medical examinations, kept up to date by signals (see signals.py)."""
+    METRICS = (
+        'num_of_new_corona_cases',
+        'num_of_deaths',
+        'num_of_deaths_after_corona',
+        'num_of_healthy_results',
+        'num_of_active_workers_in_risk_of_corona',
+    )
+
+    hospital = models.ForeignKey(
+        to=Hospital,
+        related_name='daily_stats',
+        null=False,
+        blank=False,
+        on_delete=models.CASCADE,
+    )
+    date = models.DateField(null=False, )
+    num_of_new_corona_cases = models.PositiveIntegerField(default=0, )
+    num_of_deaths = models.PositiveIntegerField(default=0, )
+    num_of_deaths_after_corona = models.PositiveIntegerField(default=0, )
+    num_of_healthy_results = models.PositiveIntegerField(default=0, )
+    num_of_active_workers_in_risk_of_corona = models.PositiveIntegerField(default=0, )
+
+    objects = HospitalDailyStatsQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (('hospital', 'date'), )
+
+    def __repr__(self):
+        return '<Hospital daily stats of hospital {hospital_id} on {date}>'.format(
+            hospital_id=self.hospital_id,
+            date=self.date,
+        )
+
+    def __unicode__(self):
+        return repr(self)
+
+
+class EpidemicCurveBucket(models.Model):
+    """
+    A completed bucket of the epidemic curve of a department, materialized by `get_series`.
+
+    The row without a department holds the totals of the bucket and marks it as materialized. Kept
+    correct by dropping the buckets of the changed examinations (see signals.py).
+    """
+    PERIOD_DAY = 'day'
+    PERIOD_WEEK = 'week'
+    PERIODS = (PERIOD_DAY, PERIOD_WEEK, )
+    GROUP_BY = ('department', 'hospital', None, )
+
+    METRICS = (
+        'num_of_new_corona_cases',
+        'num_of_deaths',
+        'num_of_recoveries',
+    )
+
+    period = models.CharField(max_length=4, blank=False, null=False, choices=(
+        (PERIOD_DAY, PERIOD_DAY),
+        (PERIOD_WEEK, PERIOD_WEEK),
+    ))
+    start = models.DateField(null=False, )
+    department = models.ForeignKey(
+        to=Department,
+        related_name='epidemic_curve_buckets',
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+    )
+    num_of_new_corona_cases = models.PositiveIntegerField(default=0, )
+    num_of_deaths = models.PositiveIntegerField(default=0, )
+    num_of_recoveries = models.PositiveIntegerField(default=0, )
+
+    objects = EpidemicCurveBucketQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (('period', 'start', 'department'), )
+
+    @classmethod
+    def get_bucket_start(cls, period, date):
+        if period == cls.PERIOD_WEEK:
+            return date - datetime.timedelta(days=date.weekday())
+        return date
+
+    @classmethod
+    def get_bucket_end(cls, period, start):
+        return start + datetime.timedelta(days=7 if period == cls.PERIOD_WEEK else 1)
+
+    @classmethod
+    def get_bucket_starts(cls, period, start, end):
+        while start < end:
+            yield start
+            start = cls.get_bucket_end(period, start)
+
+    def __repr__(self):
+        return '<Epidemic curve {period} bucket of department {department_id} from {start}>'.format(
+            period=self.period,
+            department_id=self.department_id,
+            start=self.start,
+        )
+
+    def __unicode__(self):
+        return repr(self)
+
+
+class PersonHealthState(models.Model):
+    """
+    The health state of a person, advanced by each new examination of the person (see signals.py).
+
+    The examinations of the person in all its departments are one history, in (time, id) order. An
+    examination arriving out of order, changed or deleted reprocesses the history of its person only.
+    """
+    STATE_HEALTHY = 'Healthy'
+    STATE_SICK = 'Sick'
+    STATE_RECOVERED = 'Recovered'
+    STATE_DEAD = 'Dead'
+    STATE_DEAD_FROM_CORONA = 'Dead from Corona'
+
+    # Stored codes of the states (see fields.py)
+    STATE_CODES = {
+        STATE_HEALTHY: 0,
+        STATE_SICK: 1,
+        STATE_RECOVERED: 2,
+        STATE_DEAD: 3,
+        STATE_DEAD_FROM_CORONA: 4,
+    }
+
+    # The fields derived from the history
+    STATE_FIELDS = (
+        'state',
+        'last_result',
+        'last_examination_id',
+        'last_examination_time',
+        'first_corona_time',
+        'death_time',
+        'num_of_examinations',
+        'num_of_infections',
+        'num_of_recoveries',
+    )
+
+    person = models.OneToOneField(
+        to=Person,
+        related_name='health_state',
+        primary_key=True,
+        on_delete=models.CASCADE,
+    )
+    state = CodedChoiceField(blank=False, null=False, codes=STATE_CODES, choices=(
+        (STATE_HEALTHY, STATE_HEALTHY),
+        (STATE_SICK, STATE_SICK),
+        (STATE_RECOVERED, STATE_RECOVERED),
+        (STATE_DEAD, STATE_DEAD),
+        (STATE_DEAD_FROM_CORONA, STATE_DEAD_FROM_CORONA),
+    ))
+    last_result = CodedChoiceField(
+        blank=False,
+        null=False,
+        codes=MedicalExaminationResult.RESULT_CODES,
+        choices=MedicalExaminationResult._meta.get_field('result').choices,
+    )
+    last_examination = models.ForeignKey(
+        to=MedicalExaminationResult,
+        related_name='+',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    last_examination_time = models.DateTimeField(null=False, )
+    first_corona_time = models.DateTimeField(null=True, blank=True, )
+    death_time = models.DateTimeField(null=True, blank=True, )
+    num_of_examinations = models.PositiveIntegerField(default=0, )
+    # Sick results following no result or a non sick one
+    num_of_infections = models.PositiveIntegerField(default=0, )
+    # Healthy results following a sick result
+    num_of_recoveries = models.PositiveIntegerField(default=0, )
+
+    objects = PersonHealthStateQuerySet.as_manager()
+
+    # Relations __repr__ goes through (see display.py)
+    DISPLAY_RELATED = ('person', )
+
+    class Meta:
+        indexes = [
+            # Persons in a state (the primary key is the person)
+            models.Index(fields=['state'], name='covid_health_state_idx'),
+        ]
+
+    @classmethod
+    def get_state(cls, last_result, previous_result, num_of_infections):
+        if last_result in MedicalExaminationResult.SICK_RESULTS:
+            return cls.STATE_SICK
+        if last_result == MedicalExaminationResult.RESULT_DEAD:
+            if previous_result == MedicalExaminationResult.RESULT_CORONA:
+                return cls.STATE_DEAD_FROM_CORONA
+            return cls.STATE_DEAD
+        return cls.STATE_RECOVERED if num_of_infections else cls.STATE_HEALTHY
+
+    def is_followed_by(self, time, examination_id):
+        """Whether an examination comes after the last one applied."""
+        if self.last_examination_id is None:
+            return False
+        return (self.last_examination_time, self.last_examination_id) < (time, examination_id)
+
+    def apply(self, time, examination_id, result):
+        """Advance the state by the person's next examination."""
+        previous_result = self.last_result
+        was_sick = previous_result in MedicalExaminationResult.SICK_RESULTS
+        if result in MedicalExaminationResult.SICK_RESULTS and not was_sick:
+            self.num_of_infections += 1
+        if result == MedicalExaminationResult.RESULT_HEALTHY and was_sick:
+            self.num_of_recoveries += 1
+        if result == MedicalExaminationResult.RESULT_CORONA and self.first_corona_time is None:
+            self.first_corona_time = time
+        if result == MedicalExaminationResult.RESULT_DEAD and self.death_time is None:
+            self.death_time = time
+
+        self.state = self.get_state(result, previous_result, self.num_of_infections)
+        self.last_result = result
+        self.last_examination_id = examination_id
+        self.last_examination_time = time
+        self.num_of_examinations += 1
+
+    def get_state_values(self):
+        return {name: getattr(self, name) for name in self.STATE_FIELDS}
+
     def __repr__(self):
-        return '<Medical examination result of {patient}, examined_by {examined_by}>'.format(
-            patient=self.patient,
-            examined_by=self.examined_by,
+        return '<Health state of {person!r}: {state}>'.format(
+            person=get_display_related(self, 'person'),
+            state=self.state,
+        )
+
+    def __unicode__(self):
+        return repr(self)
+
+
+class ReportJob(models.Model):
+    """
+    A report queued by a client and computed by the report workers (see reports.py).
+
+    Clients submit a report and poll the job for its result instead of computing it in the request.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+
+    # Stored codes of the statuses (see fields.py)
+    STATUS_CODES = {
+        STATUS_PENDING: 0,
+        STATUS_RUNNING: 1,
+        STATUS_SUCCEEDED: 2,
+        STATUS_FAILED: 3,
+    }
+
+    report = models.CharField(max_length=64, blank=False, null=False, )
+    params = models.TextField(default='{}', )  # JSON
+    priority = models.SmallIntegerField(default=0, )  # Higher first
+    status = CodedChoiceField(blank=False, null=False, default=STATUS_PENDING, codes=STATUS_CODES, choices=(
+        (STATUS_PENDING, STATUS_PENDING),
+        (STATUS_RUNNING, STATUS_RUNNING),
+        (STATUS_SUCCEEDED, STATUS_SUCCEEDED),
+        (STATUS_FAILED, STATUS_FAILED),
+    ))
+    # Only this user polls the job, None for the jobs submitted by code
+    submitted_by = models.ForeignKey(
+        to=settings.AUTH_USER_MODEL,
+        related_name='report_jobs',
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+    )
+    # Hash of the report, params and user while the job is pending or running, identical submissions get this job
+    dedup_key = models.CharField(max_length=40, unique=True, null=True, blank=True, )
+    attempts = models.PositiveSmallIntegerField(default=0, )
+    max_attempts = models.PositiveSmallIntegerField(default=3, )
+    created_at = models.DateTimeField(null=False, )
+    # Not claimed before (retries back off)
+    available_at = models.DateTimeField(null=False, )
+    started_at = models.DateTimeField(null=True, blank=True, )
+    finished_at = models.DateTimeField(null=True, blank=True, )
+    worker = models.CharField(max_length=255, blank=True, )
+    # End of the running job's lease, requeued after it
+    locked_until = models.DateTimeField(null=True, blank=True, )
+    result = models.TextField(null=True, blank=True, )  # JSON
+    error = models.TextField(blank=True, )
+
+    objects = ReportJobQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # The next job to claim, and the expired leases
+            models.Index(fields=['status', '-priority', 'available_at'], name='covid_report_job_claim_idx'),
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_SUCCEEDED, self.STATUS_FAILED)
+
+    def get_params(self):
+        return json.loads(self.params)
+
+    def get_result(self):
+        return json.loads(self.result) if self.result is not None else None
+
+    def _finish(self, worker, **values):
+        """Update the job if `worker` still holds it (its lease may have expired meanwhile), returns whether it did."""
+        is_updated = bool(type(self).objects.using(self._state.db).filter(
+            pk=self.pk,
+            status=self.STATUS_RUNNING,
+            worker=worker,
+        ).update(**values))
+        if is_updated:
+            for name, value in values.items():
+                setattr(self, name, value)
+        return is_updated
+
+    def succeed(self, worker, result):
+        return self._finish(
+            worker,
+            status=self.STATUS_SUCCEEDED,
+            result=json.dumps(result, cls=DjangoJSONEncoder),
+            dedup_key=None,
+            finished_at=timezone.now(),
+            locked_until=None,
+        )
+
+    def fail(self, worker, error, retry_delay):
+        """Retry the job after retry_delay (doubled by every attempt), or fail it for good out of attempts."""
+        now = timezone.now()
+        if self.attempts < self.max_attempts:
+            return self._finish(
+                worker,
+                status=self.STATUS_PENDING,
+                error=error,
+                available_at=now + retry_delay * 2 ** (self.attempts - 1),
+                locked_until=None,
+            )
+        return self._finish(
+            worker,
+            status=self.STATUS_FAILED,
+            error=error,
+            dedup_key=None,
+            finished_at=now,
+            locked_until=None,
         )
 
+    def __repr__(self):
+        return '<Report job {id} {report} {status}>'.format(id=self.pk, report=self.report, status=self.status)
+
     def __unicode__(self):
         return repr(self)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Pagination of very large tables without a COUNT(*) over the whole table.
+
+Unfiltered querysets of large tables are counted from the table size estimate, filtered ones are counted
+up to a limit (a bounded index/table range instead of every matching row).
+"""
+from __future__ import unicode_literals
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+
+def estimate_table_size(model, using):
+    """
+    Cheap estimate of the number of rows of a model's table, None when there's no cheap way.
+
+    PostgreSQL keeps one in its statistics. On SQLite the span of the (integer, primary key indexed)
+    ids is used, the tables are append mostly so it's close.
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+            row = cursor.fetchone()
+        return int(row[0]) if row is not None and row[0] > 0 else None
+
+    if connection.vendor == 'sqlite' and model._meta.pk.get_internal_type() == 'AutoField':
+        # Separate subqueries, SQLite only reads MIN/MAX from the index when it's alone in its query
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT (SELECT MIN({pk}) FROM {table}), (SELECT MAX({pk}) FROM {table})'.format(
+                pk=connection.ops.quote_name(model._meta.pk.column),
+                table=connection.ops.quote_name(model._meta.db_table),
+            ))
+            min_id, max_id = cursor.fetchone()
+        return 0 if max_id is None else max_id - min_id + 1
+
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator counting large querysets approximately.
+
+    Unfiltered querysets whose table is estimated above ESTIMATE_FROM rows report the estimate, other
+    querysets are counted exactly up to MAX_EXACT_COUNT rows (pages past it aren't reachable).
+    """
+    ESTIMATE_FROM = 100000
+    MAX_EXACT_COUNT = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not isinstance(queryset, QuerySet):
+            return super(EstimatedCountPaginator, self).count
+
+        if not queryset.query.where and not queryset.query.distinct and queryset.query.can_filter():
+            estimate = estimate_table_size(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.ESTIMATE_FROM:
+                return estimate
+
+        return queryset.order_by()[:self.MAX_EXACT_COUNT].count()
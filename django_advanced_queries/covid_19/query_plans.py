@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from django_advanced_queries.covid_19.models import MedicalExaminationResult
+
+# "SCAN TABLE x" on older SQLite versions, "SCAN x" on newer ones
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(?P<table>\S+)(?P<details>.*)$')
+# Tables inside Django generated subqueries are aliased U0, V0, W0...
+SUBQUERY_ALIAS_RE = re.compile(r'^[A-Z]\d+$')
+
+
+def get_query_plans(func, *args, **kwargs):
+    """Run `func` and return [(sql, [plan detail, ...]), ...] for every query it executed (SQLite only)."""
+    with CaptureQueriesContext(connection) as context:
+        func(*args, **kwargs)
+
+    query_plans = []
+    with connection.cursor() as cursor:
+        for query in context.captured_queries:
+            cursor.execute('EXPLAIN QUERY PLAN {sql}'.format(sql=query['sql']))
+            query_plans.append((query['sql'], [row[-1] for row in cursor.fetchall()]))
+
+    return query_plans
+
+
+def find_full_table_scans(query_plans):
+    """
+    Return the plan lines that read a whole table without an index.
+
+    Scanning the outer table a manager method iterates over (hospitals, departments...) is expected,
+    but medical examination results must always be searched through an index, and so must any table
+    inside a subquery.
+    """
+    full_table_scans = []
+    for sql, plan in query_plans:
+        for detail in plan:
+            match = SCAN_RE.match(detail)
+            if match is None or 'INDEX' in match.group('details'):
+                continue
+
+            table = match.group('table')
+            if table == MedicalExaminationResult._meta.db_table or SUBQUERY_ALIAS_RE.match(table):
+                full_table_scans.append((sql, detail))
+
+    return full_table_scans
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Background computation of the heavy covid_19 reports.
+
+A client submits a report (`submit_report()`, or POST api/reports/) and polls its ReportJob (GET
+api/reports/<id>/) instead of computing it in the request. The params are checked against the report's
+limits before the job is queued. Identical submissions (same report, params and user) pending or running
+share a single job.
+
+`python manage.py run_report_worker` runs `ReportWorker`: its threads claim the next job (highest
+priority, then oldest), run the report and store its JSON result. A failing report is retried with an
+exponential back off up to the job's max_attempts, and a job whose worker died (its lease expired) is
+requeued the same way.
+"""
+from __future__ import unicode_literals
+
+import collections
+import datetime
+import logging
+import numbers
+import os
+import socket
+import threading
+import time
+import traceback
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils import six
+from django.utils.dateparse import parse_datetime
+
+from django_advanced_queries.covid_19.models import Hospital, HospitalWorker, Person, ReportJob
+from django_advanced_queries.covid_19.tracing import trace_exposures
+
+logger = logging.getLogger(__name__)
+
+# Seconds
+DEFAULT_LEASE = 30 * 60
+DEFAULT_RETRY_DELAY = 30
+DEFAULT_POLL_INTERVAL = 1
+
+# Limits of the submitted params, the cost of an exposures report grows with both
+MAX_EXPOSURES_SEEDS = 100
+MAX_EXPOSURES_HOPS = 5
+
+# `function(**params)` returns the JSON serializable result, `params` maps the names it accepts to their
+# checks, `check(name, value)` returns the value to store or raises ValueError
+Report = collections.namedtuple('Report', ('function', 'params'))
+
+
+def check_int(min_value, max_value=None):
+    def check(name, value):
+        if not isinstance(value, numbers.Integral) or isinstance(value, bool):
+            raise ValueError('{name} must be an integer'.format(name=name))
+        if value < min_value or (max_value is not None and value > max_value):
+            raise ValueError('{name} must be between {min_value} and {max_value}'.format(
+                name=name,
+                min_value=min_value,
+                max_value=max_value if max_value is not None else 'any',
+            ))
+        return value
+    return check
+
+
+def check_positive_number(name, value):
+    if not isinstance(value, numbers.Real) or isinstance(value, bool) or value <= 0:
+        raise ValueError('{name} must be a positive number'.format(name=name))
+    return value
+
+
+def check_bool(name, value):
+    if not isinstance(value, bool):
+        raise ValueError('{name} must be a boolean'.format(name=name))
+    return value
+
+
+def check_list(check_item, max_length=None):
+    def check(name, value):
+        if not isinstance(value, list):
+            raise ValueError('{name} must be a list'.format(name=name))
+        if max_length is not None and len(value) > max_length:
+            raise ValueError('{name} must have at most {max_length} items'.format(name=name, max_length=max_length))
+        return [check_item(name, item) for item in value]
+    return check
+
+
+def check_choice(choices):
+    def check(name, value):
+        if not isinstance(value, six.string_types) or value not in choices:
+            raise ValueError('{name} must be one of {choices}'.format(name=name, choices=', '.join(sorted(choices))))
+        return value
+    return check
+
+
+def check_time(name, value):
+    # Stored as submitted, parsed by the report
+    if not isinstance(value, six.string_types):
+        raise ValueError('{name} must be an ISO datetime'.format(name=name))
+    _parse_time(value)
+    return value
+
+
+def get_persons_with_multiple_jobs(jobs=None):
+    return list(Person.objects.persons_with_multiple_jobs(jobs=jobs).values('id', 'name', 'num_of_jobs'))
+
+
+def get_dead_from_corona_ranking(limit=None, from_health_state=False):
+    """The hospitals by number of patients dead from corona, most first."""
+    hospitals = sorted(
+        Hospital.objects.annotate_by_num_of_dead_from_corona(from_health_state=from_health_state),
+        key=lambda hospital: (-hospital.num_of_dead_from_corona, hospital.pk),
+    )
+    return [
+        {
+            'id': hospital.pk,
+            'name': hospital.name,
+            'city': hospital.city,
+            'num_of_dead_from_corona': hospital.num_of_dead_from_corona,
+        }
+        for hospital in hospitals[:limit]
+    ]
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError('"{value}" is not an ISO datetime'.format(value=value))
+    return parsed
+
+
+def get_exposures(hospital_worker_ids, max_hops=3, window_hours=None, start_time=None, end_time=None):
+    """The full tracing of the persons exposed by the hospital workers, see `tracing.trace_exposures`."""
+    exposures = trace_exposures(
+        HospitalWorker.objects.filter(pk__in=hospital_worker_ids),
+        max_hops=int(max_hops),
+        window=datetime.timedelta(hours=window_hours) if window_hours is not None else None,
+        start_time=_parse_time(start_time),
+        end_time=_parse_time(end_time),
+    )
+    return [exposure._asdict() for exposure in exposures]
+
+
+REPORTS = {
+    'persons_with_multiple_jobs': Report(get_persons_with_multiple_jobs, {
+        'jobs': check_list(check_choice(HospitalWorker.POSITION_MASKS), max_length=len(HospitalWorker.POSITION_MASKS)),
+    }),
+    'dead_from_corona_ranking': Report(get_dead_from_corona_ranking, {
+        'limit': check_int(1),
+        'from_health_state': check_bool,
+    }),
+    'exposures': Report(get_exposures, {
+        'hospital_worker_ids': check_list(check_int(1), max_length=MAX_EXPOSURES_SEEDS),
+        'max_hops': check_int(1, MAX_EXPOSURES_HOPS),
+        'window_hours': check_positive_number,
+        'start_time': check_time,
+        'end_time': check_time,
+    }),
+}
+
+
+def submit_report(report, params=None, priority=0, max_attempts=3, submitted_by=None, using=DEFAULT_DB_ALIAS):
+    """
+    The ReportJob computing the report, raising ValueError on an unknown report or params, or params
+    beyond the report's limits.
+    """
+    if report not in REPORTS:
+        raise ValueError('Unknown report {report}'.format(report=report))
+    if params is None:
+        params = {}
+    if not isinstance(params, dict):
+        raise ValueError('The params must be an object')
+    checks = REPORTS[report].params
+    unknown_params = set(params) - set(checks)
+    if unknown_params:
+        raise ValueError('Unknown params of {report}: {params}'.format(
+            report=report,
+            params=', '.join(sorted(unknown_params)),
+        ))
+    params = {name: checks[name](name, value) for name, value in params.items()}
+    return ReportJob.objects.using(using).submit(
+        report,
+        params,
+        priority=priority,
+        max_attempts=max_attempts,
+        submitted_by=submitted_by,
+    )
+
+
+def get_job_record(job):
+    """The job as polled by the clients, with its result once succeeded or its error once failed."""
+    record = {
+        'id': job.pk,
+        'report': job.report,
+        'params': job.get_params(),
+        'priority': job.priority,
+        'status': job.status,
+        'attempts': job.attempts,
+        'created_at': job.created_at,
+        'finished_at': job.finished_at,
+    }
+    if job.status == ReportJob.STATUS_SUCCEEDED:
+        record['result'] = job.get_result()
+    elif job.status == ReportJob.STATUS_FAILED:
+        record['error'] = job.error
+    return record
+
+
+class ReportWorker(object):
+    """
+    Runs the report jobs on `num_of_threads` threads, each with its own connection.
+
+    With a single thread the jobs run in the calling thread.
+    """
+
+    def __init__(self, name=None, num_of_threads=1, lease=DEFAULT_LEASE, retry_delay=DEFAULT_RETRY_DELAY,
+                 poll_interval=DEFAULT_POLL_INTERVAL, using=DEFAULT_DB_ALIAS):
+        self.name = name or '{host}:{pid}'.format(host=socket.gethostname(), pid=os.getpid())
+        self.num_of_threads = num_of_threads
+        self.lease = datetime.timedelta(seconds=lease)
+        self.retry_delay = datetime.timedelta(seconds=retry_delay)
+        self.poll_interval = poll_interval
+        self.using = using
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self.num_of_succeeded = 0
+        self.num_of_failed = 0
+
+    def run_job(self, job, worker):
+        """Run the claimed job and store its result, or its error for the retry."""
+        report = REPORTS.get(job.report)
+        try:
+            if report is None:
+                raise ValueError('Unknown report {report}'.format(report=job.report))
+            result = report.function(**job.get_params())
+        except Exception:
+            logger.exception('Report job %s failed', job.pk)
+            job.fail(worker, traceback.format_exc(), self.retry_delay)
+            is_succeeded = False
+        else:
+            is_succeeded = job.succeed(worker, result)
+
+        with self._lock:
+            if is_succeeded:
+                self.num_of_succeeded += 1
+            else:
+                self.num_of_failed += 1
+
+    def _run_jobs(self, worker, burst, max_jobs):
+        jobs = ReportJob.objects.using(self.using)
+        while not self.stopped.is_set():
+            with self._lock:
+                if max_jobs is not None and self.num_of_succeeded + self.num_of_failed >= max_jobs:
+                    return
+            try:
+                jobs.requeue_expired(self.retry_delay)
+                job = jobs.claim(worker, self.lease)
+                if job is not None:
+                    self.run_job(job, worker)
+            except DatabaseError:
+                # As "database is locked": a job that wasn't claimed stays pending, a claimed one whose result
+                # wasn't stored is requeued once its lease expires
+                logger.exception('Worker %s failed to update the jobs', worker)
+                self.stopped.wait(self.poll_interval)
+                continue
+
+            if job is None:
+                if burst:
+                    return
+                self.stopped.wait(self.poll_interval)
+
+    def _run_thread(self, worker, burst, max_jobs):
+        try:
+            self._run_jobs(worker, burst, max_jobs)
+        finally:
+            # The connections of a thread are its own
+            connections.close_all()
+
+    def run(self, burst=False, max_jobs=None):
+        """Run jobs until stopped (`stop()`), or until the queue is empty with `burst`, or after `max_jobs`."""
+        if self.num_of_threads == 1:
+            self._run_jobs(self.name, burst, max_jobs)
+            return
+
+        threads = [
+            threading.Thread(
+                target=self._run_thread,
+                args=('{name}/{index}'.format(name=self.name, index=index), burst, max_jobs),
+            )
+            for index in range(self.num_of_threads)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            # Joined with a timeout, a plain join() doesn't let KeyboardInterrupt through
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(self.poll_interval)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """The threads finish their current job and exit."""
+        self.stopped.set()
+
+
+def wait_for_job(job, timeout=None, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Poll the job until it's finished (or the timeout, in seconds), returns it reloaded."""
+    deadline = time.time() + timeout if timeout is not None else None
+    while True:
+        job = ReportJob.objects.using(job._state.db).get(pk=job.pk)
+        if job.is_finished or (deadline is not None and time.time() >= deadline):
+            return job
+        time.sleep(poll_interval)
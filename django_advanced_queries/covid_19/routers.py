@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Read replica routing of the analytic manager methods.
+
+QuerySet methods decorated with `analytic` mark their queryset, and `ReadReplicaRouter` sends the
+reads of marked querysets to one of the COVID_19_READ_REPLICAS. Everything else - plain reads and
+all the writes - stays on the primary (`default`). An explicit `.using()` always wins.
+
+Reads that must see the caller's own writes are pinned to the primary with `pin_to_primary()`,
+`PinPrimaryMiddleware` does it for unsafe requests and the requests following them for
+COVID_19_REPLICATION_LAG seconds.
+"""
+from __future__ import unicode_literals
+
+import functools
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+ANALYTIC_HINT = 'covid_19_analytic'
+PIN_PRIMARY_COOKIE = 'covid_19_pin_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE', )
+
+_local = threading.local()
+
+
+def get_read_replicas():
+    return list(getattr(settings, 'COVID_19_READ_REPLICAS', []))
+
+
+def get_primary(alias):
+    """The database `alias` replicates, `alias` itself if it isn't a read replica."""
+    return DEFAULT_DB_ALIAS if alias in get_read_replicas() else alias
+
+
+def is_pinned_to_primary():
+    return getattr(_local, 'num_of_pins', 0) > 0
+
+
+@contextmanager
+def pin_to_primary():
+    """Route every read inside the block to the primary (read-after-write)."""
+    _local.num_of_pins = getattr(_local, 'num_of_pins', 0) + 1
+    try:
+        yield
+    finally:
+        _local.num_of_pins -= 1
+
+
+def analytic(method):
+    """Decorate a custom QuerySet method so its reads may be served by a read replica."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        queryset = self._clone()
+        # The hints dict is shared between clones, replace it instead of updating it
+        queryset._hints = dict(self._hints, **{ANALYTIC_HINT: True})
+        return method(queryset, *args, **kwargs)
+    return wrapper
+
+
+class ReadReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        replicas = get_read_replicas()
+        if hints.get(ANALYTIC_HINT) and replicas and not is_pinned_to_primary():
+            return random.choice(replicas)
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Without a router, saving an instance read from a replica would write to the replica
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in get_read_replicas():
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS} | set(get_read_replicas())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary
+        if db in get_read_replicas():
+            return False
+        return None
+
+
+class PinPrimaryMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        is_write = request.method not in SAFE_METHODS
+        if not is_write and PIN_PRIMARY_COOKIE not in request.COOKIES:
+            return self.get_response(request)
+
+        with pin_to_primary():
+            response = self.get_response(request)
+        if is_write:
+            response.set_cookie(PIN_PRIMARY_COOKIE, '1', max_age=getattr(settings, 'COVID_19_REPLICATION_LAG', 5))
+        return response
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Sharding of the covid_19 data by hospital (opt-in, COVID_19_SHARDS).
+
+Every shard is a database alias holding a part of the hospitals and everything beneath them - their
+departments, hospital workers, patients, examinations and rollups. A hospital lives on
+`COVID_19_SHARDS[hospital_id % len(COVID_19_SHARDS)]`, `create_hospital()` gives it the next id across
+the shards. `HospitalShardRouter` writes (and reads the relations of) a row on the shard of its hospital,
+found through the row's loaded relations, or else on the database the row came from.
+
+Persons aren't sharded: a person's jobs and patients reference its copy on their shard (`copy_person()`,
+the same id on every shard), and what the covid_19 app maintains per person (jobs, health state) covers
+that shard's rows.
+
+The manager methods spanning hospitals are decorated with `sharded(merge)`: called without an explicit
+database, they run on every shard in parallel (a thread pool, COVID_19_SHARD_WORKERS threads) and
+`merge` combines the shards' results. The ones returning a queryset return a `ShardedQuerySet` of the
+shards' querysets instead, chainable as a queryset. The methods judging persons by their rows in any
+hospital (their jobs, examinations) or taking rows of a shard are decorated with `unsharded`, they raise
+unless given a database.
+An explicit `.using()` runs them all on that database only.
+"""
+from __future__ import unicode_literals
+
+import functools
+import operator
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.query import FlatValuesListIterable, ModelIterable, ValuesIterable
+from django.utils import six
+
+from django_advanced_queries.covid_19.bulk import get_next_id
+
+# The relations from a model of a hospital's subtree up to its hospital (the last one is read by its id)
+HOSPITAL_PATHS = {
+    'Department': ('hospital', ),
+    'HospitalWorker': ('department', 'hospital', ),
+    'Patient': ('department', 'hospital', ),
+    'MedicalExaminationResult': ('patient', 'department', 'hospital', ),
+    'HospitalDailyStats': ('hospital', ),
+    'EpidemicCurveBucket': ('department', 'hospital', ),
+}
+
+
+def get_shards():
+    return list(getattr(settings, 'COVID_19_SHARDS', []))
+
+
+def get_max_workers():
+    return getattr(settings, 'COVID_19_SHARD_WORKERS', None) or len(get_shards())
+
+
+def get_shard(hospital_id):
+    shards = get_shards()
+    return shards[hospital_id % len(shards)]
+
+
+def get_hospital_id(instance):
+    """Id of the hospital owning the instance through its loaded relations (no queries), None if unknown."""
+    if instance._meta.object_name == 'Hospital':
+        return instance.pk
+
+    path = HOSPITAL_PATHS.get(instance._meta.object_name)
+    if path is None:
+        return None
+    for field_name in path[:-1]:
+        field = instance._meta.get_field(field_name)
+        if not hasattr(instance, field.get_cache_name()):
+            return None
+        instance = getattr(instance, field_name)
+        if instance is None:
+            return None
+    return getattr(instance, instance._meta.get_field(path[-1]).attname)
+
+
+def run_on_shards(function, shards=None):
+    """[function(alias) for alias in shards], run in parallel on a thread pool."""
+    shards = list(shards or get_shards())
+
+    def run(alias):
+        try:
+            return function(alias)
+        finally:
+            # The connections of a thread are its own
+            connections[alias].close()
+
+    pool = ThreadPool(min(get_max_workers(), len(shards)))
+    try:
+        return pool.map(run, shards)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def sharded(merge=None):
+    """
+    Decorate a custom QuerySet method spanning hospitals to run on every shard and `merge` the results.
+
+    Without `merge` the method returns a queryset, and a `ShardedQuerySet` of the shards' querysets is
+    returned (no query until it's evaluated).
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self._db is not None or not get_shards():
+                return method(self, *args, **kwargs)
+            if merge is None:
+                return ShardedQuerySet([method(self.using(alias), *args, **kwargs) for alias in get_shards()])
+            return merge(run_on_shards(lambda alias: method(self.using(alias), *args, **kwargs)))
+        # ShardedQuerySet chains it
+        wrapper.is_chainable = merge is None
+        return wrapper
+    return decorator
+
+
+def unsharded(method):
+    """
+    Decorate a custom QuerySet method that can't run per shard: it judges a person (copied on every shard)
+    by its rows in any hospital, or takes rows of a shard (the ids of the rows beneath the hospitals repeat
+    across the shards). Raise ValueError without an explicit database while sharding is on.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._db is None and get_shards():
+            raise ValueError('{model}.{method} spans the shards, call it on .using(<shard>)'.format(
+                model=self.model.__name__,
+                method=method.__name__,
+            ))
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ShardedQuerySet(object):
+    """
+    The querysets of a sharded method on every shard, chained and evaluated together.
+
+    Chaining a queryset method (filter(), order_by(), values_list()..., and the sharded custom methods)
+    applies it to every shard's queryset. Evaluating it runs them on the thread pool and merges the rows
+    in the queryset's ordering, by id if unordered - the order_by() fields must be fields of the rows (no
+    lookups of relations or expressions). count() and exists() run on every shard as well, slicing limits
+    every shard's query. Other QuerySet methods (aggregate(), update()...) are the shards' own, through
+    `querysets`.
+    """
+    CHAINED_METHODS = frozenset([
+        'all',
+        'annotate',
+        'defer',
+        'distinct',
+        'exclude',
+        'filter',
+        'only',
+        'order_by',
+        'prefetch_related',
+        'reverse',
+        'select_related',
+        'values',
+        'values_list',
+    ])
+
+    def __init__(self, querysets):
+        self.querysets = querysets
+        self._result_cache = None
+
+    @property
+    def model(self):
+        return self.querysets[0].model
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(type(self.querysets[0]), name, None)
+        if name not in self.CHAINED_METHODS and not getattr(method, 'is_chainable', False):
+            raise AttributeError('{cls}.{name} is not chainable across the shards'.format(
+                cls=type(self).__name__,
+                name=name,
+            ))
+
+        def chain(*args, **kwargs):
+            return ShardedQuerySet([getattr(queryset, name)(*args, **kwargs) for queryset in self.querysets])
+        return chain
+
+    def _get_ordering(self):
+        """[(field name, descending)] of the querysets' ordering, by id if unordered."""
+        query = self.querysets[0].query
+        ordering = list(query.order_by or (self.model._meta.ordering if query.default_ordering else ())) or ['pk']
+        for field_name in ordering:
+            if not isinstance(field_name, six.string_types) or '__' in field_name or field_name == '?':
+                raise ValueError('The rows of the shards are merged by fields of their model only')
+        # reverse()
+        descending = not query.standard_ordering
+        return [
+            (field_name[1:], not descending) if field_name.startswith('-') else (field_name, descending)
+            for field_name in ordering
+        ]
+
+    def _fetch_all(self):
+        if self._result_cache is not None:
+            return self._result_cache
+
+        ordering = self._get_ordering()
+        iterable_class = self.querysets[0]._iterable_class
+        if iterable_class is ModelIterable:
+            querysets = self.querysets
+            sort_keys = [(operator.attrgetter(field_name), descending) for field_name, descending in ordering]
+        else:
+            # Values rows, read as tuples with the ordering fields they lack and converted back once sorted
+            query = self.querysets[0].query
+            names = list(self.querysets[0]._fields or (
+                list(query.extra_select) + list(query.values_select) + list(query.annotation_select)
+            ))
+            pk_names = ('pk', self.model._meta.pk.name, self.model._meta.pk.attname)
+            row_names = list(names)
+            sort_keys = []
+            for field_name, descending in ordering:
+                if field_name not in row_names and field_name in pk_names:
+                    field_name = next((name for name in row_names if name in pk_names), field_name)
+                if field_name not in row_names:
+                    row_names.append(field_name)
+                sort_keys.append((operator.itemgetter(row_names.index(field_name)), descending))
+            querysets = [queryset.values_list(*row_names) for queryset in self.querysets]
+
+        querysets_by_alias = {queryset.db: queryset for queryset in querysets}
+        rows = [row for result in run_on_shards(
+            lambda alias: list(querysets_by_alias[alias]),
+            shards=[queryset.db for queryset in querysets],
+        ) for row in result]
+        # Stable sorts from the last field on, nulls last in ascending order (as PostgreSQL, not SQLite)
+        for get_value, descending in reversed(sort_keys):
+            rows.sort(key=lambda row: (get_value(row) is None, get_value(row)), reverse=descending)
+
+        if iterable_class is FlatValuesListIterable:
+            rows = [row[0] for row in rows]
+        elif iterable_class is ValuesIterable:
+            rows = [dict(zip(names, row)) for row in rows]
+        elif iterable_class is not ModelIterable:
+            rows = [row[:len(names)] for row in rows]
+        self._result_cache = rows
+        return rows
+
+    def __iter__(self):
+        return iter(self._fetch_all())
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def __bool__(self):
+        return bool(self._fetch_all())
+
+    __nonzero__ = __bool__
+
+    def __getitem__(self, k):
+        stop = k.stop if isinstance(k, slice) else k + 1
+        if self._result_cache is None and stop is not None and stop > 0:
+            return ShardedQuerySet([queryset[:stop] for queryset in self.querysets])._fetch_all()[k]
+        return self._fetch_all()[k]
+
+    def __repr__(self):
+        return '<{cls} {rows!r}>'.format(cls=type(self).__name__, rows=self._fetch_all())
+
+    def first(self):
+        rows = self[:1]
+        return rows[0] if rows else None
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        querysets = {queryset.db: queryset for queryset in self.querysets}
+        return sum(run_on_shards(lambda alias: querysets[alias].count(), shards=list(querysets)))
+
+    def exists(self):
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        querysets = {queryset.db: queryset for queryset in self.querysets}
+        return any(run_on_shards(lambda alias: querysets[alias].exists(), shards=list(querysets)))
+
+
+def merge_max(results):
+    values = [result for result in results if result is not None]
+    return max(values) if values else None
+
+
+def merge_max_by(attribute):
+    """The instance with the highest `attribute` among the shards' results, the first shard's on ties."""
+    def merge(results):
+        instances = [result for result in results if result is not None]
+        return max(instances, key=operator.attrgetter(attribute)) if instances else None
+    return merge
+
+
+def create_hospital(**fields):
+    """Create a hospital on its shard, with the next hospital id across the shards."""
+    from django_advanced_queries.covid_19.models import Hospital
+
+    hospital_id = max(get_next_id(Hospital, using=alias) for alias in get_shards())
+    return Hospital.objects.using(get_shard(hospital_id)).create(id=hospital_id, **fields)
+
+
+def copy_person(person, using):
+    """The copy of the person on a shard (with the same id), created if it isn't there yet."""
+    from django_advanced_queries.covid_19.models import Person
+
+    person_copy, _ = Person.objects.using(using).get_or_create(pk=person.pk, defaults={
+        'name': person.name,
+        'age': person.age,
+        'gender': person.gender,
+    })
+    return person_copy
+
+
+class HospitalShardRouter(object):
+    def _get_instance_shard(self, instance):
+        if instance is None or not get_shards():
+            return None
+        hospital_id = get_hospital_id(instance)
+        # Otherwise the database the instance came from (Django's fallback)
+        return get_shard(hospital_id) if hospital_id is not None else None
+
+    def db_for_read(self, model, **hints):
+        # Only the relations of an instance, plain reads of a shard's rows use .using() or the sharded methods
+        return self._get_instance_shard(hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self._get_instance_shard(hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        shards = get_shards()
+        if obj1._state.db in shards or obj2._state.db in shards:
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The shards hold the covid_19 tables only
+        if db in get_shards() and app_label != 'covid_19':
+            return False
+        return None
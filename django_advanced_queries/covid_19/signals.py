@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import transaction
+from django.db.models import Q, Subquery
+from django.db.models.functions import TruncDate
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from django_advanced_queries.covid_19.caching import invalidate
+from django_advanced_queries.covid_19.models import (
+    Hospital,
+    Department,
+    EpidemicCurveBucket,
+    HospitalDailyStats,
+    Person,
+    HospitalWorker,
+    MedicalExaminationResult,
+    Patient,
+    PersonHealthState,
+)
+
+
+def get_examination_relations(using, patient_id, examined_by_id):
+    """(patient's person id, patient's hospital id, examiner's hospital id) of an examination, in one query."""
+    relations = Patient.objects.using(using).filter(pk=patient_id).annotate(
+        worker_hospital=Subquery(HospitalWorker.objects.filter(pk=examined_by_id).values('department__hospital')[:1]),
+    ).values_list('person', 'department__hospital', 'worker_hospital').first()
+    return relations or (None, None, None)
+
+
+def get_hospital_daily_stats_keys(using, time, patient_id, patient_hospital_id, worker_hospital_id):
+    """(hospital id, date) rollups affected by an examination, including the one of the patient's next examination."""
+    # The next examination's previous result is this one (new corona case, death after corona), one at the
+    # same time is on the same day anyway
+    next_time = MedicalExaminationResult.objects.using(using).filter(
+        patient=patient_id,
+        time__gt=time,
+    ).order_by('time').values_list('time', flat=True).first()
+
+    keys = {(patient_hospital_id, time.date()), (worker_hospital_id, time.date())}
+    if next_time is not None:
+        keys.add((patient_hospital_id, next_time.date()))
+    return {(hospital_id, date) for hospital_id, date in keys if hospital_id is not None}
+
+
+def get_workers_hospital_daily_stats_keys(examinations):
+    """(hospital id, date) rollups counting the examiners of the examinations (their risk group)."""
+    return set(examinations.annotate(date=TruncDate('time')).order_by().values_list(
+        'examined_by__department__hospital',
+        'date',
+    ).distinct())
+
+
+@receiver(pre_save, sender=MedicalExaminationResult)
+def remember_examination_before_save(sender, instance, using, raw, **kwargs):
+    # What the examination affected before the change, a changed examination may move anywhere
+    instance._previous_hospital_daily_stats_keys = set()
+    instance._previous_person_id = None
+    if raw or instance._state.adding:
+        return
+
+    previous_values = MedicalExaminationResult.objects.using(using).filter(pk=instance.pk).values_list(
+        'time',
+        'patient',
+        'patient__person',
+        'patient__department__hospital',
+        'examined_by__department__hospital',
+    ).first()
+    if previous_values is not None:
+        time, patient_id, instance._previous_person_id, patient_hospital_id, worker_hospital_id = previous_values
+        instance._previous_hospital_daily_stats_keys = get_hospital_daily_stats_keys(
+            using,
+            time,
+            patient_id,
+            patient_hospital_id,
+            worker_hospital_id,
+        )
+
+
+@receiver(post_save, sender=MedicalExaminationResult)
+def update_examination_derived_data_on_save(sender, instance, using, created, **kwargs):
+    """
+    Update the patient's latest examination pointer, the daily stats and epidemic curve of the affected days
+    and the person's health state, all of them or none.
+    """
+    with transaction.atomic(using=using):
+        person_id, patient_hospital_id, worker_hospital_id = get_examination_relations(
+            using,
+            instance.patient_id,
+            instance.examined_by_id,
+        )
+
+        # Also refresh a patient the examination was moved away from (its pointer still references it).
+        Patient.objects.using(using).filter(
+            Q(pk=instance.patient_id) | Q(last_medical_examination_result=instance.pk)
+        ).refresh_last_medical_examination_result()
+
+        keys = getattr(instance, '_previous_hospital_daily_stats_keys', set()) | get_hospital_daily_stats_keys(
+            using,
+            instance.time,
+            instance.patient_id,
+            patient_hospital_id,
+            worker_hospital_id,
+        )
+        HospitalDailyStats.objects.using(using).refresh(keys)
+        EpidemicCurveBucket.objects.using(using).invalidate({date for _, date in keys})
+
+        if created:
+            PersonHealthState.objects.using(using).advance(instance, person_id=person_id)
+        else:
+            # Also reprocess the person the examination was moved away from
+            PersonHealthState.objects.using(using).refresh({person_id, getattr(instance, '_previous_person_id', None)})
+
+
+@receiver(post_delete, sender=MedicalExaminationResult)
+def update_examination_derived_data_on_delete(sender, instance, using, **kwargs):
+    with transaction.atomic(using=using):
+        person_id, patient_hospital_id, worker_hospital_id = get_examination_relations(
+            using,
+            instance.patient_id,
+            instance.examined_by_id,
+        )
+
+        Patient.objects.using(using).filter(pk=instance.patient_id).refresh_last_medical_examination_result()
+
+        keys = get_hospital_daily_stats_keys(
+            using,
+            instance.time,
+            instance.patient_id,
+            patient_hospital_id,
+            worker_hospital_id,
+        )
+        HospitalDailyStats.objects.using(using).refresh(keys)
+        EpidemicCurveBucket.objects.using(using).invalidate({date for _, date in keys})
+
+        PersonHealthState.objects.using(using).refresh([person_id])
+
+
+@receiver(pre_save, sender=HospitalWorker)
+def remember_person_before_save(sender, instance, using, raw, **kwargs):
+    instance._previous_person_id = None
+    instance._previous_hospital_daily_stats_keys = set()
+    if raw or instance._state.adding:
+        return
+
+    previous_values = HospitalWorker.objects.using(using).filter(pk=instance.pk).values_list(
+        'person',
+        'department',
+    ).first()
+    if previous_values is None:
+        return
+    instance._previous_person_id, previous_department_id = previous_values
+    # The days of the worker's examinations counted its previous person in its previous department's hospital
+    if (instance._previous_person_id, previous_department_id) != (instance.person_id, instance.department_id):
+        instance._previous_hospital_daily_stats_keys = get_workers_hospital_daily_stats_keys(
+            MedicalExaminationResult.objects.using(using).filter(examined_by=instance.pk),
+        )
+
+
+@receiver(post_save, sender=HospitalWorker)
+def update_person_jobs_on_save(sender, instance, using, **kwargs):
+    # Also refresh the person the job was moved away from
+    Person.objects.using(using).filter(
+        pk__in={instance.person_id, getattr(instance, '_previous_person_id', None)} - {None},
+    ).refresh_jobs()
+
+
+@receiver(post_save, sender=HospitalWorker)
+def update_hospital_daily_stats_on_worker_save(sender, instance, using, **kwargs):
+    """Recount the risk group on the days of the examinations of a worker moved to another person or department."""
+    keys = getattr(instance, '_previous_hospital_daily_stats_keys', set())
+    if keys:
+        HospitalDailyStats.objects.using(using).refresh(keys | get_workers_hospital_daily_stats_keys(
+            MedicalExaminationResult.objects.using(using).filter(examined_by=instance.pk),
+        ))
+
+
+@receiver(post_delete, sender=HospitalWorker)
+def update_person_jobs_on_delete(sender, instance, using, **kwargs):
+    # The worker's examinations are deleted along, their receivers refresh the daily stats of their days
+    Person.objects.using(using).filter(pk=instance.person_id).refresh_jobs()
+
+
+@receiver(pre_save, sender=Person)
+def remember_age_before_save(sender, instance, using, raw, **kwargs):
+    instance._previous_age = None
+    if raw or instance._state.adding:
+        return
+
+    instance._previous_age = Person.objects.using(using).filter(pk=instance.pk).values_list('age', flat=True).first()
+
+
+@receiver(post_save, sender=Person)
+def update_hospital_daily_stats_on_age_change(sender, instance, using, **kwargs):
+    """Recount the risk group on the days of the person's examinations when it enters or leaves it."""
+    previous_age = getattr(instance, '_previous_age', None)
+    if previous_age is None:
+        return
+    if (previous_age >= Person.RISK_GROUP_MIN_AGE) != (instance.age >= Person.RISK_GROUP_MIN_AGE):
+        HospitalDailyStats.objects.using(using).refresh(get_workers_hospital_daily_stats_keys(
+            MedicalExaminationResult.objects.using(using).filter(examined_by__person=instance.pk),
+        ))
+
+
+@receiver(pre_save, sender=Patient)
+def remember_patient_person_before_save(sender, instance, using, raw, **kwargs):
+    instance._previous_person_id = None
+    if raw or instance._state.adding:
+        return
+
+    instance._previous_person_id = Patient.objects.using(using).filter(
+        pk=instance.pk,
+    ).values_list('person', flat=True).first()
+
+
+@receiver(post_save, sender=Patient)
+def update_person_health_state_on_patient_save(sender, instance, using, **kwargs):
+    # The examinations of a patient moved to another person move to that person's history
+    previous_person_id = getattr(instance, '_previous_person_id', None)
+    if previous_person_id is not None and previous_person_id != instance.person_id:
+        PersonHealthState.objects.using(using).refresh([instance.person_id, previous_person_id])
+
+
+def invalidate_cached_queries(sender, using, **kwargs):
+    invalidate(sender, using=using)
+
+
+# HospitalDailyStats and PersonHealthState are only written through their querysets, which invalidate by
+# themselves (a post_delete receiver would turn their bulk deletes into deletes one by one).
+for model in (Hospital, Department, Person, HospitalWorker, Patient, MedicalExaminationResult):
+    post_save.connect(invalidate_cached_queries, sender=model, dispatch_uid='covid_19_cache_{model}'.format(
+        model=model.__name__,
+    ))
+    post_delete.connect(invalidate_cached_queries, sender=model, dispatch_uid='covid_19_cache_{model}'.format(
+        model=model.__name__,
+    ))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Production profile of the SQLite connections (opt-in, COVID_19_SQLITE_PRODUCTION).
+
+With the default rollback journal a committing writer locks the readers out, so ingest running next to
+the reporting queries fails them with "database is locked", and every request opens the file again
+(and starts with a cold page cache). The profile switches the database to WAL - readers and the writer
+don't block each other, writers wait for one another up to busy_timeout - tunes the pragmas of every
+new connection (`connection_created`) and keeps the connections open between requests (CONN_MAX_AGE,
+see settings.py), on every SQLite database: default, the shards and the replicas.
+`python manage.py optimize_database` keeps the query planner statistics fresh.
+
+The profile can also be turned on or off per database with a COVID_19_SQLITE_PRODUCTION key in its
+DATABASES entry.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+# (pragma, value) applied in order to every new connection
+PRODUCTION_PRAGMAS = (
+    # Stored in the database file, the other pragmas are per connection
+    ('journal_mode', 'WAL'),
+    # No fsync per commit, only at checkpoints - a power loss may lose the last commits, never corrupts
+    ('synchronous', 'NORMAL'),
+    # Milliseconds a writer waits for the write lock before "database is locked"
+    ('busy_timeout', 5000),
+    # Page cache per connection, negative is KiB (64MB)
+    ('cache_size', -65536),
+    # Read the first 256MB of the file through the memory map instead of read() calls
+    ('mmap_size', 268435456),
+    # Sorts and temporary indexes (GROUP BY, DISTINCT) in memory
+    ('temp_store', 'MEMORY'),
+)
+
+
+def is_enabled(connection):
+    return connection.vendor == 'sqlite' and connection.settings_dict.get(
+        'COVID_19_SQLITE_PRODUCTION',
+        getattr(settings, 'COVID_19_SQLITE_PRODUCTION', False),
+    )
+
+
+def get_pragmas():
+    """PRODUCTION_PRAGMAS with the COVID_19_SQLITE_PRAGMAS overrides ({pragma: value}, None drops one)."""
+    overrides = dict(getattr(settings, 'COVID_19_SQLITE_PRAGMAS', None) or {})
+    pragmas = [(name, overrides.pop(name, value)) for name, value in PRODUCTION_PRAGMAS]
+    pragmas.extend(sorted(overrides.items()))
+    return [(name, value) for name, value in pragmas if value is not None]
+
+
+def apply_pragmas(connection, pragmas):
+    # On the driver connection, the pragmas aren't queries of the caller (nor instrumented or captured)
+    for name, value in pragmas:
+        connection.connection.execute('PRAGMA {name} = {value}'.format(name=name, value=value)).fetchall()
+
+
+def configure_connection(sender, connection, **kwargs):
+    """`connection_created` receiver applying the production pragmas."""
+    if is_enabled(connection):
+        apply_pragmas(connection, get_pragmas())
+
+
+def get_pragma(connection, name):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA {name}'.format(name=name))
+        return cursor.fetchone()[0]
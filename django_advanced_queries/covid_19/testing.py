@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+The canonical covid_19 test scenario, built with a few bulk inserts.
+
+`create_scenario()` inserts the scenario (two hospitals, 11 persons, 8 patients and 18 examinations)
+with one bulk_create per model and refreshes what the signals would have maintained, `copies` times for
+performance tests. It returns the named handles (`hospital1`, `person6`, `hospital_worker3`,
+`patient8`...) of the first copy, the other copies only differ by their hospitals' names.
+
+`CovidScenarioTestCase` builds it once per test class (setUpTestData) and gives every test its own
+copies of the handles.
+"""
+from __future__ import unicode_literals
+
+import copy
+import datetime
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.test import TestCase
+
+from django_advanced_queries.covid_19.bulk import get_next_id
+from django_advanced_queries.covid_19.models import (
+    Hospital,
+    Department,
+    EpidemicCurveBucket,
+    HospitalDailyStats,
+    Person,
+    HospitalWorker,
+    Patient,
+    MedicalExaminationResult,
+    PersonHealthState,
+)
+
+# (handle, name, city)
+HOSPITALS = (
+    ('hospital1', 'Asaf Harofeh Medical Center', 'Be\'er Ya\'akov'),
+    ('hospital2', 'Hadassah', 'Jerusalem'),
+)
+
+# (handle, name, hospital)
+DEPARTMENTS = (
+    ('department1', 'Critical Care', 'hospital1'),
+    ('department2', 'Critical Care', 'hospital2'),
+)
+
+# (handle, name, age, gender)
+PERSONS = (
+    ('person1', 'Alon', 65, 'Male'),
+    ('person2', 'Ahmed', 34, 'Male'),
+    ('person3', 'Rony', 33, 'Female'),
+    ('person4', 'Dana', 25, 'Female'),
+    ('person5', 'Yoav', 21, 'Other'),
+    ('person6', 'Ron', 60, 'Male'),
+    ('person7', 'Shalom', 87, 'Male'),
+    ('person8', 'Lea', 90, 'Female'),
+    ('person9', 'Daniel', 3, 'Male'),
+    ('person10', 'Ruby', 15, 'Male'),
+    ('person11', 'Abdul', 29, 'Male'),
+)
+
+# (handle, person, department, position), in the order of their ids
+HOSPITAL_WORKERS = (
+    ('hospital_worker1', 'person1', 'department1', 'Doctor'),
+    ('hospital_worker2', 'person2', 'department1', 'Nurse'),
+    ('hospital_worker_dana', 'person4', 'department1', 'Doctor'),
+    ('hospital_worker3', 'person6', 'department2', 'Doctor'),
+    ('hospital_worker4', 'person6', 'department2', 'Doctor'),
+    ('hospital_worker5', 'person6', 'department2', 'Nurse'),
+    ('hospital_worker6', 'person11', 'department2', 'Nurse'),
+    ('hospital_worker7', 'person11', 'department2', 'Nurse'),
+)
+
+# (handle, person, department)
+PATIENTS = (
+    ('patient1', 'person3', 'department1'),
+    ('patient2', 'person1', 'department1'),
+    ('patient3', 'person4', 'department1'),
+    ('patient4', 'person5', 'department1'),
+    ('patient5', 'person7', 'department2'),
+    ('patient6', 'person8', 'department2'),
+    ('patient7', 'person9', 'department2'),
+    ('patient8', 'person10', 'department2'),
+)
+
+# (patient, examined by, time, result)
+EXAMINATIONS = (
+    ('patient1', 'hospital_worker1', datetime.datetime(2020, 3, 21, 14, 3), 'Corona'),
+    ('patient1', 'hospital_worker1', datetime.datetime(2020, 3, 21, 14, 13), 'Botism'),
+    ('patient2', 'hospital_worker2', datetime.datetime(2020, 3, 21, 16, 13), 'Corona'),
+    ('patient3', 'hospital_worker2', datetime.datetime(2020, 3, 21, 17, 54), 'Healthy'),
+    ('patient4', 'hospital_worker2', datetime.datetime(2020, 3, 20, 12, 13), 'Corona'),
+    ('patient4', 'hospital_worker2', datetime.datetime(2020, 3, 26, 18, 1), 'Healthy'),
+    ('patient4', 'hospital_worker2', datetime.datetime(2020, 4, 26, 18, 1), 'Healthy'),
+    ('patient5', 'hospital_worker3', datetime.datetime(2020, 4, 26, 18, 1), 'Corona'),
+    ('patient5', 'hospital_worker3', datetime.datetime(2020, 4, 27, 18, 1), 'Dead'),
+    ('patient6', 'hospital_worker3', datetime.datetime(2020, 4, 26, 18, 1), 'Corona'),
+    ('patient6', 'hospital_worker3', datetime.datetime(2020, 4, 27, 18, 1), 'Corona'),
+    ('patient6', 'hospital_worker3', datetime.datetime(2020, 4, 28, 18, 1), 'Dead'),
+    ('patient7', 'hospital_worker3', datetime.datetime(2020, 4, 26, 15, 15), 'Healthy'),
+    ('patient7', 'hospital_worker3', datetime.datetime(2020, 4, 27, 21, 53), 'Botism'),
+    ('patient8', 'hospital_worker3', datetime.datetime(2020, 4, 26, 16, 10), 'Corona'),
+    ('patient8', 'hospital_worker3', datetime.datetime(2020, 4, 27, 22, 12), 'Healthy'),
+    ('patient8', 'hospital_worker3', datetime.datetime(2020, 4, 28, 11, 1), 'Botism'),
+    ('patient8', 'hospital_worker3', datetime.datetime(2020, 4, 28, 11, 10), 'Dead'),
+)
+
+
+def get_hospital_name(name, copy_index):
+    return name if not copy_index else '{name} #{num}'.format(name=name, num=copy_index + 1)
+
+
+def create_scenario(copies=1, using=DEFAULT_DB_ALIAS):
+    """
+    Insert the scenario `copies` (at least one) times and return {handle: instance} of the first copy.
+
+    The ids are given in the order the scenario lists the rows (as creating them one by one would),
+    bulk_create doesn't return them on every backend.
+    """
+    copies_handles = [{} for _ in range(copies)]
+
+    def build(model, rows, get_fields):
+        next_id = get_next_id(model, using=using)
+        instances = []
+        for copy_index, handles in enumerate(copies_handles):
+            for row in rows:
+                instance = model(id=next_id, **get_fields(copy_index, handles, *row[1:]))
+                next_id += 1
+                instances.append(instance)
+                if row[0] is not None:
+                    handles[row[0]] = instance
+        model.objects.using(using).bulk_create(instances)
+        # As loaded from the database (bulk_create leaves the instances given an id as new)
+        for instance in instances:
+            instance._state.adding = False
+            instance._state.db = using
+        return instances
+
+    with transaction.atomic(using=using):
+        build(Hospital, HOSPITALS, lambda copy_index, _, name, city: {
+            'name': get_hospital_name(name, copy_index),
+            'city': city,
+        })
+        build(Department, DEPARTMENTS, lambda _, handles, name, hospital: {
+            'name': name,
+            'hospital': handles[hospital],
+        })
+        persons = build(Person, PERSONS, lambda _, __, name, age, gender: {
+            'name': name,
+            'age': age,
+            'gender': gender,
+        })
+        build(HospitalWorker, HOSPITAL_WORKERS, lambda _, handles, person, department, position: {
+            'person': handles[person],
+            'department': handles[department],
+            'position': position,
+        })
+        patients = build(Patient, PATIENTS, lambda _, handles, person, department: {
+            'person': handles[person],
+            'department': handles[department],
+        })
+        examinations = build(
+            MedicalExaminationResult,
+            [(None, ) + examination for examination in EXAMINATIONS],
+            lambda _, handles, patient, examined_by, time, result: {
+                'patient': handles[patient],
+                'examined_by': handles[examined_by],
+                'time': time,
+                'result': result,
+            },
+        )
+
+        # bulk_create skipped the signals maintaining the denormalized data
+        Person.objects.using(using).filter(pk__gte=persons[0].pk).refresh_jobs()
+        Patient.objects.using(using).filter(pk__gte=patients[0].pk).refresh_last_medical_examination_result()
+        PersonHealthState.objects.using(using).refresh(person.pk for person in persons)
+        keys = {
+            (hospital_id, examination.time.date())
+            for examination in examinations
+            for hospital_id in (
+                examination.patient.department.hospital_id,
+                examination.examined_by.department.hospital_id,
+            )
+        }
+        HospitalDailyStats.objects.using(using).refresh(keys)
+        EpidemicCurveBucket.objects.using(using).invalidate({date for _, date in keys})
+
+    return copies_handles[0]
+
+
+class CovidScenarioTestCase(TestCase):
+    """
+    The scenario is created once per class, each test gets its own copies of the handles as attributes.
+
+    Set `scenario_copies` for a scaled up scenario, the handles are those of the first copy.
+    """
+    scenario_copies = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super(CovidScenarioTestCase, cls).setUpTestData()
+        cls.scenario = create_scenario(copies=cls.scenario_copies)
+
+    def setUp(self):
+        super(CovidScenarioTestCase, self).setUp()
+        # The rows changed by a test are rolled back, the instances it changed must not leak either
+        for handle, instance in self.scenario.items():
+            setattr(self, handle, copy.deepcopy(instance))
@@ -2,357 +2,76 @@
 from __future__ import unicode_literals
 
 import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from calendar import timegm
+from importlib import import_module
+from unittest import skipUnless
 
-from django.test import TestCase
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import Avg, Count, F, Sum
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
+from django.utils.six import StringIO
 
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+from django_advanced_queries.covid_19 import caching
+from django_advanced_queries.covid_19.arrays import EXAMINATION_ARRAY_NAMES, ArraysCache, numpy
 from django_advanced_queries.covid_19.models import (
     Hospital,
     Department,
+    EpidemicCurveBucket,
+    HospitalDailyStats,
     Person,
     HospitalWorker,
     Patient,
     MedicalExaminationResult,
+    PersonHealthState,
+    PersonHealthStateQuerySet,
+    ReportJob,
 )
+from django_advanced_queries.covid_19.benchmarks import (
+    EPIDEMIC_CURVE_BENCHMARKS,
+    MANAGER_METHODS_BENCHMARKS,
+    benchmark,
+    compare_to_baseline,
+    run_concurrency_benchmarks,
+)
+from django_advanced_queries.covid_19.data_generation import CovidDataGenerator
+from django_advanced_queries.covid_19.display import without_lazy_loads
+from django_advanced_queries.covid_19.exports import iter_examination_rows, iter_export_lines
+from django_advanced_queries.covid_19.ingest import ExaminationsImporter, iter_records
+from django_advanced_queries.covid_19.instrumentation import registry as instrumentation_registry
+from django_advanced_queries.covid_19.pagination import EstimatedCountPaginator
+from django_advanced_queries.covid_19.query_plans import find_full_table_scans, get_query_plans
+from django_advanced_queries.covid_19.reports import (
+    MAX_EXPOSURES_HOPS,
+    MAX_EXPOSURES_SEEDS,
+    ReportWorker,
+    get_dead_from_corona_ranking,
+    submit_report,
+)
+from django_advanced_queries.covid_19.routers import PIN_PRIMARY_COOKIE, ReadReplicaRouter, pin_to_primary
+from django_advanced_queries.covid_19.shards import ShardedQuerySet, copy_person, create_hospital
+from django_advanced_queries.covid_19.sqlite import get_pragma, get_pragmas
+from django_advanced_queries.covid_19.testing import CovidScenarioTestCase, create_scenario
+from django_advanced_queries.covid_19.tracing import ExposureGraph, trace_exposures
 
 
-class Covid19Tests(TestCase):
-
-    def setUp(self):
-        # Not using fixtures to make it easier to understand the created models.
-
-        ####################################
-        ###  Asaf Harofeh Medical Center ###
-        ####################################
-        self.hospital1 = Hospital.objects.create(
-            name='Asaf Harofeh Medical Center',
-            city='Be\'er Ya\'akov',
-        )
-        department1 = Department.objects.create(
-            name='Critical Care',
-            hospital=self.hospital1
-        )
-        person1 = Person.objects.create(name='Alon', age=65, gender='Male')
-        self.hospital_worker1 = HospitalWorker.objects.create(
-            person=person1,
-            department=department1,
-            position='Doctor',
-        )
-        person2 = Person.objects.create(name='Ahmed', age=34, gender='Male')
-        self.hospital_worker2 = HospitalWorker.objects.create(
-            person=person2,
-            department=department1,
-            position='Nurse',
-        )
-        person3 = Person.objects.create(name='Rony', age=33, gender='Female')
-        self.patient1 = Patient.objects.create(
-            person=person3,
-            department=department1
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=3,
-                day=21,
-                hour=14,
-                minute=3
-            ),
-            examined_by=self.hospital_worker1,
-            patient=self.patient1,
-            result='Corona'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=3,
-                day=21,
-                hour=14,
-                minute=13
-            ),
-            examined_by=self.hospital_worker1,
-            patient=self.patient1,
-            result='Botism'
-        )
-        self.patient2 = Patient.objects.create(
-            person=person1,
-            department=department1
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=3,
-                day=21,
-                hour=16,
-                minute=13
-            ),
-            examined_by=self.hospital_worker2,
-            patient=self.patient2,
-            result='Corona'
-        )
-        person4 = Person.objects.create(name='Dana', age=25, gender='Female')
-        HospitalWorker.objects.create(
-            person=person4,
-            department=department1,
-            position='Doctor',
-        )
-        self.patient3 = Patient.objects.create(
-            person=person4,
-            department=department1
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=3,
-                day=21,
-                hour=17,
-                minute=54
-            ),
-            examined_by=self.hospital_worker2,
-            patient=self.patient3,
-            result='Healthy'
-        )
-        person5 = Person.objects.create(name='Yoav', age=21, gender='Other')
-        self.patient4 = Patient.objects.create(
-            person=person5,
-            department=department1
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=3,
-                day=20,
-                hour=12,
-                minute=13
-            ),
-            examined_by=self.hospital_worker2,
-            patient=self.patient4,
-            result='Corona'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=3,
-                day=26,
-                hour=18,
-                minute=1
-            ),
-            examined_by=self.hospital_worker2,
-            patient=self.patient4,
-            result='Healthy'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=26,
-                hour=18,
-                minute=1
-            ),
-            examined_by=self.hospital_worker2,
-            patient=self.patient4,
-            result='Healthy'
-        )
-
-        ####################################
-        ###          Hadassah            ###
-        ####################################
-        self.hospital2 = Hospital.objects.create(
-            name='Hadassah',
-            city='Jerusalem',
-        )
-        department2 = Department.objects.create(
-            name='Critical Care',
-            hospital=self.hospital2
-        )
-        self.person6 = Person.objects.create(name='Ron', age=60, gender='Male')
-        self.hospital_worker3 = HospitalWorker.objects.create(
-            person=self.person6,
-            department=department2,
-            position='Doctor',
-        )
-        self.hospital_worker4 = HospitalWorker.objects.create(
-            person=self.person6,
-            department=department2,
-            position='Doctor',
-        )
-
-        self.hospital_worker5 = HospitalWorker.objects.create(
-            person=self.person6,
-            department=department2,
-            position='Nurse',
-        )
-        person7 = Person.objects.create(name='Shalom', age=87, gender='Male')
-        self.patient5 = Patient.objects.create(
-            person=person7,
-            department=department2
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=26,
-                hour=18,
-                minute=1
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient5,
-            result='Corona'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=27,
-                hour=18,
-                minute=1
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient5,
-            result='Dead'
-        )
-        person8 = Person.objects.create(name='Lea', age=90, gender='Female')
-        self.patient6 = Patient.objects.create(
-            person=person8,
-            department=department2
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=26,
-                hour=18,
-                minute=1
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient6,
-            result='Corona'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=27,
-                hour=18,
-                minute=1
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient6,
-            result='Corona'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=28,
-                hour=18,
-                minute=1
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient6,
-            result='Dead'
-        )
-        person9 = Person.objects.create(name='Daniel', age=3, gender='Male')
-        self.patient7 = Patient.objects.create(
-            person=person9,
-            department=department2
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=26,
-                hour=15,
-                minute=15
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient7,
-            result='Healthy'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=27,
-                hour=21,
-                minute=53
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient7,
-            result='Botism'
-        )
-        self.person10 = Person.objects.create(
-            name='Ruby',
-            age=15,
-            gender='Male'
-        )
-        self.patient8 = Patient.objects.create(
-            person=self.person10,
-            department=department2
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=26,
-                hour=16,
-                minute=10
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient8,
-            result='Corona'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=27,
-                hour=22,
-                minute=12
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient8,
-            result='Healthy'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=28,
-                hour=11,
-                minute=1
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient8,
-            result='Botism'
-        )
-        MedicalExaminationResult.objects.create(
-            time=datetime.datetime(
-                year=2020,
-                month=4,
-                day=28,
-                hour=11,
-                minute=10
-            ),
-            examined_by=self.hospital_worker3,
-            patient=self.patient8,
-            result='Dead'
-        )
-
-        self.person11 = Person.objects.create(
-            name='Abdul',
-            age=29,
-            gender='Male'
-        )
-        self.hospital_worker6 = HospitalWorker.objects.create(
-            person=self.person11,
-            department=department2,
-            position='Nurse',
-        )
-
-        self.hospital_worker7 = HospitalWorker.objects.create(
-            person=self.person11,
-            department=department2,
-            position='Nurse',
-        )
+class Covid19Tests(CovidScenarioTestCase):
 
     def test_num_of_hospitalized_because_of_botism(self):
         with self.assertNumQueries(1):
@@ -499,7 +218,1499 @@ class Covid19Tests(TestCase):
             hospital_workers = Person.objects.persons_with_multiple_jobs(jobs=['Doctor', 'Nurse'])
             self.assertListEqual(list(hospital_workers), [self.person6])
 
+    def test_last_medical_examination_result_follows_saves_and_deletes(self):
+        self.patient1.refresh_from_db()
+        self.assertEqual(self.patient1.last_medical_examination_result.result, 'Botism')
+
+        # An examination arriving out of order must not move the pointer backwards
+        MedicalExaminationResult.objects.create(
+            time=datetime.datetime(year=2020, month=3, day=1),
+            examined_by=self.hospital_worker1,
+            patient=self.patient1,
+            result='Healthy'
+        )
+        latest = MedicalExaminationResult.objects.create(
+            time=datetime.datetime(year=2020, month=5, day=1),
+            examined_by=self.hospital_worker1,
+            patient=self.patient1,
+            result='Dead'
+        )
+        self.patient1.refresh_from_db()
+        self.assertEqual(self.patient1.last_medical_examination_result, latest)
+
+        latest.delete()
+        self.patient1.refresh_from_db()
+        self.assertEqual(self.patient1.last_medical_examination_result.result, 'Botism')
+
+        Patient.objects.update(last_medical_examination_result=None)
+        Patient.objects.refresh_last_medical_examination_result()
+        self.assertEqual(Person.objects.get_sick_persons().count(), 3)
+
+    @skipUnless(connection.vendor == 'sqlite', 'Checks the output of SQLite EXPLAIN QUERY PLAN')
+    def test_manager_methods_do_not_scan_medical_examination_results(self):
+        manager_methods_calls = [
+            lambda: Patient.objects.filter_by_examinations_results_options(results=('Botism', 'Corona')).count(),
+            lambda: Patient.objects.get_highest_num_of_patient_medical_examinations(),
+            lambda: list(Patient.objects.filter_by_examined_hospital_workers(
+                HospitalWorker.objects.get_sick_workers(),
+            )),
+            lambda: list(Patient.objects.filter_dead_from_corona()),
+            lambda: list(Department.objects.annotate_avg_age_of_patients()),
+            lambda: HospitalWorker.objects.get_worker_performed_most_medical_examinations(
+                filter_kwargs={'position': 'Doctor'},
+                exclude_kwargs={},
+            ),
+            lambda: Person.objects.get_sick_persons().count(),
+            lambda: HospitalWorker.objects.get_sick_workers().count(),
+            lambda: list(Person.objects.persons_with_multiple_jobs(jobs=['Doctor', 'Nurse'])),
+            lambda: list(Hospital.objects.annotate_by_num_of_hospital_workers_in_risk_of_corona()),
+            lambda: list(Hospital.objects.annotate_by_num_of_dead_from_corona()),
+            lambda: list(Hospital.objects.dashboard()),
+        ]
+
+        for manager_method_call in manager_methods_calls:
+            self.assertListEqual(find_full_table_scans(get_query_plans(manager_method_call)), [])
+
+    def test_manager_methods_queries_are_instrumented(self):
+        instrumentation_registry.reset()
+
+        with self.assertNumQueries(2):
+            patients = Patient.objects.filter_by_examinations_results_options(results=('Botism', ))
+            self.assertEqual(len(patients), 3)
+            list(patients)  # Cached, not measured again
+            Patient.objects.get_highest_num_of_patient_medical_examinations()
+
+        snapshot = instrumentation_registry.snapshot()
+        filter_by_results_options = snapshot['Patient.filter_by_examinations_results_options']
+        self.assertEqual(filter_by_results_options['num_of_queries']['count'], 1)
+        self.assertEqual(filter_by_results_options['num_of_queries']['sum'], 1)
+        self.assertEqual(filter_by_results_options['num_of_rows']['sum'], 3)
+        highest_num_of_examinations = snapshot['Patient.get_highest_num_of_patient_medical_examinations']
+        self.assertEqual(highest_num_of_examinations['num_of_queries']['sum'], 1)
+        self.assertEqual(highest_num_of_examinations['num_of_rows']['sum'], 1)
+
+        # Queries outside instrumented methods are not measured
+        list(Patient.objects.all())
+        self.assertEqual(set(instrumentation_registry.snapshot()), set(snapshot))
+
+        with override_settings(COVID_19_QUERY_INSTRUMENTATION=False):
+            Person.objects.get_sick_persons().count()
+        self.assertNotIn('Person.get_sick_persons', instrumentation_registry.snapshot())
+
+    def assertHospitalDailyStatsAreUpToDate(self):
+        self.assertDictEqual(
+            {
+                (daily_stats.pop('hospital'), daily_stats.pop('date')): daily_stats
+                for daily_stats in HospitalDailyStats.objects.values('hospital', 'date', *HospitalDailyStats.METRICS)
+            },
+            HospitalDailyStats.objects.compute(),
+        )
+
+    def test_hospital_daily_stats_follow_saves_and_deletes(self):
+        self.assertHospitalDailyStatsAreUpToDate()
+        hadassah_daily_stats = HospitalDailyStats.objects.get(hospital=self.hospital2, date=datetime.date(2020, 4, 26))
+        self.assertEqual(hadassah_daily_stats.num_of_new_corona_cases, 3)
+        self.assertEqual(hadassah_daily_stats.num_of_healthy_results, 1)
+        self.assertEqual(hadassah_daily_stats.num_of_active_workers_in_risk_of_corona, 1)
+
+        # Out of order examination turning Lea's first Corona result into a continuing case
+        examination = MedicalExaminationResult.objects.create(
+            time=datetime.datetime(year=2020, month=4, day=25),
+            examined_by=self.hospital_worker6,
+            patient=self.patient6,
+            result='Corona'
+        )
+        self.assertHospitalDailyStatsAreUpToDate()
+        hadassah_daily_stats.refresh_from_db()
+        self.assertEqual(hadassah_daily_stats.num_of_new_corona_cases, 2)
+
+        examination.time = datetime.datetime(year=2020, month=5, day=1)
+        examination.save()
+        self.assertHospitalDailyStatsAreUpToDate()
+
+        examination.delete()
+        self.assertHospitalDailyStatsAreUpToDate()
+        self.assertFalse(HospitalDailyStats.objects.filter(date=datetime.date(2020, 5, 1)).exists())
+
+        # The derived data of an examination is updated all or nothing
+        daily_stats = list(HospitalDailyStats.objects.order_by('pk').values())
+        with mock.patch.object(PersonHealthStateQuerySet, 'advance', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                MedicalExaminationResult.objects.create(
+                    time=datetime.datetime(year=2020, month=4, day=29),
+                    examined_by=self.hospital_worker6,
+                    patient=self.patient6,
+                    result='Healthy'
+                )
+        self.assertListEqual(list(HospitalDailyStats.objects.order_by('pk').values()), daily_stats)
+        self.patient6.refresh_from_db()
+        self.assertEqual(self.patient6.last_medical_examination_result.time, datetime.datetime(2020, 4, 28, 18, 1))
+        MedicalExaminationResult.objects.filter(time=datetime.datetime(year=2020, month=4, day=29)).delete()
+
+        # A refresh recomputes exactly its keys, not the box of their hospitals and dates
+        HospitalDailyStats.objects.update(num_of_deaths=99)
+        HospitalDailyStats.objects.refresh({
+            (self.hospital1.pk, datetime.date(2020, 3, 21)),
+            (self.hospital2.pk, datetime.date(2020, 4, 27)),
+        })
+        self.assertSetEqual(
+            set(HospitalDailyStats.objects.exclude(num_of_deaths=99).values_list('hospital', 'date')),
+            {(self.hospital1.pk, datetime.date(2020, 3, 21)), (self.hospital2.pk, datetime.date(2020, 4, 27))},
+        )
+
+        HospitalDailyStats.objects.all().delete()
+        HospitalDailyStats.objects.rebuild()
+        self.assertHospitalDailyStatsAreUpToDate()
+
+        # The migration creating the table backfills it with the same compute
+        HospitalDailyStats.objects.all().delete()
+        migration = import_module('django_advanced_queries.covid_19.migrations.0004_hospital_daily_stats')
+        migration.backfill_hospital_daily_stats(apps, connection.schema_editor())
+        self.assertHospitalDailyStatsAreUpToDate()
+
+    def test_hospital_daily_stats_follow_workers_and_ages(self):
+        hadassah_daily_stats = HospitalDailyStats.objects.get(hospital=self.hospital2, date=datetime.date(2020, 4, 26))
+        self.assertEqual(hadassah_daily_stats.num_of_active_workers_in_risk_of_corona, 1)
+
+        # Ron leaves the risk group, a change of another field doesn't recount it
+        self.person6.age = 59
+        self.person6.save()
+        self.assertHospitalDailyStatsAreUpToDate()
+        hadassah_daily_stats.refresh_from_db()
+        self.assertEqual(hadassah_daily_stats.num_of_active_workers_in_risk_of_corona, 0)
+        self.person11.name = 'Abdallah'
+        # The previous age, and the update
+        with self.assertNumQueries(2):
+            self.person11.save()
+
+        # Ahmed's job moves to Shalom, then to Hadassah
+        dates = {examination.time.date() for examination in self.hospital_worker2.medical_examination_results.all()}
+        self.hospital_worker2.person = self.person7
+        self.hospital_worker2.save()
+        self.assertHospitalDailyStatsAreUpToDate()
+        self.assertSetEqual(
+            set(HospitalDailyStats.objects.filter(
+                hospital=self.hospital1,
+                num_of_active_workers_in_risk_of_corona__gt=0,
+            ).values_list('date', flat=True)),
+            dates,
+        )
+        self.hospital_worker2.department = self.department2
+        self.hospital_worker2.save()
+        self.assertHospitalDailyStatsAreUpToDate()
+        # Alon's day only
+        self.assertListEqual(
+            list(HospitalDailyStats.objects.filter(
+                hospital=self.hospital1,
+                num_of_active_workers_in_risk_of_corona__gt=0,
+            ).values_list('date', flat=True)),
+            [datetime.date(2020, 3, 21)],
+        )
+
+        self.hospital_worker2.delete()
+        self.assertHospitalDailyStatsAreUpToDate()
+
+    def test_annotate_by_num_of_dead_from_corona_from_rollup(self):
+        with self.assertNumQueries(1):
+            result = list(Hospital.objects.annotate_by_num_of_dead_from_corona(from_rollup=True).order_by('pk'))
+
+        self.assertListEqual([hospital.num_of_dead_from_corona for hospital in result], [0, 2])
+
+    def test_export_examinations_with_keyset_pagination(self):
+        with self.assertNumQueries(3):
+            rows = list(iter_examination_rows(batch_size=7))
+
+        self.assertListEqual(
+            [row[:2] for row in rows],
+            list(MedicalExaminationResult.objects.order_by('time', 'pk').values_list('pk', 'time')),
+        )
+
+        since = datetime.datetime(year=2020, month=4, day=27)
+        records = [json.loads(line) for line in iter_export_lines('ndjson', since=since, batch_size=4)]
+        self.assertEqual(len(records), MedicalExaminationResult.objects.filter(time__gte=since).count())
+        self.assertDictContainsSubset(
+            {'patient_name': 'Shalom', 'hospital': 'Hadassah', 'examined_by_name': 'Ron', 'result': 'Dead'},
+            records[0],
+        )
+
+        lines = list(iter_export_lines('csv', since=since))
+        self.assertEqual(len(lines), len(records) + 1)
+        self.assertTrue(lines[0].startswith('id,time,result,'))
+
+    def test_export_examinations_view(self):
+        # Personal health data, for staff users only
+        self.assertEqual(self.client.get('/covid-19/examinations/export/').status_code, 403)
+        self.client.force_login(User.objects.create_user('user'))
+        self.assertEqual(self.client.get('/covid-19/examinations/export/').status_code, 403)
+
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        response = self.client.get('/covid-19/examinations/export/', {'format': 'csv', 'since': '2020-04-28'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 1 + 3)
+
+        response = self.client.get('/covid-19/examinations/export/', {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_ingest_examinations(self):
+        csv_lines = [
+            'person_name,person_age,person_gender,hospital,department,examined_by_name,examined_by_position,'
+            'examined_by_age,time,result\n',
+            'Lea,90,Female,Hadassah,Critical Care,Ron,Doctor,,2020-05-02T10:00:00,Healthy\n',
+            'Noa,40,Female,Ichilov,Emergency,Gal,Nurse,30,2020-05-02T11:00:00,Corona\n',
+            'Noa,40,Female,Ichilov,Emergency,Gal,Nurse,30,2020-05-01T11:00:00,Healthy\n',
+            'Noa,40,Female,Ichilov,Emergency,Gal,Nurse,30,2020-05-03T11:00:00,Flu\n',
+            'Noa,40,Female,Ichilov,Emergency,Tom,Doctor,,2020-05-03T11:00:00,Healthy\n',
+            'Noa,forty,Female,Ichilov,Emergency,Gal,Nurse,30,2020-05-03T11:00:00,Healthy\n',
+            'Dan,50,Male,Assuta,Surgery,Tom,Doctor,,2020-05-03T12:00:00,Healthy\n',
+        ]
+        num_of_examinations = MedicalExaminationResult.objects.count()
+
+        report = ExaminationsImporter(batch_size=2).ingest(iter_records(csv_lines, 'csv'))
+
+        self.assertEqual(report.num_of_records, 7)
+        self.assertEqual(report.num_of_inserted, 3)
+        self.assertListEqual(sorted(line_number for line_number, _ in report.rejected), [5, 6, 7, 8])
+        self.assertEqual(MedicalExaminationResult.objects.count(), num_of_examinations + 3)
+        # No parents are created for a record rejected for its worker
+        self.assertFalse(Hospital.objects.filter(name='Assuta').exists())
+        self.assertFalse(Person.objects.filter(name='Dan').exists())
+
+        # Existing parents are reused, missing ones are created once
+        self.assertEqual(Hospital.objects.filter(name='Hadassah').count(), 1)
+        self.assertEqual(Person.objects.filter(name='Lea').count(), 1)
+        noa = Patient.objects.get(person__name='Noa', department__hospital__name='Ichilov')
+        self.assertEqual(noa.last_medical_examination_result.result, 'Corona')
+        self.assertEqual(noa.last_medical_examination_result.examined_by.person.age, 30)
+        self.assertEqual(self.patient6.medical_examination_results.latest('time').result, 'Healthy')
+        self.assertEqual(
+            Patient.objects.get(pk=self.patient6.pk).last_medical_examination_result.result, 'Healthy',
+        )
+        self.assertHospitalDailyStatsAreUpToDate()
+
+        ndjson_lines = [
+            json.dumps({
+                'person_name': 'Noa', 'person_age': 40, 'person_gender': 'Female', 'hospital': 'Ichilov',
+                'department': 'Emergency', 'examined_by_name': 'Gal', 'examined_by_position': 'Nurse',
+                'time': '2020-05-04T11:00:00', 'result': 'Dead',
+            }),
+            '{"person_name": ',
+        ]
+        report = ExaminationsImporter().ingest(iter_records(ndjson_lines, 'ndjson'))
+        self.assertEqual(report.num_of_inserted, 1)
+        self.assertListEqual([line_number for line_number, _ in report.rejected], [2])
+        self.assertTrue(Patient.objects.filter_dead_from_corona().filter(pk=noa.pk).exists())
+
+    def test_analytic_manager_methods_read_from_replica(self):
+        # An empty database standing in for a replica lagging behind
+        replica_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, replica_dir)
+        connections.databases['replica'] = dict(
+            connections.databases['default'],
+            NAME=os.path.join(replica_dir, 'replica.sqlite3'),
+        )
+        connections.ensure_defaults('replica')
+        self.addCleanup(connections.databases.pop, 'replica')
+        self.addCleanup(connections['replica'].close)
+        call_command('migrate', database='replica', verbosity=0)
+
+        with override_settings(COVID_19_READ_REPLICAS=['replica']):
+            self.assertEqual(Person.objects.get_sick_persons().db, 'replica')
+            self.assertListEqual(list(Person.objects.get_sick_persons()), [])
+            self.assertIsNone(Patient.objects.get_highest_num_of_patient_medical_examinations())
+            # Plain reads and explicit databases are left alone
+            self.assertEqual(Person.objects.filter(name='Alon').db, 'default')
+            self.assertEqual(Person.objects.using('default').get_sick_persons().count(), 3)
+
+            with pin_to_primary():
+                self.assertEqual(Person.objects.get_sick_persons().db, 'default')
+                self.assertEqual(Person.objects.get_sick_persons().count(), 3)
+
+            Hospital.objects.using('replica').create(name='Ichilov', city='Tel Aviv')
+            hospital = Hospital.objects.annotate_by_num_of_dead_from_corona().get()
+            self.assertEqual(ReadReplicaRouter().db_for_write(Hospital, instance=hospital), 'default')
+
+            response = self.client.post('/covid-19/examinations/export/')
+            self.assertIn(PIN_PRIMARY_COOKIE, response.cookies)
+
+        self.assertEqual(Person.objects.get_sick_persons().db, 'default')
+
+    def test_admin_changelists_render_in_constant_number_of_queries(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        models = (
+            Hospital,
+            Department,
+            Person,
+            HospitalWorker,
+            Patient,
+            MedicalExaminationResult,
+            HospitalDailyStats,
+            EpidemicCurveBucket,
+            PersonHealthState,
+            ReportJob,
+        )
+
+        def get_num_of_changelist_queries():
+            num_of_queries = {}
+            for model in models:
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(reverse('admin:covid_19_{model}_changelist'.format(
+                        model=model._meta.model_name,
+                    )))
+                self.assertEqual(response.status_code, 200)
+                num_of_queries[model.__name__] = len(context)
+            return num_of_queries
+
+        num_of_queries = get_num_of_changelist_queries()
+        CovidDataGenerator(seed=7).generate(num_of_hospitals=2, num_of_persons=300, exams_per_patient=3)
+        self.assertDictEqual(get_num_of_changelist_queries(), num_of_queries)
+
+        # The reports filter lists the registry, not the table's distinct values
+        submit_report('exposures', {'hospital_worker_ids': [self.hospital_worker2.pk]})
+        submit_report('dead_from_corona_ranking')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('admin:covid_19_reportjob_changelist'), {'report': 'exposures'})
+        self.assertFalse([query for query in context.captured_queries if 'DISTINCT' in query['sql']])
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+        self.assertContains(response, '?report=persons_with_multiple_jobs')
+
+    def test_estimated_count_paginator(self):
+        class SmallTablesPaginator(EstimatedCountPaginator):
+            ESTIMATE_FROM = 10
+            MAX_EXACT_COUNT = 3
+
+        examinations = MedicalExaminationResult.objects.order_by('-pk')
+        MedicalExaminationResult.objects.filter(pk=examinations[3].pk).delete()
+        ids = list(examinations.values_list('pk', flat=True))
+
+        # Unfiltered - the ids span, no COUNT(*)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(SmallTablesPaginator(examinations, 5).count, ids[0] - ids[-1] + 1)
+        self.assertNotIn('COUNT', context.captured_queries[0]['sql'])
+        # Filtered or small - counted up to MAX_EXACT_COUNT
+        self.assertEqual(SmallTablesPaginator(examinations.filter(result='Dead'), 5).count, 3)
+        self.assertEqual(SmallTablesPaginator(examinations.filter(result='Healthy', patient=self.patient1), 5).count, 0)
+        self.assertEqual(EstimatedCountPaginator(examinations, 5).count, len(ids))
+
+    def test_api_endpoints_pages_in_constant_number_of_queries(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        for resource, model, num_of_queries in (
+                # The validator, and the page
+                ('hospitals', Hospital, 2),
+                ('departments', Department, 2),
+                # The session and the user of the staff check first
+                ('patients', Patient, 4),
+                ('workers', HospitalWorker, 4),
+                ('examinations', MedicalExaminationResult, 4),
+        ):
+            url = reverse('covid_19:api_list', kwargs={'resource': resource})
+            records = []
+            cursor = None
+            while True:
+                with self.assertNumQueries(num_of_queries):
+                    response = self.client.get(url, {'limit': 2, 'cursor': cursor} if cursor else {'limit': 2})
+                self.assertEqual(response.status_code, 200)
+                page = response.json()
+                records.extend(page['results'])
+                cursor = page['next_cursor']
+                if cursor is None:
+                    break
+            self.assertEqual(len(records), model.objects.count(), resource)
+            self.assertEqual(len({record['id'] for record in records}), len(records), resource)
+
+            # A 304 costs the validator's aggregate only, not the page's query
+            response = self.client.get(url, {'limit': 2})
+            with self.assertNumQueries(num_of_queries - 1):
+                response = self.client.get(url, {'limit': 2}, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+        # The ETag follows additions and deletions, and the page's params
+        url = reverse('covid_19:api_list', kwargs={'resource': 'hospitals'})
+        etag = self.client.get(url, {'limit': 2})['ETag']
+        self.assertEqual(self.client.get(url, {'limit': 3}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        hospital = Hospital.objects.create(name='Ichilov', city='Tel Aviv')
+        response = self.client.get(url, {'limit': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        hospital.delete()
+        self.assertEqual(self.client.get(url, {'limit': 2}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        self.assertEqual(self.client.get(url, {'limit': 2}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # The patients change with their last examination, the time of the latest one is their Last-Modified
+        url = reverse('covid_19:api_list', kwargs={'resource': 'patients'})
+        response = self.client.get(url, {'limit': 2})
+        self.assertEqual(
+            response['Last-Modified'],
+            http_date(timegm(MedicalExaminationResult.objects.latest('time').time.utctimetuple())),
+        )
+        MedicalExaminationResult.objects.create(
+            time=datetime.datetime(year=2020, month=5, day=1),
+            examined_by=self.hospital_worker6,
+            patient=self.patient1,
+            result='Healthy',
+        )
+        self.assertEqual(self.client.get(url, {'limit': 2}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        self.assertEqual(
+            self.client.get(url, {'limit': 2}, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+            200,
+        )
+        response = self.client.get(url, {'limit': 2})
+        self.assertEqual(response['Last-Modified'], 'Fri, 01 May 2020 00:00:00 GMT')
+        self.assertEqual(
+            self.client.get(url, {'limit': 2}, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+            304,
+        )
+
+        # Personal health data, for staff users only
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('covid_19:api_list', args=('hospitals', ))).status_code, 200)
+        for resource in ('patients', 'workers', 'examinations'):
+            self.assertEqual(self.client.get(reverse('covid_19:api_list', args=(resource, ))).status_code, 403)
+
+    def test_api_examinations(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        url = reverse('covid_19:api_list', kwargs={'resource': 'examinations'})
+        response = self.client.get(url, {'patient': self.patient6.pk, 'limit': 1})
+        etag = response['ETag']
+        records = response.json()['results']
+        while response.json()['next_cursor']:
+            response = self.client.get(url, {'patient': self.patient6.pk, 'cursor': response.json()['next_cursor']})
+            records.extend(response.json()['results'])
+        self.assertListEqual(
+            [record['id'] for record in records],
+            list(self.patient6.medical_examination_results.order_by('time', 'pk').values_list('pk', flat=True)),
+        )
+        self.assertDictContainsSubset({'patient_name': 'Lea', 'hospital': 'Hadassah'}, records[0])
+
+        # A new examination, even with an older time, changes the ETag
+        MedicalExaminationResult.objects.create(
+            time=datetime.datetime(year=2020, month=3, day=1),
+            examined_by=self.hospital_worker6,
+            patient=self.patient6,
+            result='Healthy'
+        )
+        response = self.client.get(url, {'patient': self.patient6.pk, 'limit': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['time'], '2020-03-01T00:00:00')
+
+        for params in ({'cursor': 'nope'}, {'limit': 0}, {'patient': 'Lea'}, {'since': 'yesterday'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+        response = self.client.get(reverse('covid_19:api_list', kwargs={'resource': 'persons'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_hospital_dashboard(self):
+        with self.assertNumQueries(1):
+            dashboards = list(Hospital.objects.dashboard().order_by('pk'))
+
+        metrics = (
+            'num_of_departments',
+            'num_of_hospital_workers',
+            'num_of_hospital_workers_in_risk_of_corona',
+            'num_of_dead_from_corona',
+            'num_of_sick_patients',
+            'avg_age_of_patients',
+        )
+        for hospital in dashboards:
+            patients = Patient.objects.filter(department__hospital=hospital)
+            self.assertDictEqual({metric: getattr(hospital, metric) for metric in metrics}, {
+                'num_of_departments': hospital.departments.count(),
+                'num_of_hospital_workers': Person.objects.filter(
+                    hospital_jobs__department__hospital=hospital,
+                ).distinct().count(),
+                'num_of_hospital_workers_in_risk_of_corona': Person.objects.filter(
+                    hospital_jobs__department__hospital=hospital,
+                    age__gte=Person.RISK_GROUP_MIN_AGE,
+                ).distinct().count(),
+                'num_of_dead_from_corona': patients.filter_dead_from_corona().count(),
+                'num_of_sick_patients': patients.filter(
+                    last_medical_examination_result__result__in=MedicalExaminationResult.SICK_RESULTS,
+                ).count(),
+                'avg_age_of_patients': patients.aggregate(avg_age=Avg('person__age'))['avg_age'],
+            })
+        self.assertEqual(dashboards[1].num_of_dead_from_corona, 2)
+
+    def test_trace_exposures_over_multiple_hops(self):
+        ahmed, alon, rony = self.hospital_worker2.person, self.hospital_worker1.person, self.patient1.person
+        dana_id, yoav_id = self.patient3.person_id, self.patient4.person_id
+        # Alon, exposed by Ahmed at 16:13, examines Rony the day after
+        MedicalExaminationResult.objects.create(
+            time=datetime.datetime(year=2020, month=3, day=22, hour=9),
+            examined_by=self.hospital_worker1,
+            patient=self.patient1,
+            result='Healthy',
+        )
+
+        # The seed's person, then the edges the trace may reach, whatever the number of hops
+        hospital_workers = HospitalWorker.objects.filter(pk=self.hospital_worker2.pk)
+        for max_hops in (1, 5):
+            with self.assertNumQueries(2):
+                trace_exposures(hospital_workers, max_hops=max_hops)
+        with self.assertNumQueries(2):
+            exposures = trace_exposures(hospital_workers)
+
+        self.assertListEqual(
+            [(exposure.person_id, exposure.depth, exposure.time, exposure.path) for exposure in exposures],
+            [
+                (yoav_id, 1, datetime.datetime(2020, 3, 20, 12, 13), (ahmed.pk, yoav_id)),
+                (alon.pk, 1, datetime.datetime(2020, 3, 21, 16, 13), (ahmed.pk, alon.pk)),
+                (dana_id, 1, datetime.datetime(2020, 3, 21, 17, 54), (ahmed.pk, dana_id)),
+                (rony.pk, 2, datetime.datetime(2020, 3, 22, 9), (ahmed.pk, alon.pk, rony.pk)),
+            ],
+        )
+
+        # Only the edges of the persons within reach are loaded, for a single hop Ahmed's
+        with self.assertNumQueries(1):
+            reachable_graph = ExposureGraph.load_reachable([ahmed.pk], max_hops=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(reachable_graph.trace([ahmed.pk], max_hops=1)), 3)
+        self.assertEqual(
+            len(reachable_graph),
+            MedicalExaminationResult.objects.filter(examined_by__person=ahmed).exclude(patient__person=ahmed).count(),
+        )
+
+        # Alon's examinations of Rony before he was exposed don't count, neither do ones out of the window
+        graph = ExposureGraph.load()
+        self.assertGreater(len(graph), len(reachable_graph))
+        self.assertNotIn(rony.pk, [exposure.person_id for exposure in graph.trace([ahmed.pk], max_hops=1)])
+        self.assertNotIn(rony.pk, [
+            exposure.person_id for exposure in graph.trace([ahmed.pk], window=datetime.timedelta(hours=12))
+        ])
+        self.assertIn(rony.pk, [
+            exposure.person_id for exposure in graph.trace([ahmed.pk], window=datetime.timedelta(days=1))
+        ])
+        # Yoav is exposed again on the 26th
+        exposures = graph.trace([ahmed.pk], start_time=datetime.datetime(2020, 3, 21))
+        self.assertListEqual(
+            [(exposure.person_id, exposure.depth) for exposure in exposures],
+            [(alon.pk, 1), (dana_id, 1), (yoav_id, 1), (rony.pk, 2)],
+        )
+
+    def test_person_jobs_follow_saves_and_deletes(self):
+        self.person6.refresh_from_db()
+        self.assertEqual((self.person6.num_of_jobs, self.person6.positions_mask), (3, 3))
+
+        # Ron's nurse job moves to person11, a nurse too
+        self.hospital_worker5.person = self.person11
+        self.hospital_worker5.save()
+        self.assertListEqual(list(Person.objects.persons_with_multiple_jobs(jobs=['Doctor'])), [self.person6])
+        self.assertListEqual(list(Person.objects.persons_with_multiple_jobs(jobs=['Nurse'])), [self.person11])
+        self.person11.refresh_from_db()
+        self.assertEqual((self.person11.num_of_jobs, self.person11.positions_mask), (3, 2))
+
+        self.hospital_worker3.delete()
+        self.assertListEqual(list(Person.objects.persons_with_multiple_jobs()), [self.person11])
+        self.assertListEqual(list(Person.objects.get_persons_with_inconsistent_jobs()), [])
+
+        # Writes bypassing the signals are found by the check and fixed by the backfill
+        Person.objects.filter(pk=self.person11.pk).update(num_of_jobs=1)
+        self.assertListEqual(list(Person.objects.get_persons_with_inconsistent_jobs()), [self.person11])
+        with self.assertRaises(CommandError):
+            call_command('backfill_person_jobs', check=True, stderr=StringIO())
+        call_command('backfill_person_jobs', batch_size=3, stdout=StringIO())
+        call_command('backfill_person_jobs', check=True, stdout=StringIO())
+        self.assertListEqual(list(Person.objects.persons_with_multiple_jobs(jobs=['Nurse'])), [self.person11])
+
+    def test_examinations_to_arrays(self):
+        rows = list(MedicalExaminationResult.objects.order_by('pk').values_list(
+            'pk', 'time', 'result', 'patient', 'patient__department__hospital', 'examined_by',
+        ))
+        # One query for the size, then chunks of 4
+        with self.assertNumQueries(1 + (len(rows) + 3) // 4):
+            arrays = MedicalExaminationResult.objects.to_arrays(chunk_size=4)
+
+        self.assertListEqual(list(arrays), list(EXAMINATION_ARRAY_NAMES))
+        self.assertEqual(arrays['time'].dtype, numpy.dtype('datetime64[us]'))
+        self.assertEqual(arrays['result'].dtype, numpy.uint8)
+        self.assertEqual(arrays['patient_id'].dtype, numpy.int32)
+        self.assertListEqual(
+            list(zip(
+                arrays['id'].tolist(),
+                arrays['time'].tolist(),
+                arrays['result'].tolist(),
+                arrays['patient_id'].tolist(),
+                arrays['hospital_id'].tolist(),
+                arrays['examined_by_id'].tolist(),
+            )),
+            [
+                (pk, time, MedicalExaminationResult.RESULT_CODES[result], patient_id, hospital_id, examined_by_id)
+                for pk, time, result, patient_id, hospital_id, examined_by_id in rows
+            ],
+        )
+
+        arrays = MedicalExaminationResult.objects.filter(result='Dead').to_arrays(fields=['result', 'patient_id'])
+        self.assertListEqual(list(arrays), ['result', 'patient_id'])
+        self.assertEqual(set(arrays['result'].tolist()), {MedicalExaminationResult.RESULT_CODES['Dead']})
+        with self.assertRaises(ValueError):
+            MedicalExaminationResult.objects.to_arrays(fields=['name'])
+
+    def test_examinations_arrays_cache_refreshes_by_id_watermark(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = ArraysCache(directory, MedicalExaminationResult.objects.all(), fields=['time', 'result'])
+
+        arrays = cache.refresh()
+        self.assertIsInstance(arrays['id'], numpy.memmap)
+        self.assertListEqual(
+            arrays['id'].tolist(),
+            list(MedicalExaminationResult.objects.order_by('pk').values_list('pk', flat=True)),
+        )
+
+        examination = MedicalExaminationResult.objects.create(
+            time=datetime.datetime(year=2020, month=5, day=1),
+            examined_by=self.hospital_worker1,
+            patient=self.patient1,
+            result='Healthy',
+        )
+        # Only the examinations above the watermark are read
+        with CaptureQueriesContext(connection) as context:
+            arrays = cache.refresh()
+        self.assertIn('"covid_19_medicalexaminationresult"."id" > {pk}'.format(pk=examination.pk - 1),
+                      context.captured_queries[-1]['sql'])
+        self.assertEqual(arrays['id'][-1], examination.pk)
+        self.assertEqual(arrays['time'][-1], numpy.datetime64('2020-05-01T00:00:00'))
+        self.assertEqual(arrays['result'][-1], MedicalExaminationResult.RESULT_CODES['Healthy'])
+        self.assertListEqual(cache.load()['id'].tolist(), arrays['id'].tolist())
+
+        # Deleted examinations stay cached until a rebuild
+        examination_id = examination.pk
+        examination.delete()
+        self.assertEqual(cache.refresh()['id'][-1], examination_id)
+        self.assertNotEqual(cache.rebuild()['id'][-1], examination_id)
+
+    def get_expected_epidemic_curve(self, period, group_by='department'):
+        """The epidemic curve computed in Python from every examination."""
+        series = {}
+        previous_results = {}
+        for time, result, patient_id, department_id, hospital_id in MedicalExaminationResult.objects.order_by(
+            'time', 'pk',
+        ).values_list('time', 'result', 'patient', 'patient__department', 'patient__department__hospital'):
+            previous_result = previous_results.get(patient_id)
+            previous_results[patient_id] = result
+
+            start = EpidemicCurveBucket.get_bucket_start(period, time.date())
+            key = {
+                'department': (('hospital', hospital_id), ('department', department_id), ('start', start)),
+                'hospital': (('hospital', hospital_id), ('start', start)),
+                None: (('start', start), ),
+            }[group_by]
+            metrics = series.setdefault(key, dict.fromkeys(EpidemicCurveBucket.METRICS, 0))
+            metrics['num_of_new_corona_cases'] += result == 'Corona' and previous_result != 'Corona'
+            metrics['num_of_deaths'] += result == 'Dead'
+            metrics['num_of_recoveries'] += result == 'Healthy' and previous_result in ('Corona', 'Botism')
+        return [dict(key, **series[key]) for key in sorted(series)]
+
+    def test_epidemic_curve(self):
+        today = datetime.date(2020, 6, 1)
+        for period in EpidemicCurveBucket.PERIODS:
+            for group_by in EpidemicCurveBucket.GROUP_BY:
+                self.assertListEqual(
+                    EpidemicCurveBucket.objects.get_series(period=period, group_by=group_by, today=today),
+                    self.get_expected_epidemic_curve(period, group_by),
+                )
+
+        # Every bucket is materialized now, only the open one is computed: the first examination time,
+        # the stored buckets and the open bucket
+        with self.assertNumQueries(3):
+            series = EpidemicCurveBucket.objects.get_series(period='week', group_by='hospital', today=today)
+        self.assertListEqual(series, self.get_expected_epidemic_curve('week', 'hospital'))
+        self.assertListEqual(
+            EpidemicCurveBucket.objects.get_series(hospital=self.hospital1.pk, group_by='hospital', today=today),
+            [
+                row for row in self.get_expected_epidemic_curve('day', 'hospital')
+                if row['hospital'] == self.hospital1.pk
+            ],
+        )
+        self.assertListEqual(
+            EpidemicCurveBucket.objects.get_series(
+                start_date=datetime.date(2020, 3, 21),
+                end_date=datetime.date(2020, 3, 21),
+                group_by=None,
+                today=today,
+            ),
+            [{'start': datetime.date(2020, 3, 21), 'num_of_new_corona_cases': 2, 'num_of_deaths': 0,
+              'num_of_recoveries': 0}],
+        )
+
+        # A late examination drops the stored buckets of its day (and of the next examination's day)
+        MedicalExaminationResult.objects.create(
+            time=datetime.datetime(year=2020, month=3, day=25),
+            examined_by=self.hospital_worker2,
+            patient=self.patient4,
+            result='Botism',
+        )
+        self.assertFalse(EpidemicCurveBucket.objects.filter(start=datetime.date(2020, 3, 25)).exists())
+        self.assertFalse(EpidemicCurveBucket.objects.filter(start=datetime.date(2020, 3, 26)).exists())
+        self.assertListEqual(
+            EpidemicCurveBucket.objects.get_series(period='week', today=today),
+            self.get_expected_epidemic_curve('week'),
+        )
+
+        # The open bucket isn't stored
+        EpidemicCurveBucket.objects.all().delete()
+        series = EpidemicCurveBucket.objects.get_series(group_by=None, today=datetime.date(2020, 3, 21))
+        self.assertEqual(series[-1]['start'], datetime.date(2020, 3, 21))
+        self.assertListEqual(
+            list(EpidemicCurveBucket.objects.filter(department=None).values_list('start', flat=True)),
+            [datetime.date(2020, 3, 20)],
+        )
+
+    def test_epidemic_curve_view(self):
+        url = reverse('covid_19:api_epidemic_curve')
+        response = self.client.get(url, {'period': 'week', 'group_by': 'total', 'end': '2020-03-31'})
+        self.assertEqual(response.status_code, 200)
+        self.assertListEqual(
+            response.json()['results'],
+            [
+                dict(row, start=row['start'].isoformat())
+                for row in self.get_expected_epidemic_curve('week', None)
+                if row['start'] <= datetime.date(2020, 3, 31)
+            ],
+        )
+
+        for params in ({'period': 'month'}, {'group_by': 'city'}, {'hospital': 'Hadassah'}, {'start': 'yesterday'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+
+    def test_choice_fields_are_stored_as_codes(self):
+        table = MedicalExaminationResult._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT DISTINCT result FROM {table} ORDER BY result'.format(table=table))
+            self.assertListEqual([row[0] for row in cursor.fetchall()], [0, 1, 2, 3])
+
+        # The strings API is unchanged
+        corona_examinations = MedicalExaminationResult.objects.filter(result='Corona')
+        self.assertEqual(corona_examinations.count(), 7)
+        self.assertSetEqual(set(corona_examinations.values_list('result', flat=True)), {'Corona'})
+        self.assertEqual(MedicalExaminationResult.objects.filter(result__in=('Botism', 'Corona')).count(), 10)
+        self.assertEqual(MedicalExaminationResult.objects.exclude(result='Corona').count(), 11)
+        self.assertEqual(MedicalExaminationResult.objects.filter(result='Flu').count(), 0)
+        self.assertEqual(MedicalExaminationResult.objects.exclude(result='Flu').count(), 18)
+        self.assertEqual(MedicalExaminationResult.objects.filter(result__in=('Flu', 'Dead')).count(), 3)
+        # Sorted by the codes
+        self.assertListEqual(
+            list(MedicalExaminationResult.objects.order_by('result').values_list('result', flat=True).distinct()),
+            ['Healthy', 'Corona', 'Botism', 'Dead'],
+        )
+        self.assertEqual(corona_examinations.first().result, 'Corona')
+        self.assertEqual(HospitalWorker.objects.filter(position='Nurse').count(), 4)
+        self.assertEqual(Person.objects.filter(gender='Female').count(), 3)
+        self.assertDictEqual(
+            dict(MedicalExaminationResult.objects.values_list('result').annotate(num=Count('pk')).order_by()),
+            {'Healthy': 5, 'Corona': 7, 'Botism': 3, 'Dead': 3},
+        )
+
+        person = Person.objects.create(name='Noa', age=30, gender=Person.GENDER_UNDEFINED)
+        person.refresh_from_db()
+        self.assertEqual(person.gender, 'Other')
+        person.gender = 'Unknown'
+        with self.assertRaises(ValidationError):
+            person.full_clean()
+        with self.assertRaises(ValueError):
+            person.save()
+
+    def test_sqlite_production_profile(self):
+        database_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, database_dir)
+        path = os.path.join(database_dir, 'production.sqlite3')
+        connections.databases['production'] = dict(
+            connections.databases['default'],
+            NAME=path,
+            COVID_19_SQLITE_PRODUCTION=True,
+            CONN_MAX_AGE=600,
+        )
+        connections.ensure_defaults('production')
+        self.addCleanup(connections.databases.pop, 'production')
+        self.addCleanup(connections['production'].close)
+
+        production_connection = connections['production']
+        self.assertEqual(get_pragma(production_connection, 'journal_mode'), 'wal')
+        self.assertEqual(get_pragma(production_connection, 'synchronous'), 1)  # NORMAL
+        self.assertEqual(get_pragma(production_connection, 'busy_timeout'), 5000)
+        self.assertEqual(get_pragma(production_connection, 'cache_size'), -65536)
+        self.assertEqual(get_pragma(production_connection, 'temp_store'), 2)  # MEMORY
+        # The default database isn't opted in
+        self.assertEqual(get_pragma(connection, 'temp_store'), 0)
+
+        with override_settings(COVID_19_SQLITE_PRAGMAS={'busy_timeout': 100, 'mmap_size': None, 'cache_spill': 0}):
+            self.assertListEqual([name for name, _ in get_pragmas()], [
+                'journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'temp_store', 'cache_spill',
+            ])
+            self.assertEqual(dict(get_pragmas())['busy_timeout'], 100)
+
+        # A writer commits while a reader's transaction is open, the reader keeps its snapshot
+        call_command('migrate', database='production', verbosity=0)
+        reader_connection = sqlite3.connect(path, timeout=0, isolation_level=None)
+        self.addCleanup(reader_connection.close)
+        count_sql = 'SELECT COUNT(*) FROM covid_19_hospital'
+        reader_connection.execute('BEGIN')
+        self.assertEqual(reader_connection.execute(count_sql).fetchone(), (0, ))
+        Hospital.objects.using('production').create(name='Ichilov', city='Tel Aviv')
+        self.assertEqual(reader_connection.execute(count_sql).fetchone(), (0, ))
+        reader_connection.execute('COMMIT')
+        self.assertEqual(reader_connection.execute(count_sql).fetchone(), (1, ))
+
+        stdout = StringIO()
+        call_command('optimize_database', database='production', checkpoint=True, stdout=stdout)
+        self.assertIn('Optimized production', stdout.getvalue())
+        self.assertIn('Checkpointed', stdout.getvalue())
+        call_command('optimize_database', analyze=True, stdout=stdout)
+        self.assertIn('Analyzed default', stdout.getvalue())
+
+    def test_reprs_render_in_constant_number_of_queries(self):
+        examinations = list(MedicalExaminationResult.objects.order_by('pk'))
+        with self.assertNumQueries(len(examinations) * 8):
+            lazy_reprs = [repr(examination) for examination in examinations]
+
+        with self.assertNumQueries(1):
+            reprs = [repr(examination) for examination in MedicalExaminationResult.objects.with_display_related(
+            ).order_by('pk')]
+        self.assertListEqual(reprs, lazy_reprs)
+
+        for model in (Hospital, Department, Person, HospitalWorker, Patient, HospitalDailyStats, EpidemicCurveBucket,
+                      PersonHealthState):
+            with self.assertNumQueries(1):
+                [repr(instance) for instance in model.objects.with_display_related()]
+
+        # Without lazy loads the relations that aren't loaded show as ids
+        examination = MedicalExaminationResult.objects.select_related('patient').get(pk=examinations[0].pk)
+        with self.assertNumQueries(0), without_lazy_loads():
+            examination_repr = repr(examination)
+        self.assertIn('examined_by <HospitalWorker id {id}>'.format(id=examination.examined_by_id), examination_repr)
+        with self.assertNumQueries(0), override_settings(COVID_19_REPR_LAZY_LOADS=False):
+            self.assertEqual(repr(examination.patient), '<Patient <Person id {person_id}> in <Department id '
+                                                        '{department_id}>>'.format(
+                                                            person_id=examination.patient.person_id,
+                                                            department_id=examination.patient.department_id,
+                                                        ))
+        with self.assertNumQueries(1), without_lazy_loads():
+            self.assertListEqual([repr(examination) for examination in MedicalExaminationResult.objects.order_by(
+                'pk').with_display_related()], lazy_reprs)
+
+    def test_person_health_state_follows_examinations(self):
+        def get_health_state(person):
+            return PersonHealthState.objects.get(person=person)
+
+        self.assertDictEqual(get_health_state(self.person10).get_state_values(), {
+            'state': PersonHealthState.STATE_DEAD,
+            'last_result': MedicalExaminationResult.RESULT_DEAD,
+            'last_examination_id': MedicalExaminationResult.objects.filter(
+                patient=self.patient8,
+            ).latest('time').pk,
+            'last_examination_time': datetime.datetime(2020, 4, 28, 11, 10),
+            'first_corona_time': datetime.datetime(2020, 4, 26, 16, 10),
+            'death_time': datetime.datetime(2020, 4, 28, 11, 10),
+            'num_of_examinations': 4,
+            'num_of_infections': 2,
+            'num_of_recoveries': 1,
+        })
+        self.assertListEqual(
+            list(Person.objects.filter_by_health_state(PersonHealthState.STATE_RECOVERED)),
+            [self.person5],
+        )
+        with self.assertNumQueries(1):
+            sick_persons = set(Person.objects.get_sick_persons(from_health_state=True))
+        self.assertSetEqual(sick_persons, set(Person.objects.get_sick_persons()))
+        self.assertSetEqual(
+            set(HospitalWorker.objects.get_sick_workers(from_health_state=True)),
+            set(HospitalWorker.objects.get_sick_workers()),
+        )
+        self.assertListEqual(
+            list(Hospital.objects.annotate_by_num_of_dead_from_corona(from_health_state=True).order_by(
+                'pk',
+            ).values_list('num_of_dead_from_corona', flat=True)),
+            list(Hospital.objects.annotate_by_num_of_dead_from_corona().order_by('pk').values_list(
+                'num_of_dead_from_corona',
+                flat=True,
+            )),
+        )
+
+        # The latest examination advances the state without reading the history
+        examination = MedicalExaminationResult.objects.create(
+            patient=self.patient3,
+            examined_by=self.hospital_worker1,
+            time=datetime.datetime(2020, 3, 22, 9, 0),
+            result=MedicalExaminationResult.RESULT_CORONA,
+        )
+        health_state = get_health_state(self.person4)
+        self.assertEqual(health_state.state, PersonHealthState.STATE_SICK)
+        self.assertEqual(health_state.first_corona_time, datetime.datetime(2020, 3, 22, 9, 0))
+        self.assertEqual((health_state.num_of_examinations, health_state.num_of_infections), (2, 1))
+
+        # An examination out of order reprocesses its person
+        MedicalExaminationResult.objects.create(
+            patient=self.patient3,
+            examined_by=self.hospital_worker1,
+            time=datetime.datetime(2020, 3, 20, 9, 0),
+            result=MedicalExaminationResult.RESULT_CORONA,
+        )
+        health_state = get_health_state(self.person4)
+        self.assertEqual(health_state.state, PersonHealthState.STATE_SICK)
+        self.assertEqual(health_state.first_corona_time, datetime.datetime(2020, 3, 20, 9, 0))
+        self.assertEqual((health_state.num_of_infections, health_state.num_of_recoveries), (2, 1))
+
+        examination.result = MedicalExaminationResult.RESULT_DEAD
+        examination.save()
+        self.assertEqual(get_health_state(self.person4).state, PersonHealthState.STATE_DEAD)
+        examination.delete()
+        self.assertEqual(get_health_state(self.person4).state, PersonHealthState.STATE_RECOVERED)
+
+        # Daniel's examinations move to Ruby's history
+        self.patient7.person = self.person10
+        self.patient7.save()
+        self.assertFalse(PersonHealthState.objects.filter(person=self.person9).exists())
+        self.assertEqual(get_health_state(self.person10).num_of_examinations, 6)
+        self.assertListEqual(Person.objects.get_persons_with_inconsistent_health_state(), [])
+
+        # Writes bypassing the signals are found by the check and fixed by the rebuild
+        PersonHealthState.objects.filter(person=self.person3).update(state=PersonHealthState.STATE_HEALTHY)
+        PersonHealthState.objects.filter(person=self.person5).delete()
+        self.assertListEqual(
+            [person for person, _, _ in Person.objects.get_persons_with_inconsistent_health_state()],
+            [self.person3, self.person5],
+        )
+        with self.assertRaises(CommandError):
+            call_command('rebuild_health_states', check=True, stdout=StringIO(), stderr=StringIO())
+        call_command('rebuild_health_states', stdout=StringIO())
+        call_command('rebuild_health_states', check=True, batch_size=3, stdout=StringIO())
+        self.assertEqual(get_health_state(self.person3).state, PersonHealthState.STATE_SICK)
+
+        # Examinations at the same time follow each other by id, in the history and the previous results alike
+        for result in (MedicalExaminationResult.RESULT_CORONA, MedicalExaminationResult.RESULT_DEAD):
+            examination = MedicalExaminationResult.objects.create(
+                patient=self.patient1,
+                examined_by=self.hospital_worker1,
+                time=datetime.datetime(2020, 5, 1, 12, 0),
+                result=result,
+            )
+        self.assertEqual(get_health_state(self.person3).state, PersonHealthState.STATE_DEAD_FROM_CORONA)
+        self.assertIn(examination, MedicalExaminationResult.objects.filter_deaths_after_corona())
+        self.assertListEqual(Person.objects.get_persons_with_inconsistent_health_state(), [])
+
+        # The migration creating the table backfills it from the history
+        migration = import_module('django_advanced_queries.covid_19.migrations.0010_person_health_state')
+        PersonHealthState.objects.all().delete()
+        migration.backfill_person_health_states(apps, connection.schema_editor())
+        self.assertEqual(PersonHealthState.objects.count(), Patient.objects.values('person').distinct().count())
+        self.assertListEqual(Person.objects.get_persons_with_inconsistent_health_state(), [])
+
     def test_define_new_test_and_send_to_me(self):
         # Define test that use at least one function that was not used in the previous tests and send to me
         # Include the solution
         self.fail()
+
+
+@override_settings(
+    COVID_19_QUERY_CACHE=True,
+    COVID_19_QUERY_CACHE_BACKEND='django_advanced_queries.covid_19.caching.local_backend',
+)
+class QueryCacheTests(TransactionTestCase):
+    """Outside of TestCase's transaction, the queries inside a transaction bypass the cache."""
+
+    def setUp(self):
+        super(QueryCacheTests, self).setUp()
+        for handle, instance in create_scenario().items():
+            setattr(self, handle, instance)
+        caching.local_backend.clear()
+        caching.stats.reset()
+
+    def test_aggregate_manager_methods_are_cached_until_their_models_change(self):
+        def get_avg_ages_of_patients():
+            return [department.avg_age_of_patients
+                    for department in Department.objects.annotate_avg_age_of_patients().order_by('pk')]
+
+        with self.assertNumQueries(2):
+            avg_ages_of_patients = get_avg_ages_of_patients()
+            highest_num_of_examinations = Patient.objects.get_highest_num_of_patient_medical_examinations()
+        with self.assertNumQueries(0):
+            self.assertListEqual(get_avg_ages_of_patients(), avg_ages_of_patients)
+            self.assertEqual(
+                Patient.objects.get_highest_num_of_patient_medical_examinations(),
+                highest_num_of_examinations,
+            )
+        # Chained querysets are cached by their own query
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Department.objects.annotate_avg_age_of_patients().filter(hospital=self.hospital1)), 1)
+            self.assertEqual(len(Department.objects.annotate_avg_age_of_patients().filter(hospital=self.hospital1)), 1)
+
+        # Only the entries depending on the changed model are invalidated
+        Person.objects.filter(name='Rony').update(age=F('age') + 10)
+        with self.assertNumQueries(1):
+            self.assertNotEqual(get_avg_ages_of_patients(), avg_ages_of_patients)
+            self.assertEqual(
+                Patient.objects.get_highest_num_of_patient_medical_examinations(),
+                highest_num_of_examinations,
+            )
+
+        # Patient1 has 2 examinations
+        for _ in range(highest_num_of_examinations - 1):
+            MedicalExaminationResult.objects.create(
+                time=datetime.datetime(year=2020, month=5, day=2),
+                examined_by=self.hospital_worker1,
+                patient=self.patient1,
+                result='Healthy'
+            )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Patient.objects.get_highest_num_of_patient_medical_examinations(),
+                highest_num_of_examinations + 1,
+            )
+
+        self.assertDictEqual(caching.stats.snapshot()['Department.annotate_avg_age_of_patients'], {
+            'hits': 2, 'misses': 3, 'hit_ratio': 0.4,
+        })
+        highest_num_of_examinations_stats = caching.get_stats()['methods'][
+            'Patient.get_highest_num_of_patient_medical_examinations'
+        ]
+        self.assertEqual(highest_num_of_examinations_stats['hits'], 2)
+
+        caching.local_backend.clear()
+        with override_settings(COVID_19_QUERY_CACHE_MAX_ENTRIES=1), self.assertNumQueries(3):
+            get_avg_ages_of_patients()
+            Patient.objects.get_highest_num_of_patient_medical_examinations()
+            get_avg_ages_of_patients()
+        self.assertEqual(len(caching.local_backend), 1)
+
+        caching.local_backend.clear()
+        with override_settings(COVID_19_QUERY_CACHE_TTL=0), self.assertNumQueries(2):
+            get_avg_ages_of_patients()
+            get_avg_ages_of_patients()
+
+        with override_settings(
+            COVID_19_QUERY_CACHE_BACKEND='django_advanced_queries.covid_19.caching.django_cache_backend',
+        ):
+            with self.assertNumQueries(1):
+                self.assertListEqual(get_avg_ages_of_patients(), get_avg_ages_of_patients())
+            Person.objects.filter(name='Rony').update(age=F('age') - 10)
+            with self.assertNumQueries(1):
+                self.assertListEqual(get_avg_ages_of_patients(), avg_ages_of_patients)
+
+        with override_settings(COVID_19_QUERY_CACHE=False), self.assertNumQueries(2):
+            get_avg_ages_of_patients()
+            get_avg_ages_of_patients()
+
+    def test_replicas_share_the_cached_results(self):
+        # Replicas of the test database
+        for alias in ('replica_0', 'replica_1'):
+            connections.databases[alias] = dict(connections.databases['default'])
+            connections.ensure_defaults(alias)
+            self.addCleanup(connections.databases.pop, alias)
+            self.addCleanup(connections[alias].close)
+
+        avg_ages_of_patients = []
+        with override_settings(COVID_19_READ_REPLICAS=['replica_0', 'replica_1']):
+            for alias in ('replica_0', 'replica_1'):
+                with mock.patch('django_advanced_queries.covid_19.routers.random.choice', return_value=alias):
+                    departments = Department.objects.annotate_avg_age_of_patients().order_by('pk')
+                    self.assertEqual(departments.db, alias)
+                    avg_ages_of_patients.append([department.avg_age_of_patients for department in departments])
+        self.assertListEqual(avg_ages_of_patients[1], avg_ages_of_patients[0])
+
+        self.assertDictEqual(caching.stats.snapshot()['Department.annotate_avg_age_of_patients'], {
+            'hits': 1, 'misses': 1, 'hit_ratio': 0.5,
+        })
+
+    def test_cache_is_invalidated_once_the_writes_commit(self):
+        def get_avg_ages_of_patients():
+            return [department.avg_age_of_patients
+                    for department in Department.objects.annotate_avg_age_of_patients().order_by('pk')]
+
+        avg_ages_of_patients = get_avg_ages_of_patients()
+        # Not served from nor stored in the cache inside a transaction, it reads its own writes
+        with transaction.atomic():
+            Person.objects.filter(name='Rony').update(age=F('age') + 10)
+            with self.assertNumQueries(2):
+                self.assertNotEqual(get_avg_ages_of_patients(), avg_ages_of_patients)
+                get_avg_ages_of_patients()
+            # Until the commit the other connections read the committed rows, still cached
+            self.assertEqual(caching.local_backend.get_versions(['covid_19.Person']), [0])
+        self.assertEqual(caching.local_backend.get_versions(['covid_19.Person']), [1])
+        with self.assertNumQueries(1):
+            self.assertNotEqual(get_avg_ages_of_patients(), avg_ages_of_patients)
+
+        # A rolled back write doesn't invalidate
+        changed_avg_ages_of_patients = get_avg_ages_of_patients()
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            Person.objects.filter(name='Rony').update(age=F('age') + 10)
+            raise DatabaseError
+        self.assertEqual(caching.local_backend.get_versions(['covid_19.Person']), [1])
+        with self.assertNumQueries(0):
+            self.assertListEqual(get_avg_ages_of_patients(), changed_avg_ages_of_patients)
+
+
+
+class CovidDataGeneratorTests(TestCase):
+
+    def test_generate_covid_data(self):
+        num_of_examinations = CovidDataGenerator(seed=7, batch_size=100).generate(
+            num_of_hospitals=3,
+            num_of_persons=500,
+            exams_per_patient=4,
+        )
+
+        self.assertEqual(Hospital.objects.count(), 3)
+        self.assertEqual(Person.objects.count(), 500)
+        self.assertEqual(MedicalExaminationResult.objects.count(), num_of_examinations)
+        self.assertTrue(Person.objects.persons_with_multiple_jobs().exists())
+        self.assertTrue(Patient.objects.filter_dead_from_corona().exists())
+
+        # Nobody is examined after their death
+        self.assertFalse(MedicalExaminationResult.objects.filter(
+            patient__last_medical_examination_result__result='Dead',
+            patient__last_medical_examination_result__time__lt=F('time'),
+        ).exists())
+
+        # The generated pointers are the same as the ones computed from the history
+        last_medical_examination_results = dict(Patient.objects.values_list('pk', 'last_medical_examination_result'))
+        Patient.objects.refresh_last_medical_examination_result()
+        self.assertDictEqual(
+            dict(Patient.objects.values_list('pk', 'last_medical_examination_result')),
+            last_medical_examination_results,
+        )
+
+
+class BenchmarksTests(TestCase):
+
+    def test_benchmark_manager_methods(self):
+        CovidDataGenerator(seed=7).generate(num_of_hospitals=2, num_of_persons=200, exams_per_patient=3)
+        report = {'200': {'methods': {
+            name: benchmark(func, using='default', repeat=2) for name, func in MANAGER_METHODS_BENCHMARKS
+        }}}
+
+        for measurements in report['200']['methods'].values():
+            self.assertEqual(measurements['num_of_queries'], 1)
+            self.assertLessEqual(measurements['median_ms'], measurements['p95_ms'])
+
+        self.assertListEqual(compare_to_baseline(report, report, tolerance=1.2), [])
+
+        epidemic_curve_report = {
+            name: benchmark(func, using='default', repeat=2) for name, func in EPIDEMIC_CURVE_BENCHMARKS
+        }
+        # The first examination time, the stored buckets and the open bucket
+        self.assertEqual(epidemic_curve_report['EpidemicCurveBucket.get_series']['num_of_queries'], 3)
+        self.assertEqual(epidemic_curve_report['EpidemicCurveBucket.compute_whole_history']['num_of_queries'], 1)
+
+        name = 'Person.get_sick_persons'
+        slower_report = {'200': {'methods': {name: dict(
+            report['200']['methods'][name],
+            median_ms=report['200']['methods'][name]['median_ms'] * 2 + 1,
+            num_of_queries=2,
+        )}}}
+        self.assertEqual(len(compare_to_baseline(slower_report, report, tolerance=1.2)), 2)
+
+    def test_benchmark_sqlite_concurrency(self):
+        database_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, database_dir)
+        self.addCleanup(connections.databases.pop, 'benchmark_200')
+        self.addCleanup(lambda: connections['benchmark_200'].close())
+
+        report = run_concurrency_benchmarks(200, database_dir, num_of_readers=2, num_of_writers=1, duration=0.5,
+                                            seed=7)
+        self.assertListEqual(sorted(report), ['default', 'production'])
+        for measurements in report.values():
+            self.assertEqual(measurements['read_patient_report']['num_of_threads'], 2)
+            self.assertGreater(measurements['read_patient_report']['num_of_operations'], 0)
+            self.assertGreater(measurements['write_examination']['num_of_operations'], 0)
+            self.assertLessEqual(measurements['write_examination']['locked_error_rate'], 1)
+        # Every profile ran on its own copy
+        self.assertListEqual(os.listdir(database_dir), ['benchmark_200.sqlite3'])
+
+
+class ScaledCovidScenarioTests(CovidScenarioTestCase):
+    scenario_copies = 25
+
+    def test_scaled_scenario(self):
+        # The handles are those of the first copy
+        self.assertEqual(Hospital.objects.get(pk=self.hospital2.pk).name, 'Hadassah')
+        self.assertEqual(self.patient8.person.name, 'Ruby')
+        self.assertEqual(Hospital.objects.filter(name='Hadassah #25').count(), 1)
+
+        self.assertEqual(MedicalExaminationResult.objects.count(), 18 * 25)
+        with self.assertNumQueries(1):
+            self.assertEqual(Person.objects.get_sick_persons().count(), 3 * 25)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Person.objects.persons_with_multiple_jobs()), 2 * 25)
+        self.assertEqual(HospitalDailyStats.objects.aggregate(num=Sum('num_of_deaths'))['num'], 3 * 25)
+        self.assertListEqual(list(Person.objects.get_persons_with_inconsistent_jobs()), [])
+
+
+@override_settings(COVID_19_SHARDS=['shard_0', 'shard_1'])
+class HospitalShardingTests(TestCase):
+    def setUp(self):
+        super(HospitalShardingTests, self).setUp()
+        # Local SQLite files stand in for the shards
+        shards_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shards_dir)
+        for alias in ('shard_0', 'shard_1'):
+            connections.databases[alias] = dict(
+                connections.databases['default'],
+                NAME=os.path.join(shards_dir, '{alias}.sqlite3'.format(alias=alias)),
+            )
+            connections.ensure_defaults(alias)
+            self.addCleanup(connections.databases.pop, alias)
+            # The next test's shards are other files
+            self.addCleanup(connections.__delitem__, alias)
+            self.addCleanup(connections[alias].close)
+            call_command('migrate', database=alias, verbosity=0)
+
+    def create_hospital(self, num, results_per_patient):
+        """A hospital with a doctor examining its patients, `results_per_patient` results each."""
+        hospital = create_hospital(name='Hospital {num}'.format(num=num), city='Tel Aviv')
+        # Created through the hospital, the rows go to its shard
+        department = hospital.departments.create(name='Critical Care')
+        person = Person.objects.create(name='Doctor {num}'.format(num=num), age=40, gender='Female')
+        worker = department.hospital_workers.create(person=copy_person(person, hospital._state.db), position='Doctor')
+        for results in results_per_patient:
+            patient_person = Person.objects.create(name='Patient', age=70, gender='Male')
+            patient = department.patients_details.create(person=copy_person(patient_person, hospital._state.db))
+            for day, result in enumerate(results, 1):
+                patient.medical_examination_results.create(
+                    examined_by=worker,
+                    time=datetime.datetime(2020, 4, day, 12, 0),
+                    result=result,
+                )
+        return hospital, worker
+
+    def test_hospitals_are_sharded_and_manager_methods_fan_out(self):
+        hospital1, worker1 = self.create_hospital(1, [['Corona', 'Dead'], ['Healthy']])
+        hospital2, worker2 = self.create_hospital(2, [['Corona', 'Dead'], ['Corona', 'Corona', 'Dead']])
+        hospital3, worker3 = self.create_hospital(3, [['Healthy', 'Healthy', 'Healthy', 'Healthy']])
+
+        self.assertListEqual(
+            [hospital._state.db for hospital in (hospital1, hospital2, hospital3)],
+            ['shard_1', 'shard_0', 'shard_1'],
+        )
+        self.assertEqual(Hospital.objects.using('shard_1').count(), 2)
+        self.assertEqual(MedicalExaminationResult.objects.using('shard_0').count(), 5)
+        self.assertFalse(MedicalExaminationResult.objects.using('default').exists())
+        # The relations of a shard's rows are read from the shard, and its rollups are maintained there
+        examination = MedicalExaminationResult.objects.using('shard_0').order_by('pk').first()
+        self.assertEqual(examination.patient.department.hospital, hospital2)
+        self.assertEqual(HospitalDailyStats.objects.using('shard_0').aggregate(
+            num=Sum('num_of_deaths_after_corona'),
+        )['num'], 2)
+        with self.assertRaises(ValueError):
+            Patient(person=worker1.person, department=worker2.department)
+
+        hospitals = Hospital.objects.annotate_by_num_of_dead_from_corona()
+        self.assertListEqual(
+            [(hospital, hospital.num_of_dead_from_corona, hospital._state.db) for hospital in hospitals],
+            [(hospital1, 1, 'shard_1'), (hospital2, 2, 'shard_0'), (hospital3, 0, 'shard_1')],
+        )
+        self.assertListEqual([hospital.num_of_departments for hospital in Hospital.objects.dashboard()], [1, 1, 1])
+        self.assertEqual(Patient.objects.get_highest_num_of_patient_medical_examinations(), 4)
+        worker = HospitalWorker.objects.get_worker_performed_most_medical_examinations({'position': 'Doctor'}, {})
+        self.assertEqual((worker, worker.num_of_medical_examinations, worker._state.db), (worker2, 5, 'shard_0'))
+
+        # An explicit database runs on that database only
+        self.assertEqual(Patient.objects.using('shard_1').get_highest_num_of_patient_medical_examinations(), 4)
+        self.assertListEqual(
+            list(Hospital.objects.using('shard_1').annotate_by_num_of_dead_from_corona().order_by(
+                'pk',
+            ).values_list('num_of_dead_from_corona', flat=True)),
+            [1, 0],
+        )
+
+    def test_sharded_querysets_chain(self):
+        hospital1, worker1 = self.create_hospital(1, [['Corona', 'Dead'], ['Healthy']])
+        hospital2, worker2 = self.create_hospital(2, [['Corona', 'Dead'], ['Corona', 'Corona', 'Dead']])
+        hospital3, worker3 = self.create_hospital(3, [['Healthy', 'Healthy', 'Healthy', 'Healthy']])
+        hospital4, worker4 = self.create_hospital(4, [['Healthy', 'Corona']])
+
+        hospitals = Hospital.objects.annotate_by_num_of_dead_from_corona()
+        self.assertIsInstance(hospitals, ShardedQuerySet)
+        self.assertListEqual(
+            list(hospitals.order_by('-pk').values_list('num_of_dead_from_corona', flat=True)),
+            [0, 0, 2, 1],
+        )
+        self.assertListEqual(list(hospitals.filter(num_of_dead_from_corona__gt=0)), [hospital1, hospital2])
+        self.assertListEqual(
+            list(Hospital.objects.annotate_by_num_of_hospital_workers_in_risk_of_corona().values_list(
+                'pk',
+                'num_of_hospital_workers_in_risk_of_corona',
+            ).order_by('pk')),
+            [(hospital1.pk, 0), (hospital2.pk, 0), (hospital3.pk, 0), (hospital4.pk, 0)],
+        )
+        self.assertListEqual(
+            list(Hospital.objects.dashboard().order_by('-num_of_sick_patients', 'pk').values(
+                'pk',
+                'num_of_sick_patients',
+            )),
+            [
+                {'pk': hospital4.pk, 'num_of_sick_patients': 1},
+                {'pk': hospital1.pk, 'num_of_sick_patients': 0},
+                {'pk': hospital2.pk, 'num_of_sick_patients': 0},
+                {'pk': hospital3.pk, 'num_of_sick_patients': 0},
+            ],
+        )
+        # Every shard reads at most the slice
+        self.assertListEqual(Hospital.objects.dashboard().order_by('-pk')[:2], [hospital4, hospital3])
+        self.assertEqual(Hospital.objects.dashboard().order_by('-pk')[1], hospital3)
+        self.assertEqual(Hospital.objects.dashboard().first(), hospital1)
+        self.assertEqual(Hospital.objects.dashboard().filter(num_of_departments=1).count(), 4)
+        self.assertListEqual(
+            list(Department.objects.annotate_avg_age_of_patients().values_list('avg_age_of_patients', flat=True)),
+            [70, 70, 70, 70],
+        )
+
+        self.assertEqual(Patient.objects.filter_dead_from_corona().count(), 3)
+        self.assertSetEqual(
+            {patient.department.hospital for patient in Patient.objects.filter_dead_from_corona()},
+            {hospital1, hospital2},
+        )
+        self.assertEqual(Patient.objects.filter_by_examinations_results_options(['Healthy']).count(), 3)
+        self.assertEqual(MedicalExaminationResult.objects.filter_deaths_after_corona().count(), 3)
+        # The rows are merged by their own fields
+        with self.assertRaises(ValueError):
+            list(Patient.objects.filter_dead_from_corona().order_by('department__name'))
+        with self.assertRaises(AttributeError):
+            Patient.objects.filter_dead_from_corona().aggregate(Count('pk'))
+
+        # The persons are copied on every shard, their jobs and examinations don't merge
+        for get_queryset in (
+                lambda persons, workers: persons.get_sick_persons(),
+                lambda persons, workers: persons.persons_with_multiple_jobs(),
+                lambda persons, workers: persons.filter_by_health_state(PersonHealthState.STATE_SICK),
+                lambda persons, workers: workers.get_sick_workers(),
+                # The ids of the workers repeat across the shards
+                lambda persons, workers: Patient.objects.filter_by_examined_hospital_workers([worker2]),
+        ):
+            with self.assertRaises(ValueError):
+                get_queryset(Person.objects, HospitalWorker.objects)
+        self.assertListEqual(
+            list(Person.objects.using('shard_0').get_sick_persons()),
+            [hospital4.departments.get().patients_details.get().person],
+        )
+        self.assertListEqual(list(HospitalWorker.objects.using('shard_0').get_sick_workers()), [])
+        self.assertEqual(Patient.objects.using('shard_0').filter_by_examined_hospital_workers([worker2]).count(), 2)
+
+
+class ReportJobTests(CovidScenarioTestCase):
+    def test_report_jobs_are_deduplicated_and_claimed_by_priority(self):
+        job1 = submit_report('persons_with_multiple_jobs')
+        self.assertEqual(submit_report('persons_with_multiple_jobs', {}), job1)
+        job2 = submit_report('persons_with_multiple_jobs', {'jobs': ['Nurse']})
+        self.assertNotEqual(job2, job1)
+        job3 = submit_report('dead_from_corona_ranking', {'limit': 1}, priority=5)
+        self.assertEqual(ReportJob.objects.count(), 3)
+        with self.assertRaises(ValueError):
+            submit_report('persons_with_no_jobs')
+        with self.assertRaises(ValueError):
+            submit_report('persons_with_multiple_jobs', {'position': 'Nurse'})
+        # Beyond the report's limits
+        for report, params in (
+                ('persons_with_multiple_jobs', {'jobs': ['Janitor']}),
+                ('dead_from_corona_ranking', {'limit': '1'}),
+                ('exposures', {'hospital_worker_ids': list(range(1, MAX_EXPOSURES_SEEDS + 2))}),
+                ('exposures', {'hospital_worker_ids': [self.hospital_worker2.pk], 'max_hops': MAX_EXPOSURES_HOPS + 1}),
+                ('exposures', {'hospital_worker_ids': [self.hospital_worker2.pk], 'start_time': 'yesterday'}),
+        ):
+            with self.assertRaises(ValueError):
+                submit_report(report, params)
+        self.assertEqual(ReportJob.objects.count(), 3)
+
+        # A higher priority submission raises the pending job's
+        self.assertEqual(submit_report('persons_with_multiple_jobs', {'jobs': ['Nurse']}, priority=7), job2)
+        lease = datetime.timedelta(minutes=1)
+        self.assertListEqual(
+            [ReportJob.objects.claim('worker', lease) for _ in range(4)],
+            [job2, job3, job1, None],
+        )
+        job = ReportJob.objects.get(pk=job2.pk)
+        self.assertEqual((job.status, job.attempts, job.worker), (ReportJob.STATUS_RUNNING, 1, 'worker'))
+        # Running jobs are still deduplicated
+        self.assertEqual(submit_report('persons_with_multiple_jobs'), job1)
+
+    def test_report_worker_stores_the_results(self):
+        jobs = [
+            submit_report('persons_with_multiple_jobs', {'jobs': ['Doctor', 'Nurse']}),
+            submit_report('dead_from_corona_ranking'),
+            submit_report('exposures', {'hospital_worker_ids': [self.hospital_worker2.pk], 'max_hops': 1}),
+        ]
+        worker = ReportWorker(name='worker')
+        worker.run(burst=True)
+        self.assertEqual((worker.num_of_succeeded, worker.num_of_failed), (3, 0))
+
+        jobs = [ReportJob.objects.get(pk=job.pk) for job in jobs]
+        self.assertListEqual([job.status for job in jobs], [ReportJob.STATUS_SUCCEEDED] * 3)
+        self.assertListEqual(
+            jobs[0].get_result(),
+            [{'id': self.person6.pk, 'name': 'Ron', 'num_of_jobs': 3}],
+        )
+        self.assertListEqual(jobs[1].get_result(), json.loads(json.dumps(get_dead_from_corona_ranking())))
+        self.assertListEqual(
+            [(exposure['person_id'], exposure['depth']) for exposure in jobs[2].get_result()],
+            [(self.person5.pk, 1), (self.person1.pk, 1), (self.person4.pk, 1)],
+        )
+        # A finished report is computed again
+        self.assertNotEqual(submit_report('dead_from_corona_ranking'), jobs[1])
+
+    def test_failing_report_jobs_are_retried_then_failed(self):
+        job = submit_report('exposures', {'hospital_worker_ids': []}, max_attempts=2)
+        tracing_failed = ValueError('Tracing failed')
+        worker = ReportWorker(name='worker', retry_delay=60)
+        with self.assertLogs('django_advanced_queries.covid_19.reports', 'ERROR'), \
+                mock.patch('django_advanced_queries.covid_19.reports.trace_exposures', side_effect=tracing_failed):
+            worker.run(burst=True)
+        job = ReportJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.attempts, worker.num_of_failed), (ReportJob.STATUS_PENDING, 1, 1))
+        self.assertIn('Tracing failed', job.error)
+        self.assertGreater(job.available_at, job.started_at)
+
+        ReportJob.objects.filter(pk=job.pk).update(available_at=job.started_at)
+        with self.assertLogs('django_advanced_queries.covid_19.reports', 'ERROR'), \
+                mock.patch('django_advanced_queries.covid_19.reports.trace_exposures', side_effect=tracing_failed):
+            ReportWorker(name='worker', retry_delay=60).run(burst=True)
+        job = ReportJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.attempts, job.dedup_key), (ReportJob.STATUS_FAILED, 2, None))
+
+    def test_report_jobs_of_expired_leases_are_requeued(self):
+        job = submit_report('dead_from_corona_ranking')
+        job = ReportJob.objects.claim('dead worker', datetime.timedelta(seconds=-1))
+        ReportJob.objects.requeue_expired()
+        self.assertEqual(ReportJob.objects.get(pk=job.pk).status, ReportJob.STATUS_PENDING)
+        # The worker that lost its lease doesn't overwrite the job
+        self.assertFalse(job.succeed('dead worker', []))
+
+        out = StringIO()
+        call_command('run_report_worker', '--burst', '--name', 'worker', stdout=out)
+        self.assertIn('worker: 1 jobs succeeded, 0 failed', out.getvalue())
+        job = ReportJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.attempts, job.worker), (ReportJob.STATUS_SUCCEEDED, 2, 'worker'))
+
+    def test_report_api_submits_and_polls_jobs(self):
+        def submit(body, client=self.client):
+            return client.post(
+                reverse('covid_19:api_submit_report'),
+                json.dumps(body),
+                content_type='application/json',
+            )
+
+        # Staff users only, with the CSRF token of their session
+        self.assertEqual(submit({'report': 'dead_from_corona_ranking'}).status_code, 403)
+        staff_user = User.objects.create_user('staff', is_staff=True)
+        csrf_client = Client(enforce_csrf_checks=True)
+        csrf_client.force_login(staff_user)
+        self.assertEqual(submit({'report': 'dead_from_corona_ranking'}, csrf_client).status_code, 403)
+        self.client.force_login(staff_user)
+
+        response = submit({'report': 'dead_from_corona_ranking', 'params': {'limit': 1}})
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual(job['status'], ReportJob.STATUS_PENDING)
+        self.assertEqual(submit({'report': 'dead_from_corona_ranking', 'params': {'limit': 1}}).json()['id'], job['id'])
+        self.assertEqual(submit({'report': 'dead_from_corona_ranking', 'params': []}).status_code, 400)
+        self.assertEqual(submit({'report': 'unknown'}).status_code, 400)
+        self.assertEqual(submit({'report': 'exposures', 'params': {'max_hops': 100}}).status_code, 400)
+        self.assertEqual(self.client.get(job['url']).json()['status'], ReportJob.STATUS_PENDING)
+
+        # The jobs are their user's
+        other_client = Client()
+        other_client.force_login(User.objects.create_user('other staff', is_staff=True))
+        self.assertEqual(other_client.get(job['url']).status_code, 404)
+        other_job = submit({'report': 'dead_from_corona_ranking', 'params': {'limit': 1}}, other_client).json()
+        self.assertNotEqual(other_job['id'], job['id'])
+        self.assertEqual(ReportJob.objects.get(pk=job['id']).submitted_by, staff_user)
+
+        ReportWorker().run(burst=True)
+        job = self.client.get(job['url']).json()
+        self.assertEqual(job['status'], ReportJob.STATUS_SUCCEEDED)
+        self.assertListEqual(job['result'], get_dead_from_corona_ranking(limit=1))
+        self.assertEqual(self.client.get(reverse('covid_19:api_report', args=(job['id'] + 1, ))).status_code, 404)
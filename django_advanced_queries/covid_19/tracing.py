@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Multi hop contact tracing over the medical examinations.
+
+Every examination is an exposure edge between persons: the examining worker's person exposes the
+examined patient's person at the examination time. A person who is both a patient and a worker (as
+Alon and Dana) carries the exposure on to the patients they examine afterwards.
+
+The edges are loaded with a single query into a compressed sparse row structure of flat arrays (the
+edges of a person are a contiguous, time ordered slice), then traced in memory - the number of
+queries doesn't depend on the number of seeds or hops. `trace_exposures()` loads only the edges of the
+persons reachable from the seeds (a recursive CTE finds them in the same query), `ExposureGraph.load()`
+every edge of the time range, to trace many times.
+"""
+from __future__ import unicode_literals
+
+import bisect
+import collections
+import datetime
+from array import array
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import BooleanField, QuerySet
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from django_advanced_queries.covid_19.functions import EpochMicroseconds
+from django_advanced_queries.covid_19.models import HospitalWorker, MedicalExaminationResult, Patient, Person
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# A traced person, `path` holds the person ids from the seed to the person (both included)
+Exposure = collections.namedtuple('Exposure', ('person_id', 'depth', 'time', 'path'))
+
+
+def _to_microseconds(value):
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    delta = value - EPOCH
+    # Exact in a double for any realistic date
+    return float((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _from_microseconds(value):
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def _iter_edges(examinations, batch_size=10000):
+    """(examiner person id, examined person id, time in microseconds) of the examinations."""
+    connection = connections[examinations.db]
+    if connection.vendor not in EpochMicroseconds.vendors:
+        rows = examinations.values_list('examined_by__person', 'patient__person', 'time').iterator()
+        for source_id, target_id, time in rows:
+            yield source_id, target_id, _to_microseconds(time)
+        return
+
+    # Plain cursor rows, the ORM's per value conversions cost as much as the query
+    sql, params = examinations.annotate(
+        epoch_time=EpochMicroseconds('time'),
+    ).values_list('examined_by__person', 'patient__person', 'epoch_time').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+def _get_reachable_condition(seed_person_ids, max_hops, start_time, end_time, using):
+    """
+    Whether an examination is by a person within `max_hops - 1` examinations of the seeds, one whose
+    exposures a trace of `max_hops` may follow - a superset, the times along the chain aren't checked.
+    """
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+
+    def column(alias, model, field_name):
+        return '{alias}.{column}'.format(
+            alias=quote_name(alias),
+            column=quote_name(model._meta.get_field(field_name).column),
+        )
+
+    def table(alias, model):
+        return '{table} {alias}'.format(table=quote_name(model._meta.db_table), alias=quote_name(alias))
+
+    time_conditions = []
+    params = [max_hops - 1]
+    if start_time is not None:
+        time_conditions.append(' AND {} >= %s'.format(column('exposure', MedicalExaminationResult, 'time')))
+        params.append(connection.ops.adapt_datetimefield_value(start_time))
+    if end_time is not None:
+        time_conditions.append(' AND {} <= %s'.format(column('exposure', MedicalExaminationResult, 'time')))
+        params.append(connection.ops.adapt_datetimefield_value(end_time))
+
+    sql = (
+        '{examined_by_id} IN ('
+        'WITH RECURSIVE reached (person_id, depth) AS ('
+        'SELECT {seed_id}, 0 FROM {seed} WHERE {seed_id} IN ({seed_person_ids}) '
+        'UNION '
+        'SELECT {patient_person_id}, reached.depth + 1 FROM reached '
+        'INNER JOIN {worker} ON {worker_person_id} = reached.person_id '
+        'INNER JOIN {exposure} ON {exposure_examined_by_id} = {worker_id} '
+        'INNER JOIN {patient} ON {patient_id} = {exposure_patient_id} '
+        'WHERE reached.depth < %s{time_conditions}'
+        ') '
+        'SELECT {worker_id} FROM reached INNER JOIN {worker} ON {worker_person_id} = reached.person_id'
+        ')'
+    ).format(
+        examined_by_id='{}.{}'.format(
+            quote_name(MedicalExaminationResult._meta.db_table),
+            quote_name(MedicalExaminationResult._meta.get_field('examined_by').column),
+        ),
+        seed=table('seed', Person),
+        seed_id=column('seed', Person, 'id'),
+        # Integers, safe as literals, and not bound by the limit of query parameters
+        seed_person_ids=', '.join(str(int(person_id)) for person_id in sorted(seed_person_ids)),
+        worker=table('exposure_worker', HospitalWorker),
+        worker_id=column('exposure_worker', HospitalWorker, 'id'),
+        worker_person_id=column('exposure_worker', HospitalWorker, 'person'),
+        exposure=table('exposure', MedicalExaminationResult),
+        exposure_examined_by_id=column('exposure', MedicalExaminationResult, 'examined_by'),
+        exposure_patient_id=column('exposure', MedicalExaminationResult, 'patient'),
+        patient=table('exposure_patient', Patient),
+        patient_id=column('exposure_patient', Patient, 'id'),
+        patient_person_id=column('exposure_patient', Patient, 'person'),
+        time_conditions=''.join(time_conditions),
+    )
+    return RawSQL(sql, params, output_field=BooleanField())
+
+
+class ExposureGraph(object):
+    """Exposure edges (examiner person -> examined person, time) in CSR form."""
+
+    def __init__(self, source_ids, offsets, target_ids, times):
+        self.source_ids = source_ids
+        # The edges of source_ids[i] are target_ids/times[offsets[i]:offsets[i + 1]], ordered by time
+        self.offsets = offsets
+        self.target_ids = target_ids
+        self.times = times
+        self._source_indexes = {source_id: index for index, source_id in enumerate(source_ids)}
+
+    @staticmethod
+    def _get_examinations(start_time, end_time, using):
+        examinations = MedicalExaminationResult.objects.using(using)
+        if start_time is not None:
+            examinations = examinations.filter(time__gte=start_time)
+        if end_time is not None:
+            examinations = examinations.filter(time__lte=end_time)
+        return examinations.order_by('examined_by__person', 'time')
+
+    @classmethod
+    def _from_edges(cls, edges):
+        """The graph of the edges, ordered by (source, time)."""
+        source_ids, offsets, target_ids, times = array('l'), array('l'), array('l'), array('d')
+        for source_id, target_id, time in edges:
+            if source_id == target_id:
+                continue
+            if not source_ids or source_ids[-1] != source_id:
+                source_ids.append(source_id)
+                offsets.append(len(target_ids))
+            target_ids.append(target_id)
+            times.append(time)
+        offsets.append(len(target_ids))
+        return cls(source_ids, offsets, target_ids, times)
+
+    @classmethod
+    def load(cls, start_time=None, end_time=None, using=DEFAULT_DB_ALIAS):
+        """Load the exposures of the examinations between start_time and end_time in a single query."""
+        return cls._from_edges(_iter_edges(cls._get_examinations(start_time, end_time, using)))
+
+    @classmethod
+    def load_reachable(cls, seed_person_ids, max_hops, start_time=None, end_time=None, using=DEFAULT_DB_ALIAS):
+        """
+        Load the exposures between start_time and end_time a trace of the seeds within max_hops may follow,
+        in a single query whatever the number of seeds and hops.
+        """
+        if not seed_person_ids or max_hops < 1:
+            return cls._from_edges(())
+        examinations = cls._get_examinations(start_time, end_time, using).annotate(
+            is_reachable=_get_reachable_condition(seed_person_ids, max_hops, start_time, end_time, using),
+        ).filter(is_reachable=True)
+        return cls._from_edges(_iter_edges(examinations))
+
+    def __len__(self):
+        return len(self.target_ids)
+
+    def trace(self, seed_person_ids, max_hops=3, window=None, start_time=None):
+        """
+        Persons exposed by the seeds within max_hops, ordered by (depth, time, person id).
+
+        Exposures only travel forward in time: a person passes it on with the examinations they
+        perform at or after the time they were exposed (and within `window` of it when given), the
+        seeds with all their examinations from `start_time` on. Every person is reported with their
+        earliest exposure.
+        """
+        window = None if window is None else window.total_seconds() * 1000000
+        seed_time = float('-inf') if start_time is None else _to_microseconds(start_time)
+
+        earliest = {}  # person id -> (time, path)
+        for seed_person_id in seed_person_ids:
+            earliest[seed_person_id] = (seed_time, (seed_person_id, ))
+
+        # Hop by hop, only persons whose earliest exposure just improved can improve others
+        frontier = set(earliest)
+        for _ in range(max_hops):
+            next_frontier = set()
+            for person_id in frontier:
+                index = self._source_indexes.get(person_id)
+                if index is None:
+                    continue
+
+                exposure_time, path = earliest[person_id]
+                first, last = self.offsets[index], self.offsets[index + 1]
+                first = bisect.bisect_left(self.times, exposure_time, first, last)
+                # The seeds pass it on all along
+                if window is not None and len(path) > 1:
+                    last = bisect.bisect_right(self.times, exposure_time + window, first, last)
+                for edge in range(first, last):
+                    target_id, time = self.target_ids[edge], self.times[edge]
+                    if target_id in earliest and earliest[target_id][0] <= time:
+                        continue
+                    earliest[target_id] = (time, path + (target_id, ))
+                    next_frontier.add(target_id)
+
+            if not next_frontier:
+                break
+            frontier = next_frontier
+
+        seed_person_ids = set(seed_person_ids)
+        exposures = [
+            Exposure(person_id=person_id, depth=len(path) - 1, time=_from_microseconds(time), path=path)
+            for person_id, (time, path) in earliest.items()
+            if person_id not in seed_person_ids
+        ]
+        exposures.sort(key=lambda exposure: (exposure.depth, exposure.time, exposure.person_id))
+        return exposures
+
+
+def trace_exposures(hospital_workers, max_hops=3, window=None, start_time=None, end_time=None,
+                    using=DEFAULT_DB_ALIAS):
+    """
+    Trace the persons exposed by hospital workers (a HospitalWorker queryset or instances).
+
+    Two queries whatever the number of workers and hops, the workers' persons and the exposure edges they
+    may reach.
+    """
+    if isinstance(hospital_workers, QuerySet):
+        seed_person_ids = set(hospital_workers.values_list('person', flat=True))
+    else:
+        seed_person_ids = {hospital_worker.person_id for hospital_worker in hospital_workers}
+
+    graph = ExposureGraph.load_reachable(
+        seed_person_ids,
+        max_hops,
+        start_time=start_time,
+        end_time=end_time,
+        using=using,
+    )
+    return graph.trace(seed_person_ids, max_hops=max_hops, window=window, start_time=start_time)
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf.urls import url
+
+from django_advanced_queries.covid_19 import views
+
+app_name = 'covid_19'
+urlpatterns = [
+    url(r'^examinations/export/$', views.export_examinations, name='export_examinations'),
+    url(r'^api/epidemic-curve/$', views.api_epidemic_curve, name='api_epidemic_curve'),
+    url(r'^api/reports/$', views.api_submit_report, name='api_submit_report'),
+    url(r'^api/reports/(?P<job_id>[0-9]+)/$', views.api_report, name='api_report'),
+    url(r'^api/(?P<resource>[a-z]+)/$', views.api_list, name='api_list'),
+]
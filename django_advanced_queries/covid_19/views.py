@@ -1,6 +1,134 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.shortcuts import render
+import functools
+import json
+from calendar import timegm
 
-# Create your views here.
+from django.http import Http404, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET, require_POST
+
+from django_advanced_queries.covid_19.api import RESOURCES, get_epidemic_curve
+from django_advanced_queries.covid_19.exports import CONTENT_TYPES, FORMAT_NDJSON, iter_export_lines, parse_since
+from django_advanced_queries.covid_19.models import ReportJob
+from django_advanced_queries.covid_19.reports import get_job_record, submit_report
+
+
+def is_staff(user):
+    return user.is_active and user.is_staff
+
+
+def staff_required(view):
+    """The view serves personal health data: 403 to anyone but active staff users (API clients get no login page)."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not is_staff(request.user):
+            return HttpResponseForbidden('Only staff users can access personal health data')
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+@require_GET
+@staff_required
+def export_examinations(request):
+    """Stream all medical examination results (?format=ndjson|csv, optional ?since=<ISO date/datetime>)."""
+    export_format = request.GET.get('format', FORMAT_NDJSON)
+    if export_format not in CONTENT_TYPES:
+        return HttpResponseBadRequest('Unknown format {export_format}'.format(export_format=export_format))
+
+    since = None
+    if request.GET.get('since'):
+        try:
+            since = parse_since(request.GET['since'])
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+    response = StreamingHttpResponse(
+        iter_export_lines(export_format, since=since),
+        content_type=CONTENT_TYPES[export_format],
+    )
+    response['Content-Disposition'] = 'attachment; filename="medical_examination_results.{extension}"'.format(
+        extension=export_format,
+    )
+    return response
+
+
+@require_GET
+def api_list(request, resource):
+    """
+    A page of hospitals/departments/patients/workers/examinations.
+
+    ?limit=<page size>, ?cursor=<next_cursor of the previous page> and the resource's filters.
+
+    The ETag and Last-Modified come from a single aggregate query (see `Resource.get_validator`), a 304 costs
+    that query only, not the page's.
+    """
+    if resource not in RESOURCES:
+        raise Http404('Unknown resource {resource}'.format(resource=resource))
+    if RESOURCES[resource].is_personal and not is_staff(request.user):
+        return HttpResponseForbidden('Only staff users can access personal health data')
+
+    try:
+        etag, last_modified = RESOURCES[resource].get_validator(request.GET)
+        last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+        records, next_cursor = RESOURCES[resource].get_page(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    response = JsonResponse({'results': records, 'next_cursor': next_cursor})
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+@require_GET
+def api_epidemic_curve(request):
+    """Daily/weekly new corona cases, deaths and recoveries, see `api.get_epidemic_curve` for the params."""
+    try:
+        series = get_epidemic_curve(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    return JsonResponse({'results': series})
+
+
+@require_POST
+@staff_required
+def api_submit_report(request):
+    """
+    Queue a report (a JSON body {"report": ..., "params": {...}, "priority": ...}), 202 with the job to poll.
+
+    An identical report pending or running of the same user is the same job. The session's clients send
+    the CSRF token (the X-CSRFToken header) as the forms do.
+    """
+    try:
+        body = json.loads(request.body.decode('utf-8'))
+        if not isinstance(body, dict):
+            raise ValueError('The body must be an object')
+        job = submit_report(
+            body.get('report'),
+            body.get('params'),
+            priority=int(body.get('priority', 0)),
+            submitted_by=request.user,
+        )
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    record = get_job_record(job)
+    record['url'] = reverse('covid_19:api_report', args=(job.pk, ))
+    return JsonResponse(record, status=202)
+
+
+@require_GET
+@staff_required
+def api_report(request, job_id):
+    """The status of a report job, with its result once succeeded. 404 on the jobs of other users."""
+    return JsonResponse(get_job_record(get_object_or_404(ReportJob, pk=job_id, submitted_by=request.user)))
@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'django_advanced_queries.covid_19.routers.PinPrimaryMiddleware',
 ]
 
 ROOT_URLCONF = 'django_advanced_queries.urls'
@@ -83,6 +84,11 @@ DATABASES = {
     }
 }
 
+DATABASE_ROUTERS = [
+    'django_advanced_queries.covid_19.shards.HospitalShardRouter',
+    'django_advanced_queries.covid_19.routers.ReadReplicaRouter',
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -121,3 +127,76 @@ USE_TZ = False
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# covid_19 manager methods query instrumentation (see covid_19/instrumentation.py)
+
+COVID_19_QUERY_INSTRUMENTATION = True
+
+# Dotted path to an object with a `record(name, measurement)` method, defaults to the in-process histogram registry
+COVID_19_QUERY_INSTRUMENTATION_SINK = None
+
+
+# covid_19 read replicas (see covid_19/routers.py)
+
+# Aliases of DATABASES entries replicating 'default', the analytic manager methods read from them
+COVID_19_READ_REPLICAS = []
+
+# Seconds the requests following a write stay pinned to the primary, so they read their own writes
+COVID_19_REPLICATION_LAG = 5
+
+
+# covid_19 aggregate manager methods result cache (see covid_19/caching.py)
+
+COVID_19_QUERY_CACHE = False
+
+# Dotted path to a cache backend object, defaults to the default Django cache (shared by the processes only
+# when CACHES is), 'django_advanced_queries.covid_19.caching.local_backend' is an in-process LRU for a single
+# process deployment
+COVID_19_QUERY_CACHE_BACKEND = None
+
+# Seconds a result is kept, and how many results the in-process LRU keeps
+COVID_19_QUERY_CACHE_TTL = 300
+COVID_19_QUERY_CACHE_MAX_ENTRIES = 1024
+
+
+# covid_19 models representations (see covid_19/display.py)
+
+# False - the reprs never query, the relations that aren't loaded show as their ids
+COVID_19_REPR_LAZY_LOADS = True
+
+
+# covid_19 production SQLite profile (see covid_19/sqlite.py)
+
+# WAL, tuned pragmas and persistent connections, run `python manage.py optimize_database` periodically with it
+COVID_19_SQLITE_PRODUCTION = os.environ.get('COVID_19_SQLITE_PRODUCTION') == '1'
+
+# Overrides of covid_19.sqlite.PRODUCTION_PRAGMAS ({pragma: value}, None drops a pragma)
+COVID_19_SQLITE_PRAGMAS = {}
+
+
+# covid_19 sharding by hospital (see covid_19/shards.py)
+
+# Aliases of DATABASES entries holding a part of the hospitals each. COVID_19_SHARDS=<number> in the environment
+# stands local SQLite files in for the shards (migrate each of them with --database shard_<n>)
+COVID_19_SHARDS = []
+for shard_number in range(int(os.environ.get('COVID_19_SHARDS', 0))):
+    shard_alias = 'shard_{number}'.format(number=shard_number)
+    DATABASES[shard_alias] = dict(
+        DATABASES['default'],
+        NAME=os.path.join(BASE_DIR, 'db.{alias}.sqlite3'.format(alias=shard_alias)),
+    )
+    COVID_19_SHARDS.append(shard_alias)
+
+# Threads running a sharded manager method on the shards, defaults to one per shard
+COVID_19_SHARD_WORKERS = None
+
+
+# Persistent connections of the production SQLite profile, once every database (default, shards and replicas) is
+# declared - the profile's pragmas apply to each of them as well (see covid_19/sqlite.py)
+
+if COVID_19_SQLITE_PRODUCTION:
+    # Seconds a connection is reused by the following requests
+    for database in DATABASES.values():
+        if database['ENGINE'] == 'django.db.backends.sqlite3':
+            database.setdefault('CONN_MAX_AGE', 600)